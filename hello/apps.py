@@ -7,3 +7,24 @@ class HelloConfig(AppConfig):
 
     # Name of the app, used by Django for app management
     name = 'hello'
+
+    def ready(self):
+        # Access decisions are cached; every worker has to see the same cache
+        from .permissions import check_shared_cache
+        check_shared_cache()
+
+        # Tune every new SQLite connection for concurrent readers and the single writer
+        from django.db.backends.signals import connection_created
+        from .persistence import configure_sqlite
+        connection_created.connect(configure_sqlite)
+
+        # Count queries towards the active trace when tracing is enabled
+        from .tracing import install_query_counter
+        connection_created.connect(install_query_counter)
+
+        # Keep the search index in step with saved and deleted documents
+        from django.db.models.signals import post_delete, post_save
+        from .models import Document
+        from .search import document_deleted, document_saved
+        post_save.connect(document_saved, sender=Document, dispatch_uid='hello.search.document_saved')
+        post_delete.connect(document_deleted, sender=Document, dispatch_uid='hello.search.document_deleted')
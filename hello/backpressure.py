@@ -0,0 +1,184 @@
+"""
+Per-connection outgoing queues for the WebSocket consumer.
+
+Handlers do not write to the socket directly. They put messages in the
+connection's SendQueue, and a writer task sends them as fast as the client
+reads. Because each handler returns immediately, a slow client no longer
+leaves a backlog of group messages in the channel layer. Messages still
+waiting in the queue are merged where a newer one makes them obsolete:
+
+- a snapshot drops every pending revisioned message (snapshot and its
+  chunks, edit, operation, ack), since it resets the client's state;
+- consecutive full-content edits collapse into the newest one, which then
+  replaces the content the client actually has;
+- activity frames merge into the pending one, and a newer participant list
+  replaces a pending one.
+
+A client whose queue still grows past COLLAB_SEND_QUEUE_FRAMES, or whose
+oldest pending message is older than COLLAB_SLOW_CLIENT_SECONDS, is
+reported as slow and the consumer disconnects it. The chunks of a snapshot
+count as part of the snapshot, so a large document can still be sent.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import framing
+from . import metrics as collab_metrics
+
+logger = logging.getLogger(__name__)
+
+# Pending messages a connection may have before it counts as slow
+MAX_QUEUED_FRAMES = getattr(settings, 'COLLAB_SEND_QUEUE_FRAMES', 64)
+
+# Seconds the oldest pending message may wait before the connection counts as slow
+MAX_LAG_SECONDS = getattr(settings, 'COLLAB_SLOW_CLIENT_SECONDS', 10)
+
+# Close code sent to clients dropped for falling behind
+SLOW_CLIENT_CLOSE_CODE = 4008
+
+# Messages that depend on the revision the client is at
+REVISIONED_ACTIONS = {'snapshot', 'snapshot_chunk', 'resume', 'edit', 'operation', 'ack'}
+
+
+class BackpressureMetrics:
+    """
+    Process-wide counters for the outgoing queues.
+    """
+
+    def __init__(self):
+        self.frames_queued = 0
+        self.frames_sent = 0
+        self.frames_superseded = 0
+        self.slow_clients = 0
+        self.max_queue_depth = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+metrics = BackpressureMetrics()
+
+
+class PendingMessage:
+    __slots__ = ('message', 'frame_id', 'queued_at')
+
+    def __init__(self, message, frame_id):
+        self.message = message
+        self.frame_id = frame_id
+        self.queued_at = time.monotonic()
+
+
+class SendQueue:
+    """
+    Bounded outgoing queue of one connection, drained by a writer task.
+    """
+
+    def __init__(self, send, encoding, max_frames=MAX_QUEUED_FRAMES, max_lag=MAX_LAG_SECONDS):
+        # `send` is the consumer's send(); it takes text_data or bytes_data
+        self._send = send
+        self.encoding = encoding
+        self.max_frames = max_frames
+        self.max_lag = max_lag
+        self._pending = deque()
+        # Pending 'snapshot_chunk' messages, which do not count towards max_frames
+        self._chunks = 0
+        self._ready = asyncio.Event()
+        self._writer = asyncio.ensure_future(self._run())
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, message, frame_id=None):
+        """
+        Queues a message, merging it with pending messages it supersedes.
+        Returns False once the client has fallen too far behind.
+        """
+        action = message.get('action')
+        if action == 'snapshot':
+            self._drop(lambda pending: pending.message.get('action') in REVISIONED_ACTIONS)
+        elif action == 'edit':
+            message, frame_id = self._collapse_edits(message, frame_id)
+        elif action in ('activity', 'presence'):
+            for pending in self._pending:
+                if pending.message.get('action') == action:
+                    pending.message = _merge_activity(pending.message, message) if action == 'activity' else message
+                    pending.frame_id = None
+                    metrics.frames_superseded += 1
+                    return not self.is_slow()
+
+        self._pending.append(PendingMessage(message, frame_id))
+        if action == 'snapshot_chunk':
+            self._chunks += 1
+        self._ready.set()
+        metrics.frames_queued += 1
+        metrics.max_queue_depth = max(metrics.max_queue_depth, len(self._pending))
+        return not self.is_slow()
+
+    def is_slow(self):
+        """
+        Returns True if the client is behind by more than the allowed number
+        of messages or seconds.
+        """
+        if not self._pending:
+            return False
+        return (
+            len(self._pending) - self._chunks > self.max_frames
+            or time.monotonic() - self._pending[0].queued_at > self.max_lag
+        )
+
+    def close(self):
+        """
+        Stops the writer and discards anything not yet sent.
+        """
+        self._writer.cancel()
+        self._pending.clear()
+        self._chunks = 0
+
+    def _collapse_edits(self, message, frame_id):
+        # A full-content edit replaces the content left by the edits queued
+        # right before it, so the client only needs the newest one
+        while self._pending and self._pending[-1].message.get('action') == 'edit':
+            previous = self._pending[-1].message
+            if previous.get('replaced_length') is None or message.get('replaced_length') is None:
+                break
+            self._pending.pop()
+            message = dict(message, replaced_length=previous['replaced_length'])
+            frame_id = None
+            metrics.frames_superseded += 1
+        return message, frame_id
+
+    def _drop(self, predicate):
+        kept = [pending for pending in self._pending if not predicate(pending)]
+        metrics.frames_superseded += len(self._pending) - len(kept)
+        self._pending = deque(kept)
+        self._chunks = sum(1 for pending in kept if pending.message.get('action') == 'snapshot_chunk')
+
+    async def _run(self):
+        while True:
+            while not self._pending:
+                self._ready.clear()
+                await self._ready.wait()
+            pending = self._pending.popleft()
+            action = pending.message.get('action')
+            if action == 'snapshot_chunk':
+                self._chunks -= 1
+            frame = framing.encode(pending.message, self.encoding, pending.frame_id)
+            await self._send(**frame)
+            metrics.frames_sent += 1
+            collab_metrics.messages_sent.inc(action)
+            collab_metrics.bytes_sent.inc(action, amount=len(frame.get('text_data') or frame.get('bytes_data')))
+
+
+def _merge_activity(older, newer):
+    cursors = {cursor['user']: cursor for cursor in older['cursors']}
+    cursors.update((cursor['user'], cursor) for cursor in newer['cursors'])
+    return {
+        'action': 'activity',
+        'cursors': list(cursors.values()),
+        'typing': sorted(set(older['typing']) | set(newer['typing'])),
+        'participants': newer['participants'] if newer['participants'] is not None else older['participants'],
+    }
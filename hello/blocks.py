@@ -0,0 +1,247 @@
+"""
+Block-structured storage of document content.
+
+With DOCUMENT_BLOCK_STORAGE on, a document's content is stored as
+DocumentBlock rows instead of one Document.content blob. Each block is a
+top-level element of the HTML (a paragraph, heading, list, table...) and
+keeps its row, and so its id, for as long as it exists. Blocks are ordered by
+a fractional position key: a string that sorts between its neighbours, so a
+block inserted anywhere gets a key between the two around it and no other row
+is renumbered.
+
+A save splits the new content into blocks and compares their hashes with the
+stored ones. Only the changed run in the middle is written: changed blocks are
+updated, removed ones deleted and new ones inserted, so a one-character edit
+of a multi-megabyte document rewrites one paragraph.
+
+Readers get the full HTML from `document_content`, which assembles the blocks
+and caches the result under the content hash. Every save primes that cache
+with the content it wrote, so assembly queries are rare.
+
+Existing documents keep their blob and are converted on their first save while
+block storage is on (or all at once with `manage.py convert_block_storage`).
+Turning the setting off converts documents back to a blob on their next save;
+`convert_block_storage --to-blob` does it for every document.
+"""
+import re
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import metrics
+from .models import Document, DocumentBlock, hash_content
+
+BLOCK_STORAGE = getattr(settings, 'DOCUMENT_BLOCK_STORAGE', False)
+
+# Seconds an assembled document stays cached
+CACHE_TIMEOUT = getattr(settings, 'DOCUMENT_BLOCK_CACHE_TIMEOUT', 60 * 60)
+
+# Larger documents are assembled on every read instead of being cached
+CACHE_MAX_BYTES = getattr(settings, 'DOCUMENT_BLOCK_CACHE_MAX_BYTES', 5 * 1024 * 1024)
+
+# Rows per bulk update or insert
+BATCH_SIZE = 200
+
+# Position key digits, in the order they sort in every collation
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+_TAG = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*?(/?)>', re.S)
+
+_VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+
+def split_blocks(content):
+    """
+    Splits HTML into its top-level elements. Text between them belongs to the
+    next block, and joining the blocks always gives back `content` exactly.
+    """
+    blocks = []
+    start = depth = 0
+    for match in _TAG.finditer(content):
+        closing, name, self_closing = match.groups()
+        if name is None or self_closing or name.lower() in _VOID_ELEMENTS:
+            continue
+        if not closing:
+            depth += 1
+            continue
+        # Stray closing tags are ignored rather than unbalancing the rest
+        depth = max(0, depth - 1)
+        if depth == 0:
+            blocks.append(content[start:match.end()])
+            start = match.end()
+    if start < len(content):
+        blocks.append(content[start:])
+    return blocks
+
+
+def key_between(before=None, after=None):
+    """
+    Returns a position key sorting after `before` and before `after` (either
+    may be None for the start or end). Keys never end in the lowest digit,
+    so there is always room for another key in front of one.
+    """
+    before = before or ''
+    key = ''
+    index = 0
+    while True:
+        low = DIGITS.index(before[index]) if index < len(before) else 0
+        high = DIGITS.index(after[index]) if after is not None and index < len(after) else len(DIGITS)
+        if high - low > 1:
+            return key + DIGITS[(low + high) // 2]
+        key += DIGITS[low]
+        if high > low:
+            # The key is now below `after` whatever follows
+            after = None
+        index += 1
+
+
+def keys_between(before, after, count):
+    """
+    Returns `count` ascending keys between `before` and `after`, spread out
+    so their length grows with the log of `count`.
+    """
+    if count <= 0:
+        return []
+    middle = key_between(before, after)
+    left = (count - 1) // 2
+    return keys_between(before, middle, left) + [middle] + keys_between(middle, after, count - 1 - left)
+
+
+def store_blocks(document_id, content, content_hash=None):
+    """
+    Makes the document's blocks match `content`, writing only the blocks that
+    changed. Returns the number of rows updated, inserted and deleted.
+    Runs in the caller's transaction.
+    """
+    blocks = split_blocks(content)
+    hashes = [hash_content(block) for block in blocks]
+    stored = list(
+        DocumentBlock.objects.filter(document_id=document_id).order_by('position')
+        .values_list('id', 'position', 'content_hash')
+    )
+
+    # Blocks at the start and end that did not change are left alone
+    limit = min(len(stored), len(blocks))
+    prefix = 0
+    while prefix < limit and stored[prefix][2] == hashes[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and stored[-1 - suffix][2] == hashes[-1 - suffix]:
+        suffix += 1
+    old = stored[prefix:len(stored) - suffix]
+    start = stored[prefix - 1][1] if prefix else None
+    end = stored[len(stored) - suffix][1] if suffix else None
+
+    # Within the changed run, changed blocks keep their rows; the rest are deleted or inserted
+    updates, inserts, deleted = [], [], []
+    matcher = SequenceMatcher(None, [row[2] for row in old], hashes[prefix:len(blocks) - suffix], autojunk=False)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        paired = min(old_end - old_start, new_end - new_start)
+        for offset in range(paired):
+            index = prefix + new_start + offset
+            updates.append(DocumentBlock(id=old[old_start + offset][0], content=blocks[index], content_hash=hashes[index]))
+        deleted.extend(row[0] for row in old[old_start + paired:old_end])
+        # New blocks go between the last row kept before them and the next row after the run
+        before = old[old_start + paired - 1][1] if old_start + paired else start
+        after = old[old_end][1] if old_end < len(old) else end
+        indexes = range(prefix + new_start + paired, prefix + new_end)
+        inserts.extend(
+            DocumentBlock(document_id=document_id, position=position, content=blocks[index], content_hash=hashes[index])
+            for position, index in zip(keys_between(before, after, len(indexes)), indexes)
+        )
+
+    # Deleted keys may lie between the neighbours of the inserted ones
+    if deleted:
+        DocumentBlock.objects.filter(id__in=deleted).delete()
+    if updates:
+        DocumentBlock.objects.bulk_update(updates, ['content', 'content_hash'], batch_size=BATCH_SIZE)
+    if inserts:
+        DocumentBlock.objects.bulk_create(inserts, batch_size=BATCH_SIZE)
+    metrics.block_writes.inc('update', amount=len(updates))
+    metrics.block_writes.inc('insert', amount=len(inserts))
+    metrics.block_writes.inc('delete', amount=len(deleted))
+
+    _cache_content(document_id, content_hash or hash_content(content), content)
+    return len(updates), len(inserts), len(deleted)
+
+
+def assemble(document_id, content_hash):
+    """
+    Returns the content of a block-stored document, from the cache if possible.
+    """
+    content = cache.get(_cache_key(document_id, content_hash))
+    if content is not None:
+        return content
+    content = ''.join(
+        DocumentBlock.objects.filter(document_id=document_id).order_by('position').values_list('content', flat=True)
+    )
+    # A save committed between reading the hash and the blocks must not be cached under the old hash
+    if hash_content(content) == content_hash:
+        _cache_content(document_id, content_hash, content)
+    return content
+
+
+def document_content(document):
+    """
+    Returns the full content of a Document, whichever way it is stored.
+    """
+    if document.block_storage:
+        return assemble(document.id, document.content_hash)
+    return document.content
+
+
+def load_content(document_id):
+    """
+    Returns the full content of a document by id, or '' if it does not exist.
+    """
+    row = Document.objects.filter(id=document_id).values_list('block_storage', 'content', 'content_hash').first()
+    if row is None:
+        return ''
+    block_storage, content, content_hash = row
+    return assemble(document_id, content_hash) if block_storage else content
+
+
+def convert_to_blocks(document_id):
+    """
+    Moves a document's content from its blob into blocks.
+    Returns False if it was already block-stored or does not exist.
+    """
+    with transaction.atomic():
+        documents = Document.objects.select_for_update().filter(id=document_id)
+        row = documents.values_list('block_storage', 'content', 'content_hash').first()
+        if row is None or row[0]:
+            return False
+        block_storage, content, content_hash = row
+        content_hash = content_hash or hash_content(content)
+        store_blocks(document_id, content, content_hash)
+        documents.update(content='', content_hash=content_hash, block_storage=True)
+    return True
+
+
+def convert_to_blob(document_id):
+    """
+    Moves a document's content from its blocks back into its blob and deletes
+    the blocks. Returns False if it was not block-stored.
+    """
+    with transaction.atomic():
+        documents = Document.objects.select_for_update().filter(id=document_id)
+        row = documents.values_list('block_storage', 'content_hash').first()
+        if row is not None and row[0]:
+            documents.update(content=assemble(document_id, row[1]), block_storage=False)
+        # Also drops blocks left behind by saves made with block storage off
+        DocumentBlock.objects.filter(document_id=document_id).delete()
+    return row is not None and row[0]
+
+
+def _cache_key(document_id, content_hash):
+    return f'document_blocks_{document_id}_{content_hash}'
+
+
+def _cache_content(document_id, content_hash, content):
+    # The key names the content, so an entry never needs invalidating
+    if len(content) <= CACHE_MAX_BYTES:
+        cache.set(_cache_key(document_id, content_hash), content, CACHE_TIMEOUT)
@@ -0,0 +1,86 @@
+"""
+Per-tick batching of high-frequency collaboration chatter.
+
+Cursor moves, typing notifications and presence snapshots are not relayed
+one group message per event. They are collected per document and sent as a
+single 'activity_frame' every COLLAB_FRAME_INTERVAL_MS milliseconds. Within a
+tick only the latest cursor position of each connection is kept, and each
+recipient filters out its own entries, so nothing is echoed back.
+"""
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+
+# Milliseconds between activity frames of a document
+FRAME_INTERVAL_MS = getattr(settings, 'COLLAB_FRAME_INTERVAL_MS', 50)
+
+
+class PendingFrame:
+    """
+    Activity of one document collected since the last frame.
+    """
+
+    def __init__(self):
+        # channel name -> {'user': ..., 'position': ...}; newer positions replace older ones
+        self.cursors = {}
+        # channel name -> username
+        self.typing = {}
+        self.participants = None
+
+    def as_event(self):
+        return {
+            'type': 'activity_frame',
+            'cursors': self.cursors,
+            'typing': self.typing,
+            'participants': self.participants,
+        }
+
+
+class FrameCoalescer:
+    """
+    Collects activity per document and flushes it once per tick.
+    """
+
+    def __init__(self, interval_ms=FRAME_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self._frames = {}
+
+    def cursor(self, document_id, channel_name, username, position):
+        self._frame(document_id).cursors[channel_name] = {'user': username, 'position': position}
+
+    def typing(self, document_id, channel_name, username):
+        self._frame(document_id).typing[channel_name] = username
+
+    def presence(self, document_id, participants):
+        self._frame(document_id).participants = participants
+
+    def forget(self, document_id, channel_name):
+        """
+        Drops pending activity of a connection that went away.
+        """
+        frame = self._frames.get(str(document_id))
+        if frame is not None:
+            frame.cursors.pop(channel_name, None)
+            frame.typing.pop(channel_name, None)
+
+    def _frame(self, document_id):
+        document_id = str(document_id)
+        frame = self._frames.get(document_id)
+        if frame is None:
+            # First activity of this tick: schedule the flush
+            frame = self._frames[document_id] = PendingFrame()
+            asyncio.get_event_loop().call_later(self.interval, self._flush, document_id)
+        return frame
+
+    def _flush(self, document_id):
+        frame = self._frames.pop(document_id, None)
+        if frame is None or not (frame.cursors or frame.typing or frame.participants is not None):
+            return
+        asyncio.ensure_future(metrics.group_send(get_channel_layer(), f'document_{document_id}', frame.as_event()))
+
+
+# Process-wide coalescer shared by all consumers
+coalescer = FrameCoalescer()
@@ -0,0 +1,54 @@
+"""
+Content-Encoding negotiation for large HTTP payloads.
+
+gzip is always available; brotli is used when the optional `brotli` package
+is installed and the client accepts it.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Payloads smaller than this are sent uncompressed
+MIN_COMPRESS_SIZE = 1024
+
+
+def negotiate_encoding(request, size):
+    """
+    Returns the best encoding the client accepts for a payload of `size`
+    bytes ('br', 'gzip' or None).
+    """
+    if size < MIN_COMPRESS_SIZE:
+        return None
+
+    accepted = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    """
+    Compresses bytes with the given encoding.
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
@@ -1,43 +1,95 @@
+import logging
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
+from .blocks import document_content
 from .models import Document
-import json
+from .permissions import has_document_access
+from .presence import get_presence_backend, get_presence_broadcaster
+from .coalescing import coalescer
+from .sessions import registry, StaleRevision
+from .sharding import MOVED_CLOSE_CODE, channel_layer_alias, document_group, worker_url_for
+from .backpressure import SendQueue, SLOW_CLIENT_CLOSE_CODE, metrics as send_metrics
+from .ratelimit import get_rate_limiter
+from . import framing, metrics, ot, tracing
+from .tracing import database_sync_to_async
+
+logger = logging.getLogger(__name__)
 
 class DocumentConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for real-time collaborative editing of documents.
     """
 
+    # Outgoing message queue, created once the connection is accepted
+    outbox = None
+
+    # Latest revision the client has been sent; group events up to it are skipped
+    sent_revision = -1
+
+    async def __call__(self, scope, receive, send):
+        # Open this connection's channel on the shard that carries its document's group
+        self.channel_layer_alias = channel_layer_alias(scope['url_route']['kwargs']['doc_id'], self.channel_layer_alias)
+        return await super().__call__(scope, receive, send)
+
+    async def dispatch(self, message):
+        # Every received frame and group event is traced on its own
+        with tracing.trace(message['type']):
+            await super().dispatch(message)
+
     async def connect(self):
         """
         Handles a new WebSocket connection.
         - Authenticates the user.
+        - Negotiates the message encoding through the WebSocket subprotocol.
+        - Redirects the client if another worker owns the document.
+        - Joins the document's live session and sends the client a snapshot,
+          or only the changes it missed when it is resuming a connection.
         - Adds the user to a document-specific group.
-        - Notifies the group of the user's connection.
+        - Registers the user's presence and sends the current participants.
         """
         # Retrieve the document ID from the URL and generate a group name
         self.doc_id = self.scope['url_route']['kwargs']['doc_id']
-        self.group_name = f'document_{self.doc_id}'
+        self.group_name = document_group(self.doc_id)
         self.user = self.scope['user']
 
-        print(f'User attempting to connect: {self.user} (Authenticated: {self.user.is_authenticated})')
+        # A reconnecting editor names itself and the last revision it saw: ?client=<id>&resume=<session>.<revision>
+        query = parse_qs(self.scope.get('query_string', b'').decode('latin-1'))
+        self.client_id = query.get('client', [None])[0]
+        resume = query.get('resume', [None])[0]
+
+        logger.debug(f'User attempting to connect: {self.user} (Authenticated: {self.user.is_authenticated})')
 
         # Check if the user has permission to access the document
         has_permission = await self.user_has_permission()
 
-        if has_permission:
+        redirect_url = worker_url_for(self.doc_id) if has_permission else None
+
+        if redirect_url:
+            # The document's live session runs on another worker
+            self.encoding, subprotocol = framing.negotiate(self.scope)
+            await self.accept(subprotocol)
+            await self.send(**framing.encode({'action': 'redirect', 'url': redirect_url}, self.encoding))
+            await self.close(code=MOVED_CLOSE_CODE)
+        elif has_permission:
+            # Join the live session, loading the stored content if it is the first connection
+            self.session = await registry.join(self.doc_id, self.channel_name, self.get_current_content)
+
             # Add the user to the group and accept the WebSocket connection
             await self.channel_layer.group_add(self.group_name, self.channel_name)
-            await self.accept()
-
-            # Notify the group that the user has connected
-            await self.channel_layer.group_send(
-                self.group_name,
-                {
-                    'type': 'user_connected',
-                    'user': self.user.username,
-                }
-            )
+            self.encoding, subprotocol = framing.negotiate(self.scope)
+            await self.accept(subprotocol)
+            self.outbox = SendQueue(self.send, self.encoding)
+
+            # Send the authoritative content and the revision operations are based on
+            if not await self.send_missed(resume):
+                await self.send_snapshot()
+
+            # Record the user's presence; the group hears about it in the next coalesced snapshot
+            await self.touch_presence()
+            participants = await sync_to_async(get_presence_backend().participants, thread_sensitive=False)(self.doc_id)
+            await self.presence_snapshot({'participants': participants})
         else:
             # Close the connection if the user does not have permission
             await self.close()
@@ -45,111 +97,320 @@ class DocumentConsumer(AsyncWebsocketConsumer):
     async def disconnect(self, close_code):
         """
         Handles WebSocket disconnection.
-        - Saves the current document content.
-        - Notifies the group of the user's disconnection.
+        - Leaves the live session, which flushes its content when the last user leaves.
+        - Removes the user's presence.
         - Removes the user from the document-specific group.
         """
-        # Save the current content of the document
-        content = await self.get_current_content()
-        await self.save_document_content(content)
-
-        # Notify the group that the user has disconnected
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                'type': 'user_disconnected',
-                'user': self.user.username,
-            }
+        # The connection was refused before joining a session
+        if getattr(self, 'session', None) is None:
+            return
+
+        # Stop sending; whatever is still queued is of no use now
+        if self.outbox is not None:
+            self.outbox.close()
+
+        # The session writes its unflushed content once the last user leaves
+        await registry.leave(self.doc_id, self.channel_name)
+
+        # Drop the user's presence; remaining participants get a coalesced snapshot
+        removed = await sync_to_async(get_presence_backend().remove, thread_sensitive=False)(
+            self.doc_id, self.user.username, self.channel_name
         )
+        if removed:
+            get_presence_broadcaster().changed(self.doc_id)
+        coalescer.forget(self.doc_id, self.channel_name)
 
         # Remove the user from the group
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Handles incoming messages from the WebSocket client.
-        - Processes actions such as 'edit' or 'typing'.
+        - Drops messages over the user's message rate limit.
+        - Processes actions such as 'operation', 'edit' or 'typing'.
         - Broadcasts updates to the group.
         """
         try:
-            # Parse the received JSON data
-            data = json.loads(text_data)
+            # Parse the received JSON or MessagePack data
+            data = framing.decode(text_data, bytes_data)
             action = data.get('action')
             user = self.user.username
 
-            if action == 'edit':
-                # Handle document editing actions
+            label = metrics.action_label(action)
+            current = tracing.current_trace()
+            if current is not None:
+                current.name = f'websocket.receive {label}'
+            metrics.messages_received.inc(label)
+            metrics.bytes_received.inc(label, amount=len(text_data.encode('utf-8')) if text_data is not None else len(bytes_data))
+
+            if not await self.allow_message(action):
+                return
+
+            if action == 'operation':
+                # Handle operation-based edits made against a known revision
+                ops = ot.normalize(data.get('ops'))
+                try:
+                    with tracing.span('session.commit'):
+                        ops, revision = self.session.commit(
+                            ops, data.get('revision'), self.user.id, origin=(user, self.client_id),
+                            batch=data.get('batch'),
+                        )
+                except StaleRevision:
+                    # Too far behind to transform; start the client over from a snapshot
+                    await self.send_snapshot()
+                    return
+
+                # Broadcast the transformed operations to the group
+                await metrics.group_send(
+                    self.channel_layer,
+                    self.group_name,
+                    {
+                        'type': 'document_operation',
+                        'ops': ops,
+                        'revision': revision,
+                        'user': user,
+                        'sender': self.channel_name,
+                        'frame_id': framing.new_frame_id(),
+                    }
+                )
+
+            elif action == 'edit':
+                # Handle legacy full-content edits
                 content = data.get('content', '')
                 cursor_position = data.get('cursor_position', None)
+                replaced_length, revision = self.session.replace(content, self.user.id, origin=(user, None))
 
                 # Broadcast the updated content and cursor position to the group
-                await self.channel_layer.group_send(
+                await metrics.group_send(
+                    self.channel_layer,
                     self.group_name,
                     {
                         'type': 'document_update',
                         'content': content,
                         'cursor_position': cursor_position,
                         'user': user,
+                        'revision': revision,
+                        'replaced_length': replaced_length,
+                        'sender': self.channel_name,
+                        'frame_id': framing.new_frame_id(),
                     }
                 )
 
+            elif action == 'heartbeat':
+                # Keep the user's presence from expiring
+                await self.touch_presence()
+
+            elif action == 'cursor':
+                # Only the latest position per tick reaches the group
+                coalescer.cursor(self.doc_id, self.channel_name, user, data.get('position'))
+
             elif action == 'typing':
-                # Handle typing indicator actions
-                await self.channel_layer.group_send(
-                    self.group_name,
-                    {
-                        'type': 'typing_indicator',
-                        'user': user,
-                    }
-                )
+                # Handle typing indicator actions in the next activity frame
+                coalescer.typing(self.doc_id, self.channel_name, user)
         except Exception as e:
             # Handle any errors and send an error message to the client
-            await self.send(text_data=json.dumps({"action": "error", "message": str(e)}))
+            await self.send_message({"action": "error", "message": str(e)})
 
-    async def typing_indicator(self, event):
+    async def allow_message(self, action):
         """
-        Broadcasts a typing indicator to all group members.
+        Checks an incoming message against the user's message rate limit,
+        shared by all of the user's connections.
+        - Cursor, typing and heartbeat messages over the limit are dropped.
+        - Dropped edits are reported to the client, which sends its
+          operations again after `retry_after` seconds.
         """
-        user = event['user']
-        await self.send(text_data=json.dumps({
-            'action': 'typing',
-            'user': user,
-        }))
+        with tracing.span('rate_limit'):
+            result = await get_rate_limiter().check_async('document_message', f'user:{self.user.id}')
+        if result.allowed:
+            return True
+        metrics.rate_limit_rejections.inc('document_message')
+        if action in ('operation', 'edit'):
+            await self.send_message({
+                'action': 'rate_limited',
+                'action_dropped': action,
+                'retry_after': result.retry_after,
+            })
+        return False
+
+    async def activity_frame(self, event):
+        """
+        Sends a tick's batched cursors, typing users and participants,
+        leaving out this connection's own activity.
+        """
+        cursors = [cursor for channel, cursor in event['cursors'].items() if channel != self.channel_name]
+        typing = sorted({user for channel, user in event['typing'].items() if channel != self.channel_name})
+        participants = event.get('participants')
+        if not cursors and not typing and participants is None:
+            return
+
+        await self.send_message({
+            'action': 'activity',
+            'cursors': cursors,
+            'typing': typing,
+            'participants': participants,
+        })
 
     async def document_update(self, event):
         """
         Broadcasts document updates (content and cursor position) to all group members.
+        - The sender already has the content and is skipped.
+        - Updates already in the client's snapshot or resumed changes are skipped.
         """
+        if not self.advance(event.get('revision')) or event.get('sender') == self.channel_name:
+            return
+
         content = event['content']
         cursor_position = event.get('cursor_position', None)
         user = event['user']
 
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'action': 'edit',
             'content': content,
             'cursor_position': cursor_position,
             'user': user,
-        }))
+            'revision': event.get('revision'),
+            'replaced_length': event.get('replaced_length'),
+        }, event.get('frame_id'))
 
-    async def user_connected(self, event):
+    async def document_operation(self, event):
         """
-        Notifies all group members when a new user connects.
+        Broadcasts committed operations to all group members.
+        - The sender only receives an acknowledgement with the new revision.
+        - Operations already in the client's snapshot or resumed changes are skipped.
         """
-        user = event['user']
-        await self.send(text_data=json.dumps({
-            'action': 'user_connected',
-            'user': user,
-        }))
+        if not self.advance(event['revision']):
+            return
+        if event['sender'] == self.channel_name:
+            await self.send_message({
+                'action': 'ack',
+                'revision': event['revision'],
+            })
+            return
 
-    async def user_disconnected(self, event):
+        await self.send_message({
+            'action': 'operation',
+            'ops': event['ops'],
+            'revision': event['revision'],
+            'user': event['user'],
+        }, event.get('frame_id'))
+
+    def advance(self, revision):
         """
-        Notifies all group members when a user disconnects.
+        Records that the client is being sent `revision`. Returns False if it
+        already has it: the session may commit changes between joining the
+        group and sending the snapshot, and those reach the group as well.
         """
-        user = event['user']
-        await self.send(text_data=json.dumps({
-            'action': 'user_disconnected',
-            'user': user,
-        }))
+        if revision is None:
+            return True
+        if revision <= self.sent_revision:
+            return False
+        self.sent_revision = revision
+        return True
+
+    async def shard_moved(self, event):
+        """
+        Closes the connection after the document's group moved to another
+        shard; the client reconnects and lands on the new one.
+        """
+        await self.close(code=MOVED_CLOSE_CODE)
+
+    async def send_message(self, message, frame_id=None):
+        """
+        Queues a message for the client in its negotiated encoding.
+        - Messages broadcast to the group pass their `frame_id` so the
+          encoded frame is shared with the other recipients.
+        - Disconnects the client if it has fallen too far behind.
+        """
+        if self.outbox is None:
+            return
+        if not self.outbox.put(message, frame_id):
+            await self.drop_slow_client()
+
+    async def drop_slow_client(self):
+        """
+        Closes the connection of a client that stopped keeping up.
+        It can reconnect and start over from a fresh snapshot.
+        """
+        logger.warning(f'Disconnecting slow client: {self.user} ({len(self.outbox)} messages pending)')
+        send_metrics.slow_clients += 1
+        self.outbox.close()
+        self.outbox = None
+        await self.close(code=SLOW_CLIENT_CLOSE_CODE)
+
+    async def send_snapshot(self):
+        """
+        Sends the client the session's full content and current revision.
+        - This is the only copy of the document the editor loads.
+        - Large content is split into chunks queued back to back, so no
+          other revisioned message can come between them.
+        - Names the client's last committed operation batch, so an editor
+          that never saw its acknowledgement knows whether to send it again.
+        """
+        self.sent_revision = self.session.revision
+        committed = self.session.batches.get(self.client_id) if self.client_id else None
+        messages = framing.snapshot_messages(
+            self.session.content, self.session.revision, self.session.session_id, committed
+        )
+        for message in messages:
+            await self.send_message(message)
+
+    async def send_missed(self, resume):
+        """
+        Resumes a reconnecting client from `resume` ('<session>.<revision>',
+        the last revision it saw) by sending the changes committed since.
+        - The changes go out in one 'resume' message. The client's own
+          committed operations appear as acknowledgements.
+        - Returns False when the client has to start from a snapshot
+          instead: the session restarted, the changes are no longer all
+          kept, or they are larger than the document itself.
+        """
+        if not resume:
+            return False
+        session_id, _, revision = resume.partition('.')
+        missed = None
+        if session_id == self.session.session_id and revision.isdigit():
+            missed = self.session.missed_since(int(revision))
+        size = sum(len(op.get('text', '')) for _, ops, _ in missed or () for op in ops)
+        if missed is None or size > len(self.session.content):
+            metrics.resumes.inc('snapshot')
+            return False
+
+        messages = []
+        for revision, ops, origin in missed:
+            user, client_id = origin or (None, None)
+            if client_id is not None and client_id == self.client_id:
+                messages.append({'action': 'ack', 'revision': revision})
+            else:
+                messages.append({'action': 'operation', 'ops': ops, 'revision': revision, 'user': user})
+        self.sent_revision = self.session.revision
+        metrics.resumes.inc('replayed')
+        await self.send_message({
+            'action': 'resume',
+            'session': self.session.session_id,
+            'revision': self.session.revision,
+            'messages': messages,
+        })
+        return True
+
+    async def presence_snapshot(self, event):
+        """
+        Sends the current participant list to the client.
+        """
+        await self.send_message({
+            'action': 'presence',
+            'participants': event['participants'],
+        })
+
+    async def touch_presence(self):
+        """
+        Adds or refreshes the user's presence, scheduling a group snapshot
+        when the participant list changed.
+        """
+        changed = await sync_to_async(get_presence_backend().touch, thread_sensitive=False)(
+            self.doc_id, self.user.username, self.channel_name
+        )
+        if changed:
+            get_presence_broadcaster().changed(self.doc_id)
 
     @database_sync_to_async
     def user_has_permission(self):
@@ -158,11 +419,7 @@ class DocumentConsumer(AsyncWebsocketConsumer):
         - Returns True if the user is the owner or is shared with them.
         - Returns False otherwise.
         """
-        try:
-            document = Document.objects.get(id=self.doc_id)
-            return document.owner == self.user or self.user in document.shared_with.all()
-        except Document.DoesNotExist:
-            return False
+        return has_document_access(self.user, self.doc_id)
 
     @database_sync_to_async
     def get_current_content(self):
@@ -171,19 +428,6 @@ class DocumentConsumer(AsyncWebsocketConsumer):
         """
         try:
             document = Document.objects.get(id=self.doc_id)
-            return document.content
+            return document_content(document)
         except Document.DoesNotExist:
             return ""
-
-    @database_sync_to_async
-    def save_document_content(self, content):
-        """
-        Saves the provided content to the document.
-        """
-        try:
-            document = Document.objects.get(id=self.doc_id)
-            document.content = content
-            document.save()
-            return True
-        except Document.DoesNotExist:
-            return False
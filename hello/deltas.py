@@ -0,0 +1,45 @@
+"""
+Compact diffs between two versions of a document.
+
+A delta keeps the common prefix and suffix of the old text and replaces the
+middle, which is what a typical autosave changes. It is stored as a JSON
+array `[prefix_length, suffix_length, middle]` and computed in linear time,
+so it stays cheap on multi-megabyte documents.
+"""
+import json
+
+
+def make_delta(old, new):
+    """
+    Returns the delta that turns `old` into `new`, serialized as a string.
+    """
+    limit = min(len(old), len(new))
+    prefix = _common_prefix(old, new, limit)
+    suffix = _common_prefix(old[::-1], new[::-1], limit - prefix) if limit > prefix else 0
+    middle = new[prefix:len(new) - suffix]
+    return json.dumps([prefix, suffix, middle], separators=(',', ':'))
+
+
+def apply_delta(old, delta):
+    """
+    Rebuilds the newer text from `old` and a delta made by make_delta.
+    """
+    prefix, suffix, middle = json.loads(delta)
+    return old[:prefix] + middle + old[len(old) - suffix:]
+
+
+def _common_prefix(a, b, limit):
+    # Compare growing blocks first so long equal runs are matched in C, not per character
+    start, step = 0, 4096
+    while start < limit:
+        end = min(start + step, limit)
+        if a[start:end] == b[start:end]:
+            start = end
+            step *= 2
+            continue
+        if end - start <= 64:
+            while start < end and a[start] == b[start]:
+                start += 1
+            return start
+        step = max(64, (end - start) // 2)
+    return limit
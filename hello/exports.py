@@ -0,0 +1,462 @@
+"""
+Server-side document exports.
+
+Documents and versions are rendered as HTML, plain text, Markdown or DOCX.
+Every renderer is a generator that parses the stored HTML a slice at a time
+and yields encoded chunks, so the whole output never has to be held at
+once. Finished renders up to EXPORT_CACHE_MAX_BYTES are cached under their
+content hash and format, so exporting unchanged content again does not even
+load it.
+
+Views spool the chunks to a temporary file before responding. Under ASGI,
+Django 3.2 iterates response content on the event loop, where rendering and
+the queries of uncached renders would stall every WebSocket connection.
+
+stream_zip writes a ZIP archive on the fly, one entry after another. It is
+used for DOCX files and for the "all my documents" archive.
+"""
+import re
+import tempfile
+import time
+import zipfile
+from html.parser import HTMLParser
+from xml.sax.saxutils import escape as xml_escape
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.text import slugify
+
+# Format -> (content type, file extension)
+FORMATS = {
+    'html': ('text/html; charset=utf-8', 'html'),
+    'txt': ('text/plain; charset=utf-8', 'txt'),
+    'md': ('text/markdown; charset=utf-8', 'md'),
+    'docx': ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'docx'),
+}
+
+# Seconds a rendered export stays cached
+EXPORT_CACHE_TIMEOUT = getattr(settings, 'EXPORT_CACHE_TIMEOUT', 24 * 60 * 60)
+
+# Larger renders are not cached, and are spooled to disk rather than memory
+EXPORT_CACHE_MAX_BYTES = getattr(settings, 'EXPORT_CACHE_MAX_BYTES', 2 * 1024 * 1024)
+
+# Characters of HTML parsed per step, and bytes yielded per chunk
+CHUNK_SIZE = 64 * 1024
+
+# Bump when renderer output changes so stale cached renders are not served
+RENDER_VERSION = 1
+
+HEADINGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+BLOCK_TAGS = HEADINGS | {
+    'p', 'div', 'li', 'ul', 'ol', 'blockquote', 'pre', 'tr', 'table',
+    'section', 'article', 'header', 'footer', 'hr',
+}
+
+
+def export_filename(title, export_format):
+    return f"{slugify(title) or 'document'}.{FORMATS[export_format][1]}"
+
+
+def cached_export(content_hash, export_format, load_content):
+    """
+    Yields the export of some content, from the cache when possible.
+    `load_content` is only called on a cache miss, and may query the
+    database. The finished render is cached once it has been fully written.
+    """
+    key = f'export_{RENDER_VERSION}_{export_format}_{content_hash}'
+    cached = cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    parts, size = [], 0
+    for chunk in render(load_content(), export_format):
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > EXPORT_CACHE_MAX_BYTES:
+                parts = None
+        yield chunk
+    if parts is not None:
+        cache.set(key, b''.join(parts), EXPORT_CACHE_TIMEOUT)
+
+
+def spool(chunks):
+    """
+    Writes byte chunks to a temporary file, held in memory up to
+    EXPORT_CACHE_MAX_BYTES, and returns (file, size) with the file rewound.
+    """
+    file = tempfile.SpooledTemporaryFile(max_size=EXPORT_CACHE_MAX_BYTES)
+    try:
+        for chunk in chunks:
+            file.write(chunk)
+    except BaseException:
+        file.close()
+        raise
+    size = file.tell()
+    file.seek(0)
+    return file, size
+
+
+def render(content, export_format):
+    """
+    Yields the rendered content as byte chunks.
+    """
+    if export_format == 'docx':
+        yield from stream_zip(_docx_parts(content))
+        return
+    renderer = {'html': _render_html, 'txt': _render_text, 'md': _render_markdown}[export_format]
+    yield from _encoded(renderer(content))
+
+
+# Streaming ZIP archives
+
+class _ZipSink:
+    """
+    Write-only file object that hands written bytes back to the generator.
+    ZipFile detects that it cannot seek and writes data descriptors instead
+    of going back to patch local headers.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def stream_zip(entries):
+    """
+    Yields a ZIP archive of (name, chunks) entries as it is written. Only the
+    entry being written is buffered.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, chunks in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w') as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    data = sink.take()
+                    if data:
+                        yield data
+            data = sink.take()
+            if data:
+                yield data
+    # The central directory is written when the archive closes
+    yield sink.take()
+
+
+# Parsing
+
+class Paragraph:
+    __slots__ = ('kind', 'level', 'runs', 'quote', 'marker', 'depth')
+
+    def __init__(self, kind, level, runs, quote, marker, depth):
+        # kind is 'p', 'h' (level 1-6), 'li' (with marker and depth) or 'pre'
+        self.kind = kind
+        self.level = level
+        self.runs = runs
+        self.quote = quote
+        self.marker = marker
+        self.depth = depth
+
+
+class Run:
+    __slots__ = ('text', 'bold', 'italic', 'underline', 'code', 'href')
+
+    def __init__(self, text, bold=False, italic=False, underline=False, code=False, href=None):
+        self.text = text
+        self.bold = bold
+        self.italic = italic
+        self.underline = underline
+        self.code = code
+        self.href = href
+
+
+class _ParagraphParser(HTMLParser):
+    """
+    Splits editor HTML into paragraphs of styled text runs.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = []
+        self._runs = []
+        self._kind, self._level, self._marker = 'p', 0, ''
+        self._styles = {'bold': 0, 'italic': 0, 'underline': 0, 'code': 0}
+        self._href = None
+        self._lists = []
+        self._quote = 0
+        self._pre = 0
+        self._skip = 0
+
+    def take(self):
+        paragraphs, self.paragraphs = self.paragraphs, []
+        return paragraphs
+
+    def close(self):
+        super().close()
+        self._break()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skip += 1
+        elif tag == 'br':
+            self._add('\n')
+        elif tag in BLOCK_TAGS:
+            self._break()
+            if tag in ('ul', 'ol'):
+                self._lists.append([tag, 0])
+            elif tag == 'li':
+                self._kind = 'li'
+                if self._lists:
+                    self._lists[-1][1] += 1
+                    kind, number = self._lists[-1]
+                    self._marker = f'{number}. ' if kind == 'ol' else '- '
+                else:
+                    self._marker = '- '
+            elif tag in HEADINGS:
+                self._kind, self._level = 'h', int(tag[1])
+            elif tag == 'pre':
+                self._kind = 'pre'
+                self._pre += 1
+            elif tag == 'blockquote':
+                self._quote += 1
+        elif tag in ('b', 'strong'):
+            self._styles['bold'] += 1
+        elif tag in ('i', 'em'):
+            self._styles['italic'] += 1
+        elif tag == 'u':
+            self._styles['underline'] += 1
+        elif tag == 'code':
+            self._styles['code'] += 1
+        elif tag == 'a':
+            self._href = dict(attrs).get('href')
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style'):
+            self._skip = max(0, self._skip - 1)
+        elif tag in BLOCK_TAGS:
+            self._break()
+            if tag in ('ul', 'ol') and self._lists:
+                self._lists.pop()
+            elif tag == 'pre':
+                self._pre = max(0, self._pre - 1)
+            elif tag == 'blockquote':
+                self._quote = max(0, self._quote - 1)
+            self._kind, self._level, self._marker = 'p', 0, ''
+        elif tag in ('b', 'strong'):
+            self._styles['bold'] = max(0, self._styles['bold'] - 1)
+        elif tag in ('i', 'em'):
+            self._styles['italic'] = max(0, self._styles['italic'] - 1)
+        elif tag == 'u':
+            self._styles['underline'] = max(0, self._styles['underline'] - 1)
+        elif tag == 'code':
+            self._styles['code'] = max(0, self._styles['code'] - 1)
+        elif tag == 'a':
+            self._href = None
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if not self._pre:
+            data = re.sub(r'\s+', ' ', data)
+        if data:
+            self._add(data)
+
+    def _add(self, text):
+        styles = self._styles
+        self._runs.append(Run(
+            text, styles['bold'] > 0, styles['italic'] > 0, styles['underline'] > 0,
+            styles['code'] > 0 or self._pre > 0, self._href,
+        ))
+
+    def _break(self):
+        runs = self._runs
+        self._runs = []
+        if self._kind != 'pre':
+            # Collapse the whitespace around the paragraph
+            while runs and not runs[0].text.strip(' '):
+                runs.pop(0)
+            while runs and not runs[-1].text.strip(' '):
+                runs.pop()
+            if runs:
+                runs[0].text = runs[0].text.lstrip(' ')
+                runs[-1].text = runs[-1].text.rstrip(' ')
+        if any(run.text.strip() for run in runs):
+            depth = max(0, len(self._lists) - 1)
+            self.paragraphs.append(Paragraph(self._kind, self._level, runs, self._quote, self._marker, depth))
+
+
+def _paragraphs(content):
+    parser = _ParagraphParser()
+    for start in range(0, len(content), CHUNK_SIZE):
+        parser.feed(content[start:start + CHUNK_SIZE])
+        yield from parser.take()
+    parser.close()
+    yield from parser.take()
+
+
+def _encoded(pieces):
+    # Groups small strings into chunks of about CHUNK_SIZE bytes
+    buffer, size = [], 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+# Renderers
+
+def _render_html(content):
+    yield '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n</head>\n<body>\n'
+    for start in range(0, len(content), CHUNK_SIZE):
+        yield content[start:start + CHUNK_SIZE]
+    yield '\n</body>\n</html>\n'
+
+
+def _render_text(content):
+    previous = None
+    for paragraph in _paragraphs(content):
+        if previous is not None:
+            yield '\n' if previous.kind == paragraph.kind == 'li' else '\n\n'
+        text = ''.join(run.text for run in paragraph.runs)
+        if paragraph.kind == 'li':
+            text = '  ' * paragraph.depth + paragraph.marker + text
+        yield text
+        previous = paragraph
+    if previous is not None:
+        yield '\n'
+
+
+_MARKDOWN_SPECIAL = re.compile(r'([\\`*_\[\]#<>|])')
+
+
+def _markdown_inline(runs):
+    parts = []
+    for run in runs:
+        if run.code:
+            parts.append(f'`{run.text}`' if '\n' not in run.text else run.text)
+            continue
+        text = _MARKDOWN_SPECIAL.sub(r'\\\1', run.text).replace('\n', '  \n')
+        # Emphasis markers must touch the text, so surrounding spaces stay outside
+        stripped = text.strip(' ')
+        if not stripped:
+            parts.append(text)
+            continue
+        lead, trail = text[:len(text) - len(text.lstrip(' '))], text[len(text.rstrip(' ')):]
+        if run.bold:
+            stripped = f'**{stripped}**'
+        if run.italic:
+            stripped = f'*{stripped}*'
+        if run.href:
+            stripped = f'[{stripped}]({run.href})'
+        parts.append(lead + stripped + trail)
+    return ''.join(parts)
+
+
+def _render_markdown(content):
+    previous = None
+    for paragraph in _paragraphs(content):
+        if previous is not None:
+            yield '\n' if previous.kind == paragraph.kind == 'li' else '\n\n'
+        if paragraph.kind == 'pre':
+            text = '```\n' + ''.join(run.text for run in paragraph.runs).strip('\n') + '\n```'
+        else:
+            text = _markdown_inline(paragraph.runs)
+            if paragraph.kind == 'h':
+                text = '#' * paragraph.level + ' ' + text
+            elif paragraph.kind == 'li':
+                text = '  ' * paragraph.depth + paragraph.marker + text
+        if paragraph.quote:
+            prefix = '> ' * paragraph.quote
+            text = '\n'.join(prefix + line for line in text.split('\n'))
+        yield text
+        previous = paragraph
+    if previous is not None:
+        yield '\n'
+
+
+_DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+
+_DOCX_RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+# Font sizes of headings, in half points
+_DOCX_HEADING_SIZES = {1: 36, 2: 32, 3: 28, 4: 26, 5: 24, 6: 22}
+
+
+def _docx_parts(content):
+    yield '[Content_Types].xml', [_DOCX_CONTENT_TYPES.encode('utf-8')]
+    yield '_rels/.rels', [_DOCX_RELATIONSHIPS.encode('utf-8')]
+    yield 'word/document.xml', _encoded(_docx_document(content))
+
+
+def _docx_document(content):
+    yield (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+    )
+    for paragraph in _paragraphs(content):
+        yield _docx_paragraph(paragraph)
+    yield '<w:sectPr/></w:body></w:document>'
+
+
+def _docx_paragraph(paragraph):
+    properties = ''
+    indent = 720 * (paragraph.quote + (paragraph.depth + 1 if paragraph.kind == 'li' else 0))
+    if indent:
+        properties = f'<w:pPr><w:ind w:left="{indent}"/></w:pPr>'
+
+    runs = list(paragraph.runs)
+    if paragraph.kind == 'li':
+        runs.insert(0, Run('• ' if paragraph.marker == '- ' else paragraph.marker))
+
+    xml = []
+    for run in runs:
+        style = ''
+        if run.bold or paragraph.kind == 'h':
+            style += '<w:b/>'
+        if run.italic:
+            style += '<w:i/>'
+        if run.underline or run.href:
+            style += '<w:u w:val="single"/>'
+        if run.code:
+            style += '<w:rFonts w:ascii="Courier New" w:hAnsi="Courier New"/>'
+        if paragraph.kind == 'h':
+            style += f'<w:sz w:val="{_DOCX_HEADING_SIZES[paragraph.level]}"/>'
+        text = '<w:br/>'.join(
+            f'<w:t xml:space="preserve">{xml_escape(line)}</w:t>' for line in run.text.split('\n')
+        )
+        xml.append(f'<w:r>{f"<w:rPr>{style}</w:rPr>" if style else ""}{text}</w:r>')
+    return f'<w:p>{properties}{"".join(xml)}</w:p>'
@@ -0,0 +1,170 @@
+"""
+Wire encoding of WebSocket messages.
+
+Clients pick an encoding through the WebSocket subprotocol:
+
+- 'collab.json' (or no subprotocol): JSON text frames, as before.
+- 'collab.msgpack': binary frames holding one flag byte followed by a
+  MessagePack body, deflated (zlib) when FLAG_DEFLATE is set. Bodies of
+  COLLAB_FRAME_COMPRESS_BYTES or more are deflated.
+
+MessagePack is only offered when the optional `msgpack` package is installed.
+
+Messages broadcast to a whole group carry a `frame_id`, and each worker
+encodes such a message once per encoding. Every other recipient reuses
+the cached frame, so a multi-megabyte document is not serialized once per
+connected user.
+
+The snapshot a client starts from is its only copy of the document. Large
+snapshots are split at top-level element boundaries: the 'snapshot' message
+carries the first chunk and the number of chunks, and 'snapshot_chunk'
+messages carry the rest, so the editor shows the start of the document while
+the remainder is still arriving.
+"""
+import json
+import uuid
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .blocks import split_blocks
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# Subprotocol names accepted from clients, in order of preference
+SUBPROTOCOLS = OrderedDict([
+    ('collab.msgpack', MSGPACK),
+    ('collab.json', JSON),
+])
+
+# Encoded binary bodies at least this large are deflated
+COMPRESS_BYTES = getattr(settings, 'COLLAB_FRAME_COMPRESS_BYTES', 16 * 1024)
+
+# Largest decompressed body accepted from a client (a 5 MB document plus encoding overhead)
+MAX_FRAME_BYTES = getattr(settings, 'COLLAB_MAX_FRAME_BYTES', 8 * 1024 * 1024)
+
+# Snapshots longer than this many characters are sent in chunks of about this size
+SNAPSHOT_CHUNK_CHARS = getattr(settings, 'COLLAB_SNAPSHOT_CHUNK_CHARS', 128 * 1024)
+
+# Encoded group messages kept for reuse by the remaining recipients
+FRAME_CACHE_SIZE = 32
+
+FLAG_DEFLATE = 0x01
+
+_frames = OrderedDict()
+
+
+def negotiate(scope):
+    """
+    Returns (encoding, subprotocol) for a connection from the subprotocols
+    the client offered. `subprotocol` is None when the client offered none
+    we understand, in which case JSON is used.
+    """
+    offered = scope.get('subprotocols') or []
+    for subprotocol, encoding in SUBPROTOCOLS.items():
+        if subprotocol in offered and (encoding != MSGPACK or msgpack is not None):
+            return encoding, subprotocol
+    return JSON, None
+
+
+def new_frame_id():
+    """
+    Returns an id for a message that will be broadcast to a group.
+    """
+    return uuid.uuid4().hex
+
+
+def encode(message, encoding, frame_id=None):
+    """
+    Encodes a message as keyword arguments for `send()`: `text_data` for
+    JSON, `bytes_data` for MessagePack. With a `frame_id`, the result is
+    cached so other recipients of the same group message skip the work.
+    """
+    if frame_id is None:
+        return _encode(message, encoding)
+
+    key = (frame_id, encoding)
+    frame = _frames.get(key)
+    if frame is None:
+        frame = _frames[key] = _encode(message, encoding)
+        if len(_frames) > FRAME_CACHE_SIZE:
+            _frames.popitem(last=False)
+    return frame
+
+
+def snapshot_messages(content, revision, session_id=None, committed=None):
+    """
+    Returns the messages that deliver a snapshot of `content` at `revision`:
+    one 'snapshot' message, followed by 'snapshot_chunk' messages when the
+    content is large. `session_id` lets the client resume from the snapshot
+    after a reconnect, and `committed` is the number of the client's last
+    operation batch in the content.
+    """
+    chunks = _chunk(content, SNAPSHOT_CHUNK_CHARS)
+    messages = [{
+        'action': 'snapshot',
+        'content': chunks[0],
+        'revision': revision,
+        'chunks': len(chunks),
+        'session': session_id,
+        'committed': committed,
+    }]
+    for index, chunk in enumerate(chunks[1:], 1):
+        messages.append({'action': 'snapshot_chunk', 'content': chunk, 'revision': revision, 'index': index})
+    return messages
+
+
+def _chunk(content, size):
+    if len(content) <= size:
+        return [content]
+    chunks = []
+    current = []
+    length = 0
+    for block in split_blocks(content):
+        if current and length + len(block) > size:
+            chunks.append(''.join(current))
+            current, length = [], 0
+        current.append(block)
+        length += len(block)
+    chunks.append(''.join(current))
+    return chunks
+
+
+def decode(text_data=None, bytes_data=None):
+    """
+    Decodes a frame received from a client.
+    - Deflated bodies are inflated to at most MAX_FRAME_BYTES; larger ones
+      are rejected before they are fully expanded.
+    """
+    if text_data is not None:
+        return json.loads(text_data)
+    if msgpack is None:
+        raise ValueError('Binary frames are not supported')
+    if not bytes_data:
+        raise ValueError('Empty frame')
+    body = bytes_data[1:]
+    if bytes_data[0] & FLAG_DEFLATE:
+        inflater = zlib.decompressobj()
+        body = inflater.decompress(body, MAX_FRAME_BYTES)
+        if inflater.unconsumed_tail:
+            raise ValueError('Frame too large')
+    return msgpack.unpackb(body, raw=False)
+
+
+def _encode(message, encoding):
+    if encoding != MSGPACK:
+        return {'text_data': json.dumps(message)}
+
+    body = msgpack.packb(message, use_bin_type=True)
+    flags = 0
+    if len(body) >= COMPRESS_BYTES:
+        body = zlib.compress(body, 6)
+        flags |= FLAG_DEFLATE
+    return {'bytes_data': bytes([flags]) + body}
@@ -0,0 +1,461 @@
+"""
+Append-only journal of the operations committed in live sessions.
+
+A DocumentSession writes its content to the database every
+COLLAB_FLUSH_INTERVAL seconds, so a worker that dies loses whatever was typed
+since its last flush. With COLLAB_JOURNAL_DIR set, every committed operation
+is also appended to the document's journal file. A single JournalWriter
+thread writes the records and fsyncs each file once per
+COLLAB_JOURNAL_SYNC_INTERVAL, however many operations arrived in between, so
+committing an edit never waits for the disk.
+
+A journal file holds one JSON record per line:
+
+- {"rev": R, "hash": H}: a checkpoint; the content at revision R hashes to H;
+- {"rev": R, "ops": [...], "user": U, "batch": [C, N]}: the operations that
+  made revision R, and the client C whose batch number N they were (no
+  "batch" for edits that did not come from an editor's operation batch).
+
+A session starts its file with a checkpoint of the content it loaded. Before
+each flush it appends a checkpoint of the content it is about to store and
+waits for it to reach the disk. Once the flush is done the file is rewritten
+to start at that checkpoint, so it only ever holds the edits of the last few
+seconds. After the final flush, when the last client leaves, the file is
+deleted.
+
+A file left behind by a crash is replayed when the next session for its
+document starts, before the document is saved or reverted over HTTP, or by
+`manage.py recover_journals`. Replay starts at the last
+checkpoint whose hash matches the stored content and applies the operations
+after it. If no checkpoint matches, the document was saved some other way
+after the journal was written, and the file is discarded.
+
+Each document's journal must be written by one process only. With several
+workers, set COLLAB_WORKERS so each document is served by one of them.
+"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import Future
+from itertools import accumulate
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import ot
+from .models import hash_content
+from .persistence import write_document_content_async
+
+logger = logging.getLogger(__name__)
+
+# Directory of the journal files; None disables the journal
+JOURNAL_DIR = getattr(settings, 'COLLAB_JOURNAL_DIR', None)
+
+# Seconds the writer collects records before writing and syncing them
+SYNC_INTERVAL = getattr(settings, 'COLLAB_JOURNAL_SYNC_INTERVAL', 0.05)
+
+# Characters per chunk of the replay buffer
+REPLAY_CHUNK_CHARS = 16384
+
+
+class JournalCommand:
+    __slots__ = ('kind', 'document_id', 'payload', 'future')
+
+    def __init__(self, kind, document_id, payload):
+        self.kind = kind
+        self.document_id = int(document_id)
+        self.payload = payload
+        self.future = Future()
+
+
+class JournalWriter:
+    """
+    Single thread that owns the journal files and syncs them in batches.
+    """
+
+    def __init__(self, directory, interval=SYNC_INTERVAL):
+        self.directory = Path(directory) if directory is not None else None
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Open append handles and, per document, the (revision, line) operation
+        # records written since its file was last rewritten
+        self._files = {}
+        self._records = {}
+
+    def path(self, document_id):
+        return self.directory / f'{document_id}.journal'
+
+    def submit(self, kind, document_id, payload=None):
+        """
+        Queues a command and returns a Future resolved once its records are
+        on disk (or, for 'read', with the lines of the file).
+        """
+        self._ensure_started()
+        command = JournalCommand(kind, document_id, payload)
+        self._queue.put(command)
+        return command.future
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self.directory.mkdir(parents=True, exist_ok=True)
+                if self._thread is None:
+                    atexit.register(self.drain)
+                self._thread = threading.Thread(target=self._run, name='journal-writer', daemon=True)
+                self._thread.start()
+
+    def drain(self, timeout=5):
+        """
+        Waits until every queued command has been carried out. Runs at exit
+        so a clean shutdown does not leave compacted or finished journals behind.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self.submit('wait', 0).result(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        results = []
+        dirty = set()
+        for command in batch:
+            try:
+                result = getattr(self, f'_{command.kind}')(command.document_id, command.payload)
+                if command.kind == 'append':
+                    dirty.add(command.document_id)
+                results.append((command, result, None))
+            except Exception as e:
+                logger.error(f"Journal {command.kind} for document {command.document_id} failed: {e}")
+                results.append((command, None, e))
+
+        # One sync per file for the whole batch
+        failed = {}
+        for document_id in dirty:
+            handle = self._files.get(document_id)
+            if handle is None:
+                continue
+            try:
+                handle.flush()
+                os.fsync(handle.fileno())
+            except OSError as e:
+                logger.error(f"Journal sync for document {document_id} failed: {e}")
+                failed[document_id] = e
+
+        for command, result, error in results:
+            error = error or failed.get(command.document_id)
+            if error is not None:
+                command.future.set_exception(error)
+            else:
+                command.future.set_result(result)
+
+    def _open(self, document_id):
+        handle = self._files.get(document_id)
+        if handle is None:
+            handle = self._files[document_id] = open(self.path(document_id), 'a', encoding='utf-8')
+        return handle
+
+    def _close(self, document_id):
+        handle = self._files.pop(document_id, None)
+        if handle is not None:
+            handle.close()
+
+    def _append(self, document_id, payload):
+        revision, line = payload
+        self._open(document_id).write(line)
+        if revision is not None:
+            self._records.setdefault(document_id, []).append((revision, line))
+
+    def _start(self, document_id, line):
+        self._rewrite(document_id, line, [])
+
+    def _compact(self, document_id, payload):
+        # Operations up to the checkpoint are stored in the database now
+        revision, line = payload
+        kept = [(rev, record) for rev, record in self._records.get(document_id, []) if rev > revision]
+        self._rewrite(document_id, line, kept)
+
+    def _rewrite(self, document_id, line, records):
+        self._close(document_id)
+        path = self.path(document_id)
+        temporary = path.with_suffix('.tmp')
+        with open(temporary, 'w', encoding='utf-8') as f:
+            f.write(line)
+            f.writelines(record for _, record in records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        self._sync_directory()
+        self._records[document_id] = records
+
+    def _remove(self, document_id, payload=None):
+        self._close(document_id)
+        self._records.pop(document_id, None)
+        try:
+            os.unlink(self.path(document_id))
+        except FileNotFoundError:
+            pass
+
+    def _wait(self, document_id, payload=None):
+        pass
+
+    def _read(self, document_id, payload=None):
+        handle = self._files.get(document_id)
+        if handle is not None:
+            handle.flush()
+        try:
+            with open(self.path(document_id), encoding='utf-8') as f:
+                return f.readlines()
+        except FileNotFoundError:
+            return []
+
+    def _sync_directory(self):
+        descriptor = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+
+# Process-wide writer; only started when the journal is enabled
+writer = JournalWriter(JOURNAL_DIR)
+
+
+def enabled():
+    return JOURNAL_DIR is not None
+
+
+def exists(document_id):
+    """
+    Returns True if the document has a journal file, e.g. one left behind by a crash.
+    """
+    return enabled() and writer.path(document_id).exists()
+
+
+def _line(record):
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def record(document_id, revision, ops, editor_id=None, batch=None):
+    """
+    Journals the operations that made `revision`, and the (client id, batch
+    number) they were sent as. Does not wait for the disk.
+    """
+    if enabled():
+        entry = {'rev': revision, 'ops': ops, 'user': editor_id}
+        if batch is not None:
+            entry['batch'] = list(batch)
+        writer.submit('append', document_id, (revision, _line(entry)))
+
+
+def start(document_id, content_hash):
+    """
+    Starts a new journal for a session whose content (at revision 0) hashes to `content_hash`.
+    """
+    if enabled():
+        writer.submit('start', document_id, _line({'rev': 0, 'hash': content_hash}))
+
+
+async def checkpoint(document_id, revision, content_hash):
+    """
+    Journals that the content at `revision` is about to be stored, and waits
+    until the record is on disk.
+    """
+    if enabled():
+        await asyncio.wrap_future(writer.submit('append', document_id, (None, _line({'rev': revision, 'hash': content_hash}))))
+
+
+def compact(document_id, revision, content_hash):
+    """
+    Drops the records up to `revision`, whose content is now in the database.
+    """
+    if enabled():
+        writer.submit('compact', document_id, (revision, _line({'rev': revision, 'hash': content_hash})))
+
+
+def discard(document_id):
+    """
+    Deletes a document's journal once everything in it has been stored.
+    """
+    if enabled():
+        writer.submit('remove', document_id)
+
+
+async def recover(document_id, content):
+    """
+    Replays a journal left behind by a crashed session on top of the stored
+    `content` and stores the result.
+    - Returns the content to start from and the last batch number the
+      replayed operations committed for each client.
+    """
+    if not enabled():
+        return content, {}
+    lines = await asyncio.wrap_future(writer.submit('read', document_id))
+    if not lines:
+        return content, {}
+    replayed = await sync_to_async(replay, thread_sensitive=False)(lines, content)
+    if replayed is None:
+        return content, {}
+
+    recovered, editor_id, count, batches = replayed
+    await write_document_content_async(document_id, recovered, editor_id)
+    logger.info(f"Recovered {count} journaled operations of document {document_id}")
+    return recovered, batches
+
+
+def replay(lines, content):
+    """
+    Applies the journaled operations that follow the last checkpoint matching
+    `content`. Returns (content, last editor id, operations applied, last
+    batch number per client), or None when there is nothing to apply.
+    """
+    records = _parse(lines)
+    content_hash = hash_content(content)
+    start = None
+    for index, entry in enumerate(records):
+        if entry.get('hash') == content_hash:
+            start = index
+    if start is None:
+        return None
+
+    revision = records[start]['rev']
+    buffer = _TextBuffer(content)
+    editor_id = None
+    count = 0
+    batches = {}
+    for entry in records[start + 1:]:
+        if 'ops' not in entry:
+            continue
+        if entry['rev'] != revision + 1:
+            logger.warning(f"Journal replay stopped at revision {revision}: next record is {entry['rev']}")
+            break
+        try:
+            buffer.apply(entry['ops'])
+        except (ot.OperationError, KeyError, TypeError) as e:
+            logger.warning(f"Journal replay stopped at revision {revision}: {e}")
+            break
+        revision += 1
+        editor_id = entry.get('user') or editor_id
+        if entry.get('batch'):
+            client_id, batch = entry['batch']
+            batches[client_id] = batch
+        count += 1
+    if not count:
+        return None
+    return buffer.text(), editor_id, count, batches
+
+
+def _parse(lines):
+    # One decoder call for the whole file is much faster than one per line
+    try:
+        return json.loads('[' + ','.join(lines) + ']')
+    except ValueError:
+        pass
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # The last write was cut short by the crash
+            break
+    return records
+
+
+class _TextBuffer:
+    """
+    Text held as a list of chunks, so an operation copies one chunk instead
+    of the whole document. Replayed edits are mostly close to each other:
+    positions in the current or next chunk are found directly, others by
+    bisecting chunk offsets that are recomputed after the text changes.
+    """
+
+    def __init__(self, text, chunk_size=REPLAY_CHUNK_CHARS):
+        self.chunk_size = chunk_size
+        self.chunks = self._split(text) or ['']
+        self.length = len(text)
+        self.index = 0
+        self.start = 0
+        # Offset of every chunk, or None once an edit has moved them
+        self._starts = None
+
+    def _split(self, text):
+        return [text[offset:offset + self.chunk_size] for offset in range(0, len(text), self.chunk_size)]
+
+    def _seek(self, pos):
+        # Moves to the chunk holding `pos` (the last chunk for the end of the text)
+        chunks = self.chunks
+        last = len(chunks) - 1
+        end = self.start + len(chunks[self.index])
+        if self.start <= pos and (pos < end or self.index == last):
+            return
+        if pos >= end and self.index < last and pos < end + len(chunks[self.index + 1]):
+            self.index += 1
+            self.start = end
+            return
+        if self._starts is None:
+            self._starts = list(accumulate(map(len, chunks), initial=0))
+        self.index = min(bisect_right(self._starts, pos) - 1, last)
+        self.start = self._starts[self.index]
+
+    def apply(self, ops):
+        for op in ops:
+            if op['type'] == 'insert':
+                self.insert(op['pos'], op['text'])
+            else:
+                self.delete(op['pos'], op['length'])
+
+    def insert(self, pos, text):
+        if pos > self.length:
+            raise ot.OperationError("Insert position is past the end of the document.")
+        self._seek(pos)
+        chunk = self.chunks[self.index]
+        offset = pos - self.start
+        chunk = chunk[:offset] + text + chunk[offset:]
+        if len(chunk) > 2 * self.chunk_size:
+            self.chunks[self.index:self.index + 1] = self._split(chunk)
+        else:
+            self.chunks[self.index] = chunk
+        self.length += len(text)
+        self._starts = None
+
+    def delete(self, pos, length):
+        if pos + length > self.length:
+            raise ot.OperationError("Delete range is past the end of the document.")
+        self.length -= length
+        while length:
+            self._seek(pos)
+            self._starts = None
+            chunk = self.chunks[self.index]
+            offset = pos - self.start
+            taken = min(length, len(chunk) - offset)
+            chunk = chunk[:offset] + chunk[offset + taken:]
+            length -= taken
+            if chunk or len(self.chunks) == 1:
+                self.chunks[self.index] = chunk
+                continue
+            del self.chunks[self.index]
+            if self.index == len(self.chunks):
+                self.index -= 1
+                self.start -= len(self.chunks[self.index])
+
+    def text(self):
+        return ''.join(self.chunks)
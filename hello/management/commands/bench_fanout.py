@@ -0,0 +1,329 @@
+import asyncio
+import json
+import random
+import resource
+import statistics
+import time
+import uuid
+from contextlib import contextmanager
+
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from hello import framing, presence, ratelimit
+from hello.models import Document
+from hello.routing import websocket_urlpatterns
+
+# Metrics compared against a baseline: name -> (path in the report, True if higher is better)
+COMPARED_METRICS = {
+    'latency p95': (('latency_ms', 'p95'), False),
+    'messages received/s': (('messages_per_sec', 'received'), True),
+    'cpu percent': (('cpu', 'percent'), False),
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+class Stats:
+    """
+    Counters shared by all simulated editors of a run.
+    """
+
+    def __init__(self):
+        self.sent_at = {}
+        self.latencies = []
+        self.edits_sent = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.resyncs = 0
+        self.rate_limited = 0
+
+
+class SimulatedEditor:
+    """
+    One client typing into a document at a fixed rate. Like editor.js it
+    keeps at most one batch of operations in flight and buffers keystrokes
+    until that batch is acknowledged.
+    """
+
+    def __init__(self, communicator, name, encoding, stats):
+        self.communicator = communicator
+        self.name = name
+        self.encoding = encoding
+        self.stats = stats
+        self.revision = None
+        self.outstanding = None
+        self.buffer = []
+        self.sequence = 0
+
+    async def type(self, rate, until):
+        # Start at a random point of the first interval so editors do not type in lockstep
+        await asyncio.sleep(random.random() / rate)
+        while time.monotonic() < until:
+            self.sequence += 1
+            token = f'{self.name}.{self.sequence};'
+            self.stats.sent_at[token] = time.monotonic()
+            self.buffer.append({'type': 'insert', 'pos': 0, 'text': token})
+            self.stats.edits_sent += 1
+            if self.outstanding is None and self.revision is not None:
+                await self.send_buffer()
+            await asyncio.sleep(1 / rate)
+
+    async def send_buffer(self):
+        self.outstanding, self.buffer = self.buffer, []
+        await self.send({'action': 'operation', 'revision': self.revision, 'ops': self.outstanding})
+
+    async def send(self, message):
+        frame = framing.encode(message, self.encoding)
+        if 'text_data' in frame:
+            await self.communicator.send_to(text_data=frame['text_data'])
+            self.stats.bytes_sent += len(frame['text_data'].encode('utf-8'))
+        else:
+            await self.communicator.send_to(bytes_data=frame['bytes_data'])
+            self.stats.bytes_sent += len(frame['bytes_data'])
+        self.stats.frames_sent += 1
+
+    async def read(self):
+        # Reads the output queue directly: receive_output() would cancel the
+        # consumer on a timeout, and this loop is cancelled at the end of the run
+        while True:
+            output = await self.communicator.output_queue.get()
+            if output['type'] != 'websocket.send':
+                continue
+            text, data = output.get('text'), output.get('bytes')
+            self.stats.frames_received += 1
+            self.stats.bytes_received += len(text.encode('utf-8')) if text is not None else len(data)
+            await self.handle(framing.decode(text, data))
+
+    async def handle(self, message):
+        action = message.get('action')
+        if action == 'snapshot':
+            if self.revision is not None:
+                self.stats.resyncs += 1
+            self.revision = message['revision']
+            self.outstanding = None
+            if self.buffer:
+                await self.send_buffer()
+        elif action == 'ack':
+            self.revision = message['revision']
+            self.outstanding = None
+            if self.buffer:
+                await self.send_buffer()
+        elif action == 'operation':
+            self.revision = message['revision']
+            now = time.monotonic()
+            for op in message['ops']:
+                if op.get('type') != 'insert':
+                    continue
+                for token in op['text'].split(';')[:-1]:
+                    sent_at = self.stats.sent_at.get(f'{token};')
+                    if sent_at is not None:
+                        self.stats.latencies.append(now - sent_at)
+        elif action == 'rate_limited':
+            self.stats.rate_limited += 1
+            asyncio.ensure_future(self.resend_after(message['retry_after']))
+
+    async def resend_after(self, delay):
+        await asyncio.sleep(delay)
+        if self.outstanding is not None:
+            await self.send({'action': 'operation', 'revision': self.revision, 'ops': self.outstanding})
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulates editors typing into documents over WebSockets and reports edit "
+        "propagation latency, message and byte rates, and CPU use as JSON on stdout; "
+        "the comparison with --baseline goes to stderr. Creates "
+        "temporary users and documents in the configured database and deletes them "
+        "afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=10,
+                            help="Documents edited at the same time.")
+        parser.add_argument('--editors', type=int, default=5,
+                            help="Editors connected to each document.")
+        parser.add_argument('--rate', type=float, default=5.0,
+                            help="Keystrokes per second per editor.")
+        parser.add_argument('--duration', type=float, default=10.0,
+                            help="Seconds of typing.")
+        parser.add_argument('--layer', default='memory',
+                            help="'memory' for an in-process channel layer with in-memory presence and "
+                                 "rate limits, or a CHANNEL_LAYERS alias (e.g. 'default' for Redis).")
+        parser.add_argument('--encoding', choices=[framing.JSON, framing.MSGPACK], default=framing.JSON,
+                            help="WebSocket encoding the simulated clients negotiate.")
+        parser.add_argument('--output',
+                            help="Also write the JSON report to this file.")
+        parser.add_argument('--baseline',
+                            help="JSON report of an earlier run to compare against.")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="Relative regression against the baseline that fails the command.")
+
+    def handle(self, *args, **options):
+        if options['encoding'] == framing.MSGPACK and framing.msgpack is None:
+            raise CommandError("The msgpack package is not installed.")
+
+        prefix = f'bench-{uuid.uuid4().hex[:8]}'
+        owner = User.objects.create_user(prefix)
+        try:
+            User.objects.bulk_create([
+                User(username=f'{prefix}-{index}') for index in range(options['documents'] * options['editors'])
+            ])
+            # One user per connection, so per-user message limits apply as in real use
+            editors = list(User.objects.filter(username__startswith=f'{prefix}-').order_by('id'))
+            documents = []
+            for index in range(options['documents']):
+                document = Document.objects.create(title=f'Benchmark {index}', content='<p>benchmark</p>', owner=owner)
+                document.shared_with.set(editors[index * options['editors']:(index + 1) * options['editors']])
+                documents.append(document)
+
+            with self.channel_layer(options['layer']):
+                stats, elapsed, cpu = asyncio.run(self.run(documents, editors, options))
+        finally:
+            User.objects.filter(username__startswith=prefix).delete()
+
+        report = self.report(stats, elapsed, cpu, options)
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        if options['baseline']:
+            self.compare(report, options['baseline'], options['tolerance'])
+
+    @contextmanager
+    def channel_layer(self, layer):
+        if layer != 'memory':
+            if layer != DEFAULT_CHANNEL_LAYER:
+                old = channel_layers.set(DEFAULT_CHANNEL_LAYER, channel_layers[layer])
+            try:
+                yield
+            finally:
+                if layer != DEFAULT_CHANNEL_LAYER:
+                    channel_layers.set(DEFAULT_CHANNEL_LAYER, old)
+            return
+
+        # Everything in this process: no Redis needed for the layer, presence or rate limits
+        old = channel_layers.set(DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer(capacity=1000))
+        saved = presence._backend, presence._broadcaster, ratelimit._backend
+        presence._backend = presence.InMemoryPresenceBackend()
+        presence._broadcaster = None
+        ratelimit._backend = ratelimit.InMemoryRateLimitBackend()
+        try:
+            yield
+        finally:
+            channel_layers.set(DEFAULT_CHANNEL_LAYER, old)
+            presence._backend, presence._broadcaster, ratelimit._backend = saved
+
+    async def run(self, documents, users, options):
+        application = URLRouter(websocket_urlpatterns)
+        subprotocol = 'collab.msgpack' if options['encoding'] == framing.MSGPACK else 'collab.json'
+        stats = Stats()
+
+        editors = []
+        for document_index, document in enumerate(documents):
+            for index in range(options['editors']):
+                user = users[document_index * options['editors'] + index]
+                communicator = WebsocketCommunicator(
+                    application, f'/ws/documents/{document.id}/', subprotocols=[subprotocol]
+                )
+                communicator.scope['user'] = user
+                connected, _ = await communicator.connect(timeout=10)
+                if not connected:
+                    raise CommandError(f"Connection to document {document.id} was refused.")
+                editors.append(SimulatedEditor(communicator, f'{document_index}-{index}', options['encoding'], stats))
+
+        readers = [asyncio.ensure_future(editor.read()) for editor in editors]
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        began = time.monotonic()
+        until = began + options['duration']
+        await asyncio.gather(*(editor.type(options['rate'], until) for editor in editors))
+        # Let edits still in flight arrive
+        await asyncio.sleep(1)
+        elapsed = time.monotonic() - began
+        after = resource.getrusage(resource.RUSAGE_SELF)
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        for editor in editors:
+            await editor.communicator.disconnect()
+        cpu = (after.ru_utime - usage.ru_utime, after.ru_stime - usage.ru_stime)
+        return stats, elapsed, cpu
+
+    def report(self, stats, elapsed, cpu, options):
+        latencies = sorted(latency * 1000 for latency in stats.latencies)
+        expected = stats.edits_sent * (options['editors'] - 1)
+
+        def ms(value):
+            return round(value, 3) if value is not None else None
+
+        return {
+            'config': {
+                key: options[key] for key in ('documents', 'editors', 'rate', 'duration', 'layer', 'encoding')
+            },
+            'connections': options['documents'] * options['editors'],
+            'elapsed_s': round(elapsed, 3),
+            'edits': {
+                'sent': stats.edits_sent,
+                'deliveries_expected': expected,
+                'deliveries': len(latencies),
+                'resyncs': stats.resyncs,
+                'rate_limited': stats.rate_limited,
+            },
+            'latency_ms': {
+                'p50': ms(percentile(latencies, 0.5)),
+                'p90': ms(percentile(latencies, 0.9)),
+                'p95': ms(percentile(latencies, 0.95)),
+                'p99': ms(percentile(latencies, 0.99)),
+                'max': ms(latencies[-1] if latencies else None),
+                'mean': ms(statistics.mean(latencies) if latencies else None),
+            },
+            'messages_per_sec': {
+                'sent': round(stats.frames_sent / elapsed, 1),
+                'received': round(stats.frames_received / elapsed, 1),
+            },
+            'bytes_per_sec': {
+                'sent': round(stats.bytes_sent / elapsed, 1),
+                'received': round(stats.bytes_received / elapsed, 1),
+            },
+            # The simulated clients run in the same process, so this includes their share
+            'cpu': {
+                'user_s': round(cpu[0], 3),
+                'system_s': round(cpu[1], 3),
+                'percent': round((cpu[0] + cpu[1]) / elapsed * 100, 1),
+            },
+        }
+
+    def compare(self, report, path, tolerance):
+        with open(path) as f:
+            baseline = json.load(f)
+
+        if baseline.get('config') != report['config']:
+            self.stderr.write(self.style.WARNING(f"{path} was run with different options: {baseline.get('config')}"))
+
+        regressions = []
+        for name, (keys, higher_is_better) in COMPARED_METRICS.items():
+            current, previous = report, baseline
+            for key in keys:
+                current, previous = current.get(key), (previous or {}).get(key)
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            # stdout holds only the JSON report
+            self.stderr.write(f"{name}: {previous} -> {current} ({change:+.1%}){' REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(name)
+        if regressions:
+            raise CommandError(f"Regressed against {path}: {', '.join(regressions)}")
@@ -0,0 +1,251 @@
+import json
+import logging
+import statistics
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from hello import ratelimit
+from hello.models import VERSION_KEYFRAME_INTERVAL, Document, DocumentVersion, hash_content
+
+# Per-request budgets: scenario -> {'queries': most queries, 'p95_ms': slowest 95th percentile}
+# Query counts must not grow with the seeded data; latencies leave room for slower machines
+DEFAULT_BUDGETS = {
+    'get_document': {'queries': 4, 'p95_ms': 150},
+    'get_document_not_modified': {'queries': 4, 'p95_ms': 50},
+    'save_document': {'queries': 14, 'p95_ms': 750},
+    'document_list': {'queries': 5, 'p95_ms': 300},
+    'document_list_api': {'queries': 5, 'p95_ms': 400},
+    'version_history': {'queries': 5, 'p95_ms': 150},
+    'version_history_api': {'queries': 4, 'p95_ms': 150},
+    'revert_version': {'queries': 18, 'p95_ms': 250},
+}
+
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+class QueryCounter(logging.Handler):
+    """
+    Counts the queries logged by every database connection, including the
+    ones made by the document writer thread on behalf of a request.
+    """
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a large data set (a multi-megabyte document, a document with many "
+        "versions, heavily shared documents), then measures latency percentiles and "
+        "query counts of the document views. Fails if a scenario exceeds its budget. "
+        "Writes to the configured database; everything it creates is deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--document-mb', type=float, default=3.0,
+                            help="Size of the large document in megabytes.")
+        parser.add_argument('--versions', type=int, default=10000,
+                            help="Versions of the document whose history is listed.")
+        parser.add_argument('--documents', type=int, default=200,
+                            help="Documents owned by the benchmark user.")
+        parser.add_argument('--shares', type=int, default=500,
+                            help="Users every tenth document is shared with.")
+        parser.add_argument('--iterations', type=int, default=30,
+                            help="Requests per scenario.")
+        parser.add_argument('--budgets',
+                            help="JSON file of budgets overriding the defaults, in the same shape as DEFAULT_BUDGETS.")
+        parser.add_argument('--output',
+                            help="Also write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        budgets = {name: dict(budget) for name, budget in DEFAULT_BUDGETS.items()}
+        if options['budgets']:
+            with open(options['budgets']) as f:
+                for name, budget in json.load(f).items():
+                    budgets.setdefault(name, {}).update(budget)
+
+        prefix = f'bench-{uuid.uuid4().hex[:8]}'
+        try:
+            self.stdout.write("Seeding...")
+            seeded = self.seed(prefix, options)
+            with self.benchmark_settings():
+                results = self.run(seeded, options['iterations'])
+        finally:
+            User.objects.filter(username__startswith=prefix).delete()
+
+        failures = self.report(results, budgets)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'results': results, 'budgets': budgets}, f, indent=2)
+                f.write('\n')
+        if failures:
+            raise CommandError(f"Over budget: {', '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS("All scenarios within budget."))
+
+    def seed(self, prefix, options):
+        owner = User.objects.create_user(prefix)
+        User.objects.bulk_create([User(username=f'{prefix}-{index}') for index in range(options['shares'])])
+        sharer_ids = list(User.objects.filter(username__startswith=f'{prefix}-').values_list('id', flat=True))
+
+        Document.objects.bulk_create([
+            Document(title=f'Benchmark {index}', content=f'<p>Document {index}</p>',
+                     content_hash=hash_content(f'<p>Document {index}</p>'), owner=owner)
+            for index in range(options['documents'])
+        ])
+        document_ids = list(Document.objects.filter(owner=owner).order_by('id').values_list('id', flat=True))
+        through = Document.shared_with.through
+        through.objects.bulk_create([
+            through(document_id=document_id, user_id=user_id)
+            for document_id in document_ids[::10]
+            for user_id in sharer_ids
+        ], batch_size=5000)
+
+        paragraph = '<p>' + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 8 + '</p>'
+        large_content = paragraph * int(options['document_mb'] * 1024 * 1024 / len(paragraph))
+        large = Document.objects.create(title='Benchmark large', content=large_content, owner=owner)
+        through.objects.bulk_create([through(document_id=large.id, user_id=user_id) for user_id in sharer_ids])
+        DocumentVersion.objects.create_version(large.id, large_content, owner.id)
+
+        # Versions are bulk-created the way create_version stores them: keyframes and deltas
+        versioned = Document.objects.create(title='Benchmark history', content='', owner=owner)
+        base = paragraph * 40
+        versions = []
+        for index in range(options['versions']):
+            content = f'{base}<p>Revision {index}</p>'
+            if index % VERSION_KEYFRAME_INTERVAL == 0:
+                versions.append(DocumentVersion(
+                    document_id=versioned.id, content=content, content_hash=hash_content(content), editor=owner,
+                ))
+            else:
+                # Only the revision number differs from the previous version
+                delta = json.dumps([len(base) + len('<p>Revision '), len('</p>'), str(index)], separators=(',', ':'))
+                versions.append(DocumentVersion(
+                    document_id=versioned.id, content='', delta=delta, is_keyframe=False,
+                    content_hash=hash_content(content), editor=owner,
+                ))
+        DocumentVersion.objects.bulk_create(versions, batch_size=1000)
+        Document.objects.filter(id=versioned.id).update(content=content, content_hash=hash_content(content))
+
+        version_ids = list(DocumentVersion.objects.filter(document_id=versioned.id).order_by('id').values_list('id', flat=True))
+        return {
+            'owner': owner,
+            'large': large,
+            'versioned': versioned,
+            'version_ids': version_ids,
+        }
+
+    @contextmanager
+    def benchmark_settings(self):
+        # No rate limits, queries logged from every thread, and the test client's host allowed
+        limits = {name: (10 ** 9, 1) for name in ratelimit.DEFAULT_LIMITS}
+        saved_limiter = ratelimit._backend
+        ratelimit._backend = ratelimit.InMemoryRateLimitBackend()
+        with override_settings(DEBUG=True, RATE_LIMITS=limits, ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+            try:
+                yield
+            finally:
+                ratelimit._backend = saved_limiter
+
+    def scenarios(self, seeded):
+        large, versioned = seeded['large'], seeded['versioned']
+        version_ids = seeded['version_ids']
+        get_url = reverse('get_document', kwargs={'doc_id': large.id})
+        history_api_url = reverse('version_history_api', kwargs={'doc_id': versioned.id})
+        etag = {}
+        edits = iter(range(10 ** 9))
+
+        def get_document(client):
+            response = client.get(get_url, HTTP_ACCEPT_ENCODING='gzip')
+            etag['value'] = response['ETag']
+            return response
+
+        def save_document(client):
+            content = f'{large.content}<p>Edit {next(edits)}</p>'
+            return client.post(reverse('save_document', kwargs={'doc_id': large.id}),
+                               json.dumps({'content': content}), content_type='application/json')
+
+        def revert_version(client):
+            version_id = version_ids[next(edits) % len(version_ids)]
+            return client.post(reverse('revert_version', kwargs={'doc_id': versioned.id, 'version_id': version_id}))
+
+        return [
+            ('get_document', get_document, 200),
+            ('get_document_not_modified', lambda client: client.get(get_url, HTTP_IF_NONE_MATCH=etag['value']), 304),
+            ('save_document', save_document, 200),
+            ('document_list', lambda client: client.get(reverse('document_list')), 200),
+            ('document_list_api', lambda client: client.get(reverse('document_list_api'), {'limit': 200}), 200),
+            ('version_history', lambda client: client.get(reverse('version_history', kwargs={'doc_id': versioned.id})), 200),
+            ('version_history_api',
+             lambda client: client.get(history_api_url, {'before': version_ids[len(version_ids) // 2]}), 200),
+            ('revert_version', revert_version, 302),
+        ]
+
+    def run(self, seeded, iterations):
+        client = Client()
+        client.force_login(seeded['owner'])
+
+        counter = QueryCounter()
+        db_logger = logging.getLogger('django.db.backends')
+        saved = db_logger.level, db_logger.propagate
+        db_logger.setLevel(logging.DEBUG)
+        db_logger.propagate = False
+        db_logger.addHandler(counter)
+        try:
+            results = {}
+            for name, request, expected_status in self.scenarios(seeded):
+                latencies, queries = [], []
+                for _ in range(iterations):
+                    counter.count = 0
+                    began = time.perf_counter()
+                    response = request(client)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                    latencies.append((time.perf_counter() - began) * 1000)
+                    queries.append(counter.count)
+                    if response.status_code != expected_status:
+                        raise CommandError(f"{name} returned {response.status_code}, expected {expected_status}.")
+                latencies.sort()
+                results[name] = {
+                    'p50_ms': round(statistics.median(latencies), 2),
+                    'p95_ms': round(percentile(latencies, 0.95), 2),
+                    'max_ms': round(latencies[-1], 2),
+                    'queries': max(queries),
+                }
+        finally:
+            db_logger.removeHandler(counter)
+            db_logger.setLevel(saved[0])
+            db_logger.propagate = saved[1]
+        return results
+
+    def report(self, results, budgets):
+        failures = []
+        self.stdout.write(f"{'scenario':<28}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'queries':>9}")
+        for name, result in results.items():
+            budget = budgets.get(name, {})
+            over = [
+                key for key in ('p95_ms', 'queries')
+                if key in budget and result[key] > budget[key]
+            ]
+            line = (f"{name:<28}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+                    f"{result['max_ms']:>10.1f}{result['queries']:>9}")
+            if over:
+                failures.append(name)
+                line += '  OVER BUDGET: ' + ', '.join(f"{key} {result[key]} > {budget[key]}" for key in over)
+                line = self.style.ERROR(line)
+            self.stdout.write(line)
+        return failures
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from hello.retention import compact_all, DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Thins document versions according to the VERSION_RETENTION policy."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--document', type=int, action='append', dest='documents',
+                            help="Only compact this document (can be repeated).")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Versions deleted per transaction.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report how many versions would be deleted without deleting them.")
+
+    def handle(self, *args, **options):
+        report = compact_all(
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            document_ids=options['documents'],
+        )
+        prefix = "Dry run: " if options['dry_run'] else ""
+        self.stdout.write(self.style.SUCCESS(f"{prefix}{report}"))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from hello.blocks import BLOCK_STORAGE, convert_to_blob, convert_to_blocks
+from hello.models import Document, DocumentBlock
+
+
+class Command(BaseCommand):
+    help = (
+        "Converts existing documents to block storage (DOCUMENT_BLOCK_STORAGE), "
+        "or back to a single content blob with --to-blob. One transaction per document."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--document', type=int, action='append', dest='documents',
+                            help="Only convert this document (can be repeated).")
+        parser.add_argument('--to-blob', action='store_true',
+                            help="Move block-stored content back into Document.content and delete the blocks.")
+
+    def handle(self, *args, **options):
+        if options['to_blob']:
+            documents = Document.objects.filter(block_storage=True)
+            # Blob documents with blocks left over from an earlier conversion are cleaned up too
+            leftover = DocumentBlock.objects.filter(document__block_storage=False).values('document_id')
+            documents = documents | Document.objects.filter(id__in=leftover)
+            convert = convert_to_blob
+        else:
+            if not BLOCK_STORAGE:
+                self.stderr.write(self.style.WARNING(
+                    "DOCUMENT_BLOCK_STORAGE is off: converted documents go back to a blob on their next save."
+                ))
+            documents = Document.objects.filter(block_storage=False)
+            convert = convert_to_blocks
+        if options['documents']:
+            documents = documents.filter(id__in=options['documents'])
+
+        converted = 0
+        for document_id in documents.order_by('id').values_list('id', flat=True).distinct():
+            if convert(document_id):
+                converted += 1
+        target = "blob" if options['to_blob'] else "block"
+        self.stdout.write(self.style.SUCCESS(f"Converted {converted} documents to {target} storage."))
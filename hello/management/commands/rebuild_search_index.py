@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from hello.blocks import document_content
+from hello.deltas import apply_delta
+from hello.models import Document, DocumentVersion
+from hello.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Reindexes every document, and optionally every version, for search."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--versions', action='store_true',
+                            help="Also index the content of every stored version (for SEARCH_INDEX_VERSIONS).")
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        documents = 0
+        for document in Document.objects.only('id', 'title', 'content', 'content_hash', 'block_storage').iterator():
+            backend.index_document(document.id, document.title, document_content(document))
+            documents += 1
+
+        versions = 0
+        if options['versions']:
+            document_ids = DocumentVersion.objects.values_list('document_id', flat=True).distinct()
+            for document_id in document_ids:
+                version_ids = list(DocumentVersion.objects.filter(document_id=document_id).values_list('id', flat=True))
+                backend.remove_versions(version_ids)
+                # Walk the delta chain once instead of rebuilding each version separately
+                content = ''
+                chain = DocumentVersion.objects.filter(document_id=document_id).order_by('id')
+                for version in chain.only('id', 'is_keyframe', 'content', 'delta').iterator():
+                    content = version.content if version.is_keyframe else apply_delta(content, version.delta)
+                    backend.index_version(version.id, document_id, content)
+                    versions += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Indexed {documents} documents and {versions} versions."))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from hello import journal
+from hello.blocks import load_content
+from hello.persistence import write_document_content
+from hello.sessions import remember_batches
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays the edit journals left behind by crashed workers into the database and "
+        "deletes them. Run it before starting the workers; a live session replays its "
+        "document's journal on its own."
+    )
+
+    def handle(self, *args, **options):
+        if not journal.enabled():
+            raise CommandError("COLLAB_JOURNAL_DIR is not set.")
+        directory = journal.writer.directory
+        recovered = 0
+        for path in sorted(directory.glob('*.journal')) if directory.exists() else []:
+            document_id = int(path.stem)
+            with open(path, encoding='utf-8') as f:
+                lines = f.readlines()
+            replayed = journal.replay(lines, load_content(document_id))
+            if replayed is not None:
+                content, editor_id, count, batches = replayed
+                write_document_content(document_id, content, editor_id)
+                remember_batches(document_id, batches)
+                self.stdout.write(f"Document {document_id}: replayed {count} operations.")
+                recovered += 1
+            path.unlink()
+        self.stdout.write(self.style.SUCCESS(f"Recovered {recovered} documents."))
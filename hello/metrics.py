@@ -0,0 +1,242 @@
+"""
+Process metrics in the Prometheus text format, served by the metrics view.
+
+Counters and histograms are plain in-process numbers. Updating one takes a
+dict lookup and an addition under an uncontended lock, so they stay on in the
+consumer's hot path. Values describing current state (connections, group
+sizes, send queues) are read from the live objects only when scraped.
+
+Every worker process keeps its own numbers; Prometheus scrapes each worker
+and sums them across processes.
+"""
+import bisect
+import threading
+import time
+
+from . import tracing
+
+# Seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Incoming actions counted under their own label; anything else a client sends is 'other'
+KNOWN_ACTIONS = {'operation', 'edit', 'heartbeat', 'cursor', 'typing'}
+
+
+class Metric:
+    """
+    A named metric with optional labels, kept in the module registry.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        """
+        Yields (suffix, labels dict, value) for every series.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            yield '', dict(zip(self.labels, labels)), value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (the last one is +Inf), sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labels):
+        """
+        Context manager observing the seconds spent in its block.
+        """
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in sorted(values):
+            names = dict(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', dict(names, le=bound), cumulative
+            yield '_sum', names, total
+            yield '_count', names, cumulative
+
+
+class CallbackMetric(Metric):
+    """
+    Gauge or counter whose series are read from `collect()` at scrape time.
+    `collect` returns a dict of label tuples to values.
+    """
+
+    def __init__(self, name, documentation, collect, labels=(), kind='gauge'):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in sorted(self.collect().items()):
+            yield '', dict(zip(self.labels, labels)), value
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        f'{key}="{_format_value(value) if key == "le" else _escape(value)}"' for key, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+registry = []
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+def action_label(action):
+    return action if action in KNOWN_ACTIONS else 'other'
+
+
+async def group_send(layer, group, message):
+    """
+    Sends a message to a group, timing the channel layer call.
+    """
+    with group_send_seconds.time(message['type']), tracing.span('group_send'):
+        await layer.group_send(group, message)
+
+
+def _live_sessions():
+    from .sessions import registry as sessions
+    counts = {}
+    for document_id in sessions.document_ids():
+        session = sessions.get(document_id)
+        if session is not None:
+            counts[(str(document_id),)] = len(session.channels)
+    return counts
+
+
+def _send_queue_max_depth():
+    from .backpressure import metrics as send_metrics
+    return send_metrics.max_queue_depth
+
+
+def _send_queue_counters():
+    from .backpressure import metrics as send_metrics
+    return {(name,): value for name, value in send_metrics.as_dict().items() if name != 'max_queue_depth'}
+
+
+# Live collaboration
+connections = CallbackMetric(
+    'collab_connections', 'Open WebSocket connections in live document sessions.',
+    lambda: {(): sum(_live_sessions().values())},
+)
+document_connections = CallbackMetric(
+    'collab_document_connections', 'Connections in the live session of each document.',
+    _live_sessions, labels=('document',),
+)
+messages_received = Counter('collab_messages_received_total', 'WebSocket messages received.', labels=('action',))
+bytes_received = Counter('collab_received_bytes_total', 'Bytes of WebSocket messages received.', labels=('action',))
+messages_sent = Counter('collab_messages_sent_total', 'WebSocket messages sent.', labels=('action',))
+bytes_sent = Counter('collab_sent_bytes_total', 'Bytes of WebSocket messages sent.', labels=('action',))
+resumes = Counter('collab_resumes_total', 'Reconnecting clients, by how they caught up.', labels=('outcome',))
+group_send_seconds = Histogram(
+    'collab_group_send_seconds', 'Time spent in channel layer group_send.', labels=('type',),
+)
+send_queue_frames = CallbackMetric(
+    'collab_send_queue_frames_total', 'Outgoing queue events (queued, sent, superseded, slow clients).',
+    _send_queue_counters, labels=('event',), kind='counter',
+)
+send_queue_max_depth = CallbackMetric(
+    'collab_send_queue_max_depth', 'Deepest outgoing queue of any connection so far.',
+    lambda: {(): _send_queue_max_depth()},
+)
+
+# Persistence
+document_save_seconds = Histogram(
+    'document_save_seconds', 'Time from submitting a document write until it is committed.', labels=('path',),
+)
+document_save_bytes = Histogram(
+    'document_save_bytes', 'Size of document content written.', buckets=SIZE_BUCKETS,
+)
+versions_created = Counter('document_versions_created_total', 'Document versions created.', labels=('kind',))
+version_bytes = Counter('document_version_bytes_total', 'Bytes stored in new document versions.', labels=('kind',))
+block_writes = Counter('document_block_writes_total', 'Document block rows written.', labels=('op',))
+versions_deleted = Counter('document_versions_deleted_total', 'Document versions deleted by retention.')
+
+# Rate limits
+rate_limit_rejections = Counter('rate_limit_rejections_total', 'Requests and messages over a rate limit.', labels=('limit',))
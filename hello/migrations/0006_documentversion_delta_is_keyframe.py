@@ -0,0 +1,84 @@
+# Generated by Django 3.2.9 on 2026-10-17 01:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+from hello.deltas import make_delta, apply_delta
+
+BATCH_SIZE = 500
+
+
+def compress_versions(apps, schema_editor):
+    """
+    Converts existing full-copy versions into keyframes every
+    VERSION_KEYFRAME_INTERVAL versions and deltas in between.
+    """
+    DocumentVersion = apps.get_model('hello', 'DocumentVersion')
+    interval = getattr(settings, 'VERSION_KEYFRAME_INTERVAL', 20)
+
+    document_ids = DocumentVersion.objects.values_list('document_id', flat=True).distinct()
+    for document_id in document_ids:
+        previous = None
+        pending = []
+        versions = DocumentVersion.objects.filter(document_id=document_id).order_by('id')
+        for index, version in enumerate(versions.iterator()):
+            content = version.content
+            if index % interval:
+                version.delta = make_delta(previous, content)
+                version.content = ''
+                version.is_keyframe = False
+                pending.append(version)
+            previous = content
+            if len(pending) >= BATCH_SIZE:
+                DocumentVersion.objects.bulk_update(pending, ['content', 'delta', 'is_keyframe'])
+                pending = []
+        if pending:
+            DocumentVersion.objects.bulk_update(pending, ['content', 'delta', 'is_keyframe'])
+
+
+def expand_versions(apps, schema_editor):
+    """
+    Stores every version in full again.
+    """
+    DocumentVersion = apps.get_model('hello', 'DocumentVersion')
+
+    document_ids = DocumentVersion.objects.values_list('document_id', flat=True).distinct()
+    for document_id in document_ids:
+        content = ''
+        pending = []
+        versions = DocumentVersion.objects.filter(document_id=document_id).order_by('id')
+        for version in versions.iterator():
+            if version.is_keyframe:
+                content = version.content
+                continue
+            content = apply_delta(content, version.delta)
+            version.content = content
+            version.delta = ''
+            version.is_keyframe = True
+            pending.append(version)
+            if len(pending) >= BATCH_SIZE:
+                DocumentVersion.objects.bulk_update(pending, ['content', 'delta', 'is_keyframe'])
+                pending = []
+        if pending:
+            DocumentVersion.objects.bulk_update(pending, ['content', 'delta', 'is_keyframe'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hello', '0005_documentversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='delta',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='is_keyframe',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(compress_versions, expand_versions),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-17 01:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hello', '0006_documentversion_delta_is_keyframe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='is_revert',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 3.2.9 on 2026-10-17 01:43
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def _hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def apply_delta(old, delta):
+    # Copied from hello.deltas as of this migration, which must not change with the app
+    prefix, suffix, middle = json.loads(delta)
+    return old[:prefix] + middle + old[len(old) - suffix:]
+
+
+def fill_hashes(apps, schema_editor):
+    """
+    Computes content hashes for existing documents and versions.
+    """
+    Document = apps.get_model('hello', 'Document')
+    DocumentVersion = apps.get_model('hello', 'DocumentVersion')
+
+    pending = []
+    for document in Document.objects.only('id', 'content').iterator():
+        document.content_hash = _hash(document.content)
+        pending.append(document)
+        if len(pending) >= BATCH_SIZE:
+            Document.objects.bulk_update(pending, ['content_hash'])
+            pending = []
+    if pending:
+        Document.objects.bulk_update(pending, ['content_hash'])
+
+    # Delta versions need the content of the versions before them
+    document_ids = DocumentVersion.objects.values_list('document_id', flat=True).distinct()
+    for document_id in document_ids:
+        content = ''
+        pending = []
+        versions = DocumentVersion.objects.filter(document_id=document_id).order_by('id')
+        for version in versions.only('id', 'is_keyframe', 'content', 'delta').iterator():
+            content = version.content if version.is_keyframe else apply_delta(content, version.delta)
+            version.content_hash = _hash(content)
+            pending.append(version)
+            if len(pending) >= BATCH_SIZE:
+                DocumentVersion.objects.bulk_update(pending, ['content_hash'])
+                pending = []
+        if pending:
+            DocumentVersion.objects.bulk_update(pending, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hello', '0007_documentversion_is_revert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_hashes, migrations.RunPython.noop),
+    ]
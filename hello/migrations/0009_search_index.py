@@ -0,0 +1,68 @@
+import html
+
+from django.db import migrations
+from django.utils.html import strip_tags
+
+# Copied from hello.search as of this migration, which must not change with the app
+DOCUMENT_TABLE = 'hello_document_fts'
+VERSION_TABLE = 'hello_documentversion_fts'
+
+BATCH_SIZE = 500
+
+
+def plain_text(content):
+    return html.unescape(strip_tags(content))
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Creates the FTS5 tables used by hello.search.SQLiteFTSBackend and indexes
+    existing documents. Versions are indexed by `manage.py rebuild_search_index
+    --versions` when SEARCH_INDEX_VERSIONS is turned on.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {DOCUMENT_TABLE} USING fts5("
+                f"title, body, tokenize='unicode61 remove_diacritics 2')"
+            )
+        except Exception:
+            # SQLite built without FTS5; search falls back to BasicSearchBackend
+            return
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {VERSION_TABLE} USING fts5("
+            f"document_id UNINDEXED, body, tokenize='unicode61 remove_diacritics 2')"
+        )
+
+        Document = apps.get_model('hello', 'Document')
+        rows = []
+        for document in Document.objects.only('id', 'title', 'content').iterator():
+            rows.append((document.id, document.title, plain_text(document.content)))
+            if len(rows) >= BATCH_SIZE:
+                cursor.executemany(f'INSERT INTO {DOCUMENT_TABLE} (rowid, title, body) VALUES (%s, %s, %s)', rows)
+                rows = []
+        if rows:
+            cursor.executemany(f'INSERT INTO {DOCUMENT_TABLE} (rowid, title, body) VALUES (%s, %s, %s)', rows)
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {DOCUMENT_TABLE}')
+        cursor.execute(f'DROP TABLE IF EXISTS {VERSION_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hello', '0008_document_content_hash_documentversion_content_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.9 on 2026-10-17 02:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hello', '0009_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='block_storage',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='DocumentBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.CharField(max_length=255)),
+                ('content', models.TextField()),
+                ('content_hash', models.CharField(max_length=64)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='blocks', to='hello.document')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='documentblock',
+            constraint=models.UniqueConstraint(fields=('document', 'position'), name='unique_block_position'),
+        ),
+    ]
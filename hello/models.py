@@ -1,5 +1,19 @@
+import hashlib
 from django.db import models
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils.functional import cached_property
+from .deltas import make_delta, apply_delta
+from . import metrics
+
+# Every Nth version of a document is stored in full; the rest are deltas
+VERSION_KEYFRAME_INTERVAL = getattr(settings, 'VERSION_KEYFRAME_INTERVAL', 20)
+
+
+# SHA-256 of a document's content, used to skip writes that change nothing
+def hash_content(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
 
 # Model to represent a document
 class Document(models.Model):
@@ -9,6 +23,9 @@ class Document(models.Model):
     # Content of the document (text field for longer inputs)
     content = models.TextField()
 
+    # Hash of the content, kept in sync on every save
+    content_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
+
     # The owner of the document (one-to-many relationship with User)
     owner = models.ForeignKey(
         User, 
@@ -41,11 +58,115 @@ class Document(models.Model):
     # Indicates if the document is active (can be used for soft deletion or version control)
     is_active = models.BooleanField(default=False)
 
+    # Whether the content is stored as DocumentBlock rows (content is then empty)
+    block_storage = models.BooleanField(default=False)
+
+    # Keep the content hash in sync whenever the document is saved
+    # Block-stored content is only written by hello.persistence, which sets the hash itself
+    def save(self, *args, **kwargs):
+        if not self.block_storage:
+            self.content_hash = hash_content(self.content)
+        super().save(*args, **kwargs)
+
     # String representation of the model
     def __str__(self):
         return self.title
 
 
+# One top-level element of a block-stored document (see hello.blocks)
+class DocumentBlock(models.Model):
+    # The document this block belongs to
+    document = models.ForeignKey(
+        Document,
+        on_delete=models.CASCADE,  # Delete all blocks if the document is deleted
+        related_name='blocks'  # Allows reverse access to the blocks of a document
+    )
+
+    # Fractional ordering key; blocks sort by it within their document
+    position = models.CharField(max_length=255)
+
+    # HTML of the block
+    content = models.TextField()
+
+    # Hash of the block's content, compared to find the blocks a save changes
+    content_hash = models.CharField(max_length=64)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'position'], name='unique_block_position'),
+        ]
+
+    # String representation of the model
+    def __str__(self):
+        return f"{self.document_id}:{self.position}"
+
+
+# Manager that stores new versions as deltas against the previous one
+class DocumentVersionManager(models.Manager):
+    def create_version(self, document_id, content, editor_id=None, is_revert=False):
+        """
+        Creates a version of a document.
+        - Returns None without writing if the content matches the latest version.
+        - Stores a full keyframe every VERSION_KEYFRAME_INTERVAL versions.
+        - Stores a delta against the previous version otherwise.
+        """
+        content_hash = hash_content(content)
+        chain = self.latest_chain(document_id)
+        if chain and chain[-1][3] == content_hash:
+            return None
+
+        if not chain or len(chain) >= VERSION_KEYFRAME_INTERVAL:
+            version = self.create(
+                document_id=document_id,
+                content=content,
+                content_hash=content_hash,
+                editor_id=editor_id,
+                is_revert=is_revert,
+            )
+            metrics.versions_created.inc('keyframe')
+            metrics.version_bytes.inc('keyframe', amount=len(content.encode('utf-8')))
+            return version
+
+        previous = rebuild_chain(chain)
+        delta = make_delta(previous, content)
+        version = self.create(
+            document_id=document_id,
+            content='',
+            delta=delta,
+            content_hash=content_hash,
+            is_keyframe=False,
+            editor_id=editor_id,
+            is_revert=is_revert,
+        )
+        metrics.versions_created.inc('delta')
+        metrics.version_bytes.inc('delta', amount=len(delta.encode('utf-8')))
+        return version
+
+    def latest_chain(self, document_id, up_to=None):
+        """
+        Returns (is_keyframe, content, delta, content_hash) rows from the newest keyframe up
+        to the latest version (or to version id `up_to`), oldest first.
+        """
+        versions = self.filter(document_id=document_id)
+        if up_to is not None:
+            versions = versions.filter(id__lte=up_to)
+        keyframe_id = versions.filter(is_keyframe=True).order_by('-id').values_list('id', flat=True).first()
+        if keyframe_id is None:
+            return []
+        return list(
+            versions.filter(id__gte=keyframe_id).order_by('id')
+            .values_list('is_keyframe', 'content', 'delta', 'content_hash')
+        )
+
+
+# Rebuilds the full content at the end of a chain returned by latest_chain
+def rebuild_chain(chain):
+    content = chain[0][1]
+    for row in chain[1:]:
+        content = apply_delta(content, row[2])
+    return content
+
+
 # Model to represent a version of a document
 class DocumentVersion(models.Model):
     # The document to which this version belongs (one-to-many relationship)
@@ -55,9 +176,21 @@ class DocumentVersion(models.Model):
         related_name='versions'  # Allows reverse access to versions of a document
     )
 
-    # Content of this version of the document
+    # Full content of this version (only for keyframes, empty for deltas)
     content = models.TextField()
 
+    # Diff against the previous version of the document (only for deltas)
+    delta = models.TextField(blank=True, default='')
+
+    # Whether this version is stored in full rather than as a delta
+    is_keyframe = models.BooleanField(default=True)
+
+    # Whether this version was created by reverting (never thinned by retention)
+    is_revert = models.BooleanField(default=False)
+
+    # Hash of the full content of this version
+    content_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
+
     # Timestamp for when this version was created
     timestamp = models.DateTimeField(auto_now_add=True)
 
@@ -69,6 +202,16 @@ class DocumentVersion(models.Model):
         blank=True  # Allows the field to be empty
     )
 
+    objects = DocumentVersionManager()
+
+    # Full content of this version, rebuilt from the nearest keyframe if needed
+    @cached_property
+    def full_content(self):
+        if self.is_keyframe:
+            return self.content
+        chain = DocumentVersion.objects.latest_chain(self.document_id, up_to=self.id)
+        return rebuild_chain(chain)
+
     # String representation of the model
     def __str__(self):
         return f"{self.document.title} - {self.timestamp.strftime('%Y-%m-%d %H:%M:%S')} by {self.editor}"
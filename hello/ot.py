@@ -0,0 +1,192 @@
+"""
+Operational transformation for the collaborative editor.
+
+Edits travel between the browser and the server as small operations instead
+of full copies of the document. Operations are plain dicts so they can pass
+through the channel layer unchanged:
+
+    {'type': 'insert', 'pos': 12, 'text': 'hello'}
+    {'type': 'delete', 'pos': 4, 'length': 3}
+    {'type': 'format', 'pos': 4, 'length': 3, 'tag': 'b'}
+
+Positions are indexes into the document's HTML string. A list of operations
+is applied in order, each one against the result of the previous one.
+"""
+
+# Inline tags a 'format' operation is allowed to wrap a range with
+FORMAT_TAGS = frozenset({'b', 'i', 'u', 's', 'strong', 'em', 'sub', 'sup', 'mark'})
+
+
+class OperationError(ValueError):
+    """
+    Raised when an operation is malformed or does not fit the document.
+    """
+
+
+def insert(pos, text):
+    return {'type': 'insert', 'pos': pos, 'text': text}
+
+
+def delete(pos, length):
+    return {'type': 'delete', 'pos': pos, 'length': length}
+
+
+def normalize(ops):
+    """
+    Validates operations received from a client.
+    - Returns a new list holding only 'insert' and 'delete' operations.
+    - 'format' operations are expanded into the insertion of a closing and an
+      opening tag, so only two operation types need transforming.
+    - Raises OperationError on anything malformed.
+    """
+    if not isinstance(ops, list):
+        raise OperationError("Operations must be a list.")
+
+    result = []
+    for op in ops:
+        if not isinstance(op, dict):
+            raise OperationError("Each operation must be an object.")
+        kind = op.get('type')
+        pos = op.get('pos')
+        if not isinstance(pos, int) or isinstance(pos, bool) or pos < 0:
+            raise OperationError("Operation position must be a non-negative integer.")
+
+        if kind == 'insert':
+            text = op.get('text')
+            if not isinstance(text, str):
+                raise OperationError("Insert operations need a text string.")
+            if text:
+                result.append(insert(pos, text))
+        elif kind in ('delete', 'format'):
+            length = op.get('length')
+            if not isinstance(length, int) or isinstance(length, bool) or length < 0:
+                raise OperationError("Operation length must be a non-negative integer.")
+            if kind == 'delete':
+                if length:
+                    result.append(delete(pos, length))
+            else:
+                tag = op.get('tag')
+                if tag not in FORMAT_TAGS:
+                    raise OperationError(f"Unsupported format tag: {tag!r}.")
+                # Close first so the opening tag does not shift the end position
+                result.append(insert(pos + length, f'</{tag}>'))
+                result.append(insert(pos, f'<{tag}>'))
+        else:
+            raise OperationError(f"Unknown operation type: {kind!r}.")
+    return result
+
+
+def apply(content, ops):
+    """
+    Applies a list of normalized operations to a string and returns the result.
+    """
+    for op in ops:
+        pos = op['pos']
+        if op['type'] == 'insert':
+            if pos > len(content):
+                raise OperationError("Insert position is past the end of the document.")
+            content = content[:pos] + op['text'] + content[pos:]
+        else:
+            end = pos + op['length']
+            if end > len(content):
+                raise OperationError("Delete range is past the end of the document.")
+            content = content[:pos] + content[end:]
+    return content
+
+
+def replacement(old_length, content):
+    """
+    Returns the operations that replace a whole document of `old_length`
+    characters with `content`. Used to record legacy full-content edits.
+    """
+    ops = []
+    if old_length:
+        ops.append(delete(0, old_length))
+    if content:
+        ops.append(insert(0, content))
+    return ops
+
+
+def transform_pair(a_ops, b_ops, a_wins=False):
+    """
+    Transforms two operation lists that were both made against the same state.
+    - Returns (a', b') where a' applies after b and b' applies after a, so that
+      apply(apply(s, a), b') == apply(apply(s, b), a').
+    - When both sides insert at the same position, the side that wins keeps
+      its text first.
+    """
+    if not a_ops or not b_ops:
+        return list(a_ops), list(b_ops)
+
+    # Split the longer list in half so recursion depth stays logarithmic
+    if len(a_ops) > 1:
+        mid = len(a_ops) // 2
+        a1, b1 = transform_pair(a_ops[:mid], b_ops, a_wins)
+        a2, b2 = transform_pair(a_ops[mid:], b1, a_wins)
+        return a1 + a2, b2
+    if len(b_ops) > 1:
+        mid = len(b_ops) // 2
+        a1, b1 = transform_pair(a_ops, b_ops[:mid], a_wins)
+        a2, b2 = transform_pair(a1, b_ops[mid:], a_wins)
+        return a2, b1 + b2
+
+    return _transform_single(a_ops[0], b_ops[0], a_wins)
+
+
+def transform(ops, against, wins=False):
+    """
+    Returns `ops` rewritten so they apply after `against`.
+    """
+    return transform_pair(ops, against, wins)[0]
+
+
+def _transform_single(a, b, a_wins):
+    if a['type'] == 'insert' and b['type'] == 'insert':
+        if a['pos'] < b['pos'] or (a['pos'] == b['pos'] and a_wins):
+            return [a], [insert(b['pos'] + len(a['text']), b['text'])]
+        return [insert(a['pos'] + len(b['text']), a['text'])], [b]
+
+    if a['type'] == 'insert':
+        return _transform_insert_delete(a, b)
+
+    if b['type'] == 'insert':
+        b_out, a_out = _transform_insert_delete(b, a)
+        return a_out, b_out
+
+    return _transform_delete_delete(a, b), _transform_delete_delete(b, a)
+
+
+def _transform_insert_delete(ins, dele):
+    """
+    Transforms an insert against a concurrent delete, returning (ins', del').
+    Text inserted inside a deleted range survives at the start of that range.
+    """
+    start = dele['pos']
+    end = start + dele['length']
+    pos = ins['pos']
+    size = len(ins['text'])
+
+    if pos <= start:
+        return [ins], [delete(start + size, dele['length'])]
+    if pos >= end:
+        return [insert(pos - dele['length'], ins['text'])], [dele]
+
+    # The insert lands inside the deleted range: split the delete around it
+    head = pos - start
+    return [insert(start, ins['text'])], [delete(start, head), delete(start + size, dele['length'] - head)]
+
+
+def _transform_delete_delete(a, b):
+    """
+    Returns delete `a` rewritten to apply after delete `b`, without removing
+    the characters `b` already removed.
+    """
+    a_start, a_end = a['pos'], a['pos'] + a['length']
+    b_start, b_end = b['pos'], b['pos'] + b['length']
+
+    overlap = max(0, min(a_end, b_end) - max(a_start, b_start))
+    length = a['length'] - overlap
+    if not length:
+        return []
+    removed_before = max(0, min(b_end, a_start) - b_start)
+    return [delete(a_start - removed_before, length)]
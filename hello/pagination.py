@@ -0,0 +1,43 @@
+"""
+Keyset pagination for the document and version lists.
+
+Pages are ordered newest first by primary key and continue from the id of
+the last row already shown (`?before=<id>`), so fetching page 400 costs the
+same indexed range scan as page 1, unlike OFFSET pagination.
+"""
+from django.conf import settings
+
+# Default number of rows per page
+PAGE_SIZE = getattr(settings, 'LIST_PAGE_SIZE', 50)
+
+# Upper bound for a client-requested page size
+MAX_PAGE_SIZE = 200
+
+
+def parse_cursor(request):
+    """
+    Returns the `before` cursor and page size requested, ignoring bad values.
+    """
+    try:
+        before = int(request.GET.get('before', ''))
+    except ValueError:
+        before = None
+    try:
+        size = min(max(int(request.GET.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        size = PAGE_SIZE
+    return before, size
+
+
+def keyset_page(queryset, before=None, size=PAGE_SIZE):
+    """
+    Returns (rows, next_cursor) for one page of `queryset`, newest first.
+    `next_cursor` is None on the last page.
+    """
+    if before is not None:
+        queryset = queryset.filter(pk__lt=before)
+    rows = list(queryset.order_by('-pk')[:size + 1])
+    if len(rows) > size:
+        rows = rows[:size]
+        return rows, rows[-1].pk
+    return rows, None
@@ -0,0 +1,98 @@
+"""
+Document access checks shared by the views and the WebSocket consumer.
+
+A user may access a document they own or that is shared with them. Each
+answer is cached under its own (user, document) key, which also names the
+document's current ACL version. share_document and delete_document call
+invalidate_document_access, which replaces the version: every cached answer
+for the document stops being read at once, including one a check running
+at the same time writes under the old version.
+
+The cache has to be shared by every process serving the app, or an
+invalidation in one worker leaves the others answering from stale entries.
+Startup fails when COLLAB_WORKERS lists several workers and the default
+cache is process-local.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Exists, OuterRef, Q
+
+from .models import Document
+
+# Seconds a cached access decision is trusted
+ACL_CACHE_TIMEOUT = getattr(settings, 'DOCUMENT_ACL_CACHE_TIMEOUT', 300)
+
+
+# Cache backends that keep their entries inside one process
+LOCAL_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+def _version_key(document_id):
+    return f'document_acl_version_{document_id}'
+
+
+def _cache_key(document_id, version, user_id):
+    return f'document_acl_{document_id}_{version}_{user_id}'
+
+
+def _acl_version(document_id):
+    # A missing (or evicted) version starts a fresh one, never an old one again
+    key = _version_key(document_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def has_document_access(user, document_id, owner_id=None):
+    """
+    Returns True if `user` owns the document or it is shared with them.
+    - Pass `owner_id` when the document row is already loaded to answer the
+      owner case without touching the cache.
+    - Returns False for documents that do not exist.
+    """
+    if not user.is_authenticated:
+        return False
+    if owner_id is not None and owner_id == user.id:
+        return True
+
+    key = _cache_key(document_id, _acl_version(document_id), user.id)
+    allowed = cache.get(key)
+    if allowed is not None:
+        return allowed
+
+    allowed = _query_access(user.id, document_id)
+    cache.set(key, allowed, ACL_CACHE_TIMEOUT)
+    return allowed
+
+
+def invalidate_document_access(document_id):
+    """
+    Forgets every cached decision for a document; call after its owner or
+    share list changes, or after it is deleted.
+    """
+    cache.set(_version_key(document_id), uuid.uuid4().hex, None)
+
+
+def check_shared_cache():
+    """
+    Raises ImproperlyConfigured when documents are spread over several
+    workers but the default cache only lives in this process.
+    """
+    workers = getattr(settings, 'COLLAB_WORKERS', None) or {}
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if len(workers) > 1 and backend in LOCAL_CACHE_BACKENDS:
+        raise ImproperlyConfigured(
+            "COLLAB_WORKERS lists several workers, so CACHES['default'] must be shared by them "
+            f"(e.g. Memcached), not {backend}."
+        )
+
+
+def _query_access(user_id, document_id):
+    # Single indexed lookup: the owner column or one (document, user) share row
+    shared = Document.shared_with.through.objects.filter(document_id=OuterRef('pk'), user_id=user_id)
+    return Document.objects.filter(Q(owner_id=user_id) | Q(Exists(shared)), id=document_id).exists()
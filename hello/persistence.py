@@ -0,0 +1,232 @@
+"""
+Database writes for document content.
+
+Every path that stores new document content (the HTTP save, reverts and the
+live session flush) goes through here so a save is always the same single
+UPDATE of the document row plus one version insert, and neither happens when
+the content is unchanged. With DOCUMENT_BLOCK_STORAGE the content itself goes
+to the changed blocks instead of the document row (see hello.blocks).
+
+SQLite allows one writer at a time, and concurrent saves from request threads
+and session flushes end in "database is locked" errors. On SQLite (or when
+DOCUMENT_WRITE_QUEUE is True) writes therefore go through a single
+DocumentWriter thread. It collects the writes that arrive within
+DOCUMENT_WRITE_BATCH_INTERVAL seconds and commits them in one transaction.
+Connections are opened in WAL mode so readers never wait for that writer.
+"""
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.utils import timezone
+
+from . import blocks, metrics, tracing
+from .models import Document, DocumentVersion, hash_content
+from .search import INDEX_VERSIONS, get_search_backend
+
+logger = logging.getLogger(__name__)
+
+# True or False forces the write queue on or off; None uses it only on SQLite
+WRITE_QUEUE = getattr(settings, 'DOCUMENT_WRITE_QUEUE', None)
+
+# Seconds the writer waits for more writes to join a batch
+WRITE_BATCH_INTERVAL = getattr(settings, 'DOCUMENT_WRITE_BATCH_INTERVAL', 0.02)
+
+# Most writes committed in one transaction
+WRITE_BATCH_SIZE = getattr(settings, 'DOCUMENT_WRITE_BATCH_SIZE', 200)
+
+
+@transaction.atomic
+def store_document_content(document_id, content, editor_id=None, create_version=True, is_revert=False):
+    """
+    Writes new content to a document without loading the row first.
+    - Skips the write (and the version) when the stored content hash matches.
+    - Returns False if the document no longer exists, True otherwise.
+    - Records a DocumentVersion unless `create_version` is False.
+    """
+    content_hash = hash_content(content)
+    fields = {'content_hash': content_hash, 'updated_at': timezone.now(), 'block_storage': blocks.BLOCK_STORAGE}
+    # Stored blocks of a document saved as a blob again are ignored until it is next converted
+    fields['content'] = '' if blocks.BLOCK_STORAGE else content
+    if editor_id is not None:
+        fields['last_editor_id'] = editor_id
+
+    metrics.document_save_bytes.observe(len(content.encode('utf-8')))
+    documents = Document.objects.filter(id=document_id)
+    with tracing.span('document.update'):
+        updated = documents.exclude(content_hash=content_hash).update(**fields)
+    if not updated:
+        # Either the content is unchanged or the document is gone
+        return documents.exists()
+
+    if blocks.BLOCK_STORAGE:
+        with tracing.span('blocks.write'):
+            blocks.store_blocks(document_id, content, content_hash)
+
+    search = get_search_backend()
+    with tracing.span('search.index'):
+        search.index_content(document_id, content)
+    if create_version:
+        with tracing.span('version.insert'):
+            version = DocumentVersion.objects.create_version(document_id, content, editor_id, is_revert=is_revert)
+        if version is not None and INDEX_VERSIONS:
+            search.index_version(version.id, document_id, content)
+    return True
+
+
+def write_document_content(document_id, content, editor_id=None, create_version=True, is_revert=False):
+    """
+    Stores document content like store_document_content, through the write
+    queue when it is enabled. Blocks until the write is committed.
+    - Do not call this inside a transaction: on SQLite the caller's
+      transaction could hold the lock the writer is waiting for.
+    """
+    if not _use_write_queue():
+        with metrics.document_save_seconds.time('direct'):
+            return store_document_content(document_id, content, editor_id, create_version, is_revert)
+    with metrics.document_save_seconds.time('queue'), tracing.span('document.write'):
+        return writer.submit(document_id, content, editor_id, create_version, is_revert).result()
+
+
+async def write_document_content_async(document_id, content, editor_id=None, create_version=True, is_revert=False):
+    """
+    Async variant of write_document_content for consumers and sessions.
+    Waiting for the writer does not hold up the thread running other
+    database work.
+    """
+    if not _use_write_queue():
+        with metrics.document_save_seconds.time('direct'):
+            return await tracing.database_sync_to_async(store_document_content)(
+                document_id, content, editor_id, create_version, is_revert
+            )
+    with metrics.document_save_seconds.time('queue'), tracing.span('document.write'):
+        return await asyncio.wrap_future(writer.submit(document_id, content, editor_id, create_version, is_revert))
+
+
+def _use_write_queue():
+    if WRITE_QUEUE is not None:
+        return WRITE_QUEUE
+    return connections['default'].vendor == 'sqlite'
+
+
+class WriteRequest:
+    __slots__ = ('document_id', 'args', 'is_revert', 'future', 'followers', 'context')
+
+    def __init__(self, document_id, content, editor_id, create_version, is_revert):
+        self.document_id = document_id
+        self.args = (document_id, content, editor_id, create_version, is_revert)
+        self.is_revert = is_revert
+        self.future = Future()
+        # Earlier writes of the same document that this one superseded
+        self.followers = []
+        # The writer runs the write in the submitter's context, so it shows in the submitter's trace
+        self.context = contextvars.copy_context()
+
+
+class DocumentWriter:
+    """
+    Single thread that commits document writes in batches.
+    """
+
+    def __init__(self, interval=WRITE_BATCH_INTERVAL, batch_size=WRITE_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, document_id, content, editor_id=None, create_version=True, is_revert=False):
+        """
+        Queues a write and returns a Future resolved once it is committed.
+        """
+        self._ensure_started()
+        request = WriteRequest(int(document_id), content, editor_id, create_version, is_revert)
+        self._queue.put(request)
+        return request.future
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='document-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        # The writer keeps its connection between batches (CONN_MAX_AGE) but drops broken or expired ones
+        close_old_connections()
+        writes = self._collapse(batch)
+        outcomes = []
+        try:
+            with transaction.atomic():
+                for request in writes:
+                    try:
+                        # store_document_content runs in a savepoint, so a failed write only undoes itself
+                        outcomes.append((request, request.context.run(store_document_content, *request.args), None))
+                    except Exception as e:
+                        outcomes.append((request, None, e))
+        except Exception as e:
+            logger.error(f"Document write batch of {len(writes)} failed: {e}")
+            outcomes = [(request, None, e) for request in writes]
+
+        for request, result, error in outcomes:
+            for future in [request.future] + [follower.future for follower in request.followers]:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    @staticmethod
+    def _collapse(batch):
+        # A plain save made obsolete by a later one of the same document in
+        # the same batch is not written; its caller gets the later result.
+        # Reverts are always written, and nothing is merged across them.
+        writes = []
+        pending = {}
+        for request in batch:
+            previous = pending.get(request.document_id)
+            if previous is not None and not request.is_revert:
+                superseded = writes[previous]
+                request.followers = superseded.followers + [superseded]
+                superseded.followers = []
+                writes[previous] = request
+                continue
+            writes.append(request)
+            if request.is_revert:
+                pending.pop(request.document_id, None)
+            else:
+                pending[request.document_id] = len(writes) - 1
+        return writes
+
+
+# Process-wide writer used when the write queue is enabled
+writer = DocumentWriter()
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    connection_created handler: WAL lets readers proceed while the writer
+    commits, and NORMAL sync is safe with WAL.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
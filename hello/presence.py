@@ -0,0 +1,200 @@
+"""
+Registry of who is currently connected to each document.
+
+Every open socket is a member of its document's participant set and must
+heartbeat within PRESENCE['CONFIG']['ttl'] seconds or it expires, so crashed
+workers do not leave ghosts behind. The Redis backend shares the registry
+between processes (one sorted set per document, scored by expiry time); the
+in-memory backend is for single-process development and tests.
+
+Changes are not broadcast one by one. PresenceBroadcaster coalesces them
+and hands each document at most one participant snapshot per
+`snapshot_interval` seconds to the activity frames of hello.coalescing.
+"""
+import asyncio
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .coalescing import coalescer
+
+DEFAULT_PRESENCE = {
+    'BACKEND': 'hello.presence.InMemoryPresenceBackend',
+    'CONFIG': {},
+}
+
+
+class BasePresenceBackend:
+    """
+    Participant sets keyed by document id. Members are (username, channel)
+    pairs so a user with several tabs open is one participant.
+    """
+
+    def __init__(self, ttl=60, snapshot_interval=1.0, **kwargs):
+        self.ttl = ttl
+        self.snapshot_interval = snapshot_interval
+
+    def touch(self, document_id, username, channel_name):
+        """
+        Adds or refreshes a member. Returns True if the participant list may
+        have changed (a new member joined or stale members expired).
+        """
+        raise NotImplementedError
+
+    def remove(self, document_id, username, channel_name):
+        """
+        Removes a member. Returns True if it was present.
+        """
+        raise NotImplementedError
+
+    def participants(self, document_id):
+        """
+        Returns the sorted usernames of live members.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _member(username, channel_name):
+        return f'{username}:{channel_name}'
+
+    @staticmethod
+    def _usernames(members):
+        return sorted({member.split(':', 1)[0] for member in members})
+
+
+class InMemoryPresenceBackend(BasePresenceBackend):
+    """
+    Process-local presence registry.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def touch(self, document_id, username, channel_name):
+        now = time.time()
+        with self._lock:
+            members = self._documents.setdefault(str(document_id), {})
+            expired = self._expire(members, now)
+            member = self._member(username, channel_name)
+            joined = member not in members
+            members[member] = now + self.ttl
+            return joined or expired
+
+    def remove(self, document_id, username, channel_name):
+        with self._lock:
+            members = self._documents.get(str(document_id), {})
+            removed = members.pop(self._member(username, channel_name), None) is not None
+            if not members:
+                self._documents.pop(str(document_id), None)
+            return removed
+
+    def participants(self, document_id):
+        with self._lock:
+            members = self._documents.get(str(document_id), {})
+            self._expire(members, time.time())
+            return self._usernames(members)
+
+    @staticmethod
+    def _expire(members, now):
+        stale = [member for member, expires_at in members.items() if expires_at <= now]
+        for member in stale:
+            del members[member]
+        return bool(stale)
+
+
+class RedisPresenceBackend(BasePresenceBackend):
+    """
+    Presence registry shared by all workers through Redis.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, prefix='presence', **kwargs):
+        super().__init__(**kwargs)
+        import redis
+        self.client = redis.Redis(host=host, port=port, db=db, decode_responses=True)
+        self.prefix = prefix
+
+    def _key(self, document_id):
+        return f'{self.prefix}:document:{document_id}'
+
+    def touch(self, document_id, username, channel_name):
+        key = self._key(document_id)
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zadd(key, {self._member(username, channel_name): now + self.ttl})
+        # The whole set disappears once nobody has heartbeated for a full TTL
+        pipe.expire(key, self.ttl)
+        expired, added, _ = pipe.execute()
+        return bool(expired or added)
+
+    def remove(self, document_id, username, channel_name):
+        return bool(self.client.zrem(self._key(document_id), self._member(username, channel_name)))
+
+    def participants(self, document_id):
+        key = self._key(document_id)
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(key, '-inf', time.time())
+        pipe.zrange(key, 0, -1)
+        _, members = pipe.execute()
+        return self._usernames(members)
+
+
+class PresenceBroadcaster:
+    """
+    Produces coalesced participant snapshots for document groups.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._pending = {}
+        self._last_sent = {}
+
+    def changed(self, document_id):
+        """
+        Schedules a snapshot for a document unless one is already pending.
+        The snapshot goes out no sooner than `snapshot_interval` after the
+        previous one, and reflects every change made until then.
+        """
+        document_id = str(document_id)
+        if document_id in self._pending:
+            return
+        wait = self._last_sent.get(document_id, 0) + self.backend.snapshot_interval - time.monotonic()
+        self._pending[document_id] = asyncio.ensure_future(self._send_later(document_id, max(0, wait)))
+
+    async def _send_later(self, document_id, wait):
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            self._pending.pop(document_id, None)
+        self._last_sent[document_id] = time.monotonic()
+        participants = await sync_to_async(self.backend.participants, thread_sensitive=False)(document_id)
+        if not participants:
+            self._last_sent.pop(document_id, None)
+        coalescer.presence(document_id, participants)
+
+
+_backend = None
+_broadcaster = None
+
+
+def get_presence_backend():
+    """
+    Returns the configured presence backend, creating it on first use.
+    """
+    global _backend
+    if _backend is None:
+        config = getattr(settings, 'PRESENCE', DEFAULT_PRESENCE)
+        _backend = import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+    return _backend
+
+
+def get_presence_broadcaster():
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = PresenceBroadcaster(get_presence_backend())
+    return _broadcaster
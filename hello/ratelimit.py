@@ -0,0 +1,213 @@
+"""
+Rate limits shared by the HTTP views and the WebSocket consumer.
+
+Each limit in RATE_LIMITS allows `count` requests per `period` seconds and
+up to `count` at once. Limits use the generic cell rate algorithm, which
+behaves like a token bucket refilled continuously (a sliding window, not a
+window that resets). A key's whole state is one timestamp: the time at which
+its bucket is full again. A check reads and updates it in one atomic step:
+
+- RedisRateLimitBackend runs a Lua script, one round trip per check, so
+  limits hold across workers and concurrent requests cannot both take the
+  last token. While Redis cannot be reached, requests are let through and a
+  warning is logged, so an outage of the limiter does not take the site
+  down with it;
+- InMemoryRateLimitBackend keeps the timestamps in a dict under a lock. It
+  is the default, for a single process, development and tests.
+
+Views are limited with the rate_limit decorator. DocumentConsumer checks each
+incoming message with check_async.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from . import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMIT = {
+    'BACKEND': 'hello.ratelimit.InMemoryRateLimitBackend',
+    'CONFIG': {},
+}
+
+# Limit name -> (requests, per seconds)
+DEFAULT_LIMITS = {
+    'signup': (5, 60),
+    'save_document': (100, 60),
+    'get_document': (100, 60),
+    'revert_version': (10, 60),
+    'export': (60, 60),
+    'document_message': (300, 10),
+}
+
+# allowed: whether the request may proceed; remaining: requests left right now;
+# retry_after: seconds until the next request would be allowed (0 if allowed)
+RateLimitResult = namedtuple('RateLimitResult', ['allowed', 'remaining', 'retry_after'])
+
+
+def get_limit(name):
+    limits = getattr(settings, 'RATE_LIMITS', {})
+    return limits.get(name, DEFAULT_LIMITS[name])
+
+
+class BaseRateLimitBackend:
+    """
+    Atomic rate limit checks keyed by limit name and client.
+    """
+
+    def check(self, name, key, cost=1):
+        """
+        Takes `cost` requests from the key's allowance if they are available.
+        Returns a RateLimitResult.
+        """
+        raise NotImplementedError
+
+    async def check_async(self, name, key, cost=1):
+        return await sync_to_async(self.check, thread_sensitive=False)(name, key, cost)
+
+
+class InMemoryRateLimitBackend(BaseRateLimitBackend):
+    """
+    Process-local rate limits.
+    """
+
+    def __init__(self, **kwargs):
+        self._full_at = {}
+        self._lock = threading.Lock()
+
+    def check(self, name, key, cost=1):
+        count, period = get_limit(name)
+        interval = period / count
+        now = time.monotonic()
+        with self._lock:
+            if len(self._full_at) > 10000:
+                self._expire(now)
+            full_at = max(self._full_at.get((name, key), now), now)
+            new_full_at = full_at + interval * cost
+            allowed_at = new_full_at - period
+            if allowed_at > now:
+                return RateLimitResult(False, 0, allowed_at - now)
+            self._full_at[(name, key)] = new_full_at
+        return RateLimitResult(True, int((now - allowed_at) / interval), 0)
+
+    async def check_async(self, name, key, cost=1):
+        # Never blocks, so no thread is needed
+        return self.check(name, key, cost)
+
+    def _expire(self, now):
+        for bucket in [bucket for bucket, full_at in self._full_at.items() if full_at <= now]:
+            del self._full_at[bucket]
+
+
+# Times are in milliseconds from the Redis clock, so every worker agrees on them
+_GCRA_SCRIPT = """
+redis.replicate_commands()
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + clock[2] / 1000
+local interval = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local full_at = math.max(tonumber(redis.call('GET', KEYS[1])) or now, now)
+local new_full_at = full_at + interval * cost
+local allowed_at = new_full_at - period
+if allowed_at > now then
+    return {0, 0, math.ceil(allowed_at - now)}
+end
+redis.call('SET', KEYS[1], string.format('%.3f', new_full_at), 'PX', math.ceil(new_full_at - now))
+return {1, math.floor((now - allowed_at) / interval), 0}
+"""
+
+
+class RedisRateLimitBackend(BaseRateLimitBackend):
+    """
+    Rate limits shared by all workers through Redis. Checks fail open when
+    Redis is unavailable.
+    """
+
+    # Seconds between warnings while Redis is unavailable
+    WARNING_INTERVAL = 60
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, prefix='ratelimit', **kwargs):
+        import redis
+        self.client = redis.Redis(host=host, port=port, db=db)
+        self.prefix = prefix
+        # Sent with EVALSHA, and loaded automatically the first time
+        self._script = self.client.register_script(_GCRA_SCRIPT)
+        self._redis_error = redis.RedisError
+        self._warned_at = None
+
+    def check(self, name, key, cost=1):
+        count, period = get_limit(name)
+        try:
+            allowed, remaining, retry_after_ms = self._script(
+                keys=[f'{self.prefix}:{name}:{key}'],
+                args=[period * 1000 / count, period * 1000, cost],
+            )
+        except self._redis_error as e:
+            self._warn(e)
+            return RateLimitResult(True, count, 0)
+        return RateLimitResult(bool(allowed), remaining, retry_after_ms / 1000)
+
+    def _warn(self, error):
+        now = time.monotonic()
+        if self._warned_at is None or now - self._warned_at >= self.WARNING_INTERVAL:
+            self._warned_at = now
+            logger.warning(f"Rate limits are not enforced, Redis is unavailable: {error}")
+
+
+_backend = None
+
+
+def get_rate_limiter():
+    """
+    Returns the configured rate limit backend, creating it on first use.
+    """
+    global _backend
+    if _backend is None:
+        config = getattr(settings, 'RATE_LIMIT', DEFAULT_RATE_LIMIT)
+        _backend = import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+    return _backend
+
+
+def client_key(request):
+    """
+    Identifies who a request counts against: the user when logged in,
+    otherwise the client address.
+    """
+    if request.user.is_authenticated:
+        return f'user:{request.user.id}'
+    return f'ip:{request.META.get("REMOTE_ADDR")}'
+
+
+def too_many_requests(request, result):
+    return HttpResponse("Too many requests. Please wait.", status=429)
+
+
+def rate_limit(name, methods=None, key=client_key, limited=too_many_requests):
+    """
+    View decorator that applies the `name` limit to requests with one of
+    `methods` (all methods by default). Requests over the limit get the
+    response of `limited(request, result)`, with a Retry-After header.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if methods is None or request.method in methods:
+                with tracing.span('rate_limit'):
+                    result = get_rate_limiter().check(name, key(request))
+                if not result.allowed:
+                    metrics.rate_limit_rejections.inc(name)
+                    response = limited(request, result)
+                    response['Retry-After'] = str(max(1, round(result.retry_after)))
+                    return response
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
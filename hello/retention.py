@@ -0,0 +1,226 @@
+"""
+Retention policy for document versions.
+
+VERSION_RETENTION is a list of (max_age, spacing) tiers in seconds, checked in
+order against a version's age. Inside a tier, only the newest version of
+every `spacing`-second window is kept (a spacing of 0 keeps everything); a
+max_age of None matches any age. Reverts and the latest version of each
+document are always kept, and count as the version kept for their window.
+
+Thinning rewrites the delta chains from hello.deltas as it goes: a kept
+version whose predecessor is dropped is re-encoded against the previous
+kept version, so every remaining version still rebuilds to the same content.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .deltas import make_delta, apply_delta
+from .models import DocumentVersion, VERSION_KEYFRAME_INTERVAL
+from .search import INDEX_VERSIONS, get_search_backend
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETENTION = [
+    (60 * 60, 0),            # Keep every version for an hour
+    (24 * 60 * 60, 10 * 60), # Then one per 10 minutes for a day
+    (None, 24 * 60 * 60),    # Then one per day
+]
+
+# Rows deleted per transaction, so the versions table is never locked for long
+DEFAULT_BATCH_SIZE = 500
+
+
+class CompactionReport:
+    """
+    Totals of a compaction run.
+    """
+
+    def __init__(self):
+        self.documents = 0
+        self.rows_deleted = 0
+        self.rows_rewritten = 0
+        self.bytes_reclaimed = 0
+
+    def add(self, other):
+        self.documents += other.documents
+        self.rows_deleted += other.rows_deleted
+        self.rows_rewritten += other.rows_rewritten
+        self.bytes_reclaimed += other.bytes_reclaimed
+
+    def __str__(self):
+        return (f"{self.rows_deleted} versions deleted and {self.rows_rewritten} re-encoded "
+                f"across {self.documents} documents, {self.bytes_reclaimed} bytes reclaimed")
+
+
+def get_policy():
+    return getattr(settings, 'VERSION_RETENTION', DEFAULT_RETENTION)
+
+
+def select_kept(versions, now=None, policy=None):
+    """
+    Returns the ids of versions to keep.
+    `versions` is an iterable of (id, timestamp, is_revert) tuples of one document.
+    """
+    now = now or timezone.now()
+    policy = policy or get_policy()
+    versions = sorted(versions, key=lambda v: (v[1], v[0]), reverse=True)
+
+    kept = set()
+    seen_windows = set()
+    for index, (version_id, timestamp, is_revert) in enumerate(versions):
+        if index == 0 or is_revert:
+            kept.add(version_id)
+
+        age = (now - timestamp).total_seconds()
+        for tier, (max_age, spacing) in enumerate(policy):
+            if max_age is None or age <= max_age:
+                break
+        else:
+            # Older than every tier: nothing to keep
+            continue
+
+        if not spacing:
+            kept.add(version_id)
+            continue
+
+        # Versions are visited newest first, so the first one seen per window wins;
+        # a revert or the latest version fills its window like any other
+        window = (tier, int(timestamp.timestamp() // spacing))
+        if window not in seen_windows:
+            seen_windows.add(window)
+            kept.add(version_id)
+    return kept
+
+
+def compact_document(document_id, now=None, policy=None, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+    """
+    Thins the versions of one document according to the retention policy.
+    """
+    report = CompactionReport()
+    versions = DocumentVersion.objects.filter(document_id=document_id)
+    metadata = list(versions.values_list('id', 'timestamp', 'is_revert'))
+    kept = select_kept(metadata, now, policy)
+    dropped_count = len(metadata) - len(kept)
+    if not dropped_count:
+        return report
+    # Versions saved while compacting were not considered by the policy and are left alone
+    versions = versions.filter(id__lte=max(version_id for version_id, _, _ in metadata))
+
+    report.documents = 1
+    if dry_run:
+        report.rows_deleted = dropped_count
+        return report
+
+    updates, deletes = [], []
+    content = ''
+    # Full content of the last kept version and the number of deltas stacked on the last kept keyframe
+    kept_content = None
+    run_length = 0
+    predecessor_kept = True
+
+    for version_id, is_keyframe, stored_content, delta in _iter_versions(versions, batch_size):
+        # Rebuild the full content of every version in order
+        content = stored_content if is_keyframe else apply_delta(content, delta)
+        old_size = len(stored_content) + len(delta)
+
+        if version_id not in kept:
+            deletes.append(version_id)
+            report.bytes_reclaimed += old_size
+            predecessor_kept = False
+            continue
+
+        if is_keyframe:
+            run_length = 0
+        elif predecessor_kept and kept_content is not None:
+            # Still diffed against the previous kept version; leave it alone
+            run_length += 1
+        else:
+            # The version it was diffed against is gone: re-encode against the previous kept one
+            if kept_content is None or run_length + 1 >= VERSION_KEYFRAME_INTERVAL:
+                new_content, new_delta, new_keyframe = content, '', True
+                run_length = 0
+            else:
+                new_content, new_delta, new_keyframe = '', make_delta(kept_content, content), False
+                run_length += 1
+            updates.append(DocumentVersion(id=version_id, content=new_content, delta=new_delta, is_keyframe=new_keyframe))
+            report.bytes_reclaimed += old_size - len(new_content) - len(new_delta)
+
+        kept_content = content
+        predecessor_kept = True
+
+        # Every later version diffs against a kept one, so the chain is consistent at this point
+        if len(deletes) >= batch_size:
+            _apply_batch(updates, deletes, report)
+            updates, deletes = [], []
+
+    _apply_batch(updates, deletes, report)
+    return report
+
+
+def compact_all(now=None, policy=None, batch_size=DEFAULT_BATCH_SIZE, dry_run=False, document_ids=None):
+    """
+    Thins the versions of every document (or of the given documents).
+    """
+    report = CompactionReport()
+    if document_ids is None:
+        document_ids = DocumentVersion.objects.values_list('document_id', flat=True).distinct()
+    for document_id in list(document_ids):
+        report.add(compact_document(document_id, now, policy, batch_size, dry_run))
+    return report
+
+
+def _iter_versions(versions, page_size):
+    # Page by id instead of holding a cursor open while batches are committed
+    last_id = 0
+    while True:
+        page = list(
+            versions.filter(id__gt=last_id).order_by('id')
+            .values_list('id', 'is_keyframe', 'content', 'delta')[:page_size]
+        )
+        if not page:
+            return
+        yield from page
+        last_id = page[-1][0]
+
+
+def _apply_batch(updates, deletes, report):
+    if not updates and not deletes:
+        return
+    with transaction.atomic():
+        if updates:
+            DocumentVersion.objects.bulk_update(updates, ['content', 'delta', 'is_keyframe'])
+        if deletes:
+            DocumentVersion.objects.filter(id__in=deletes).delete()
+            metrics.versions_deleted.inc(amount=len(deletes))
+            if INDEX_VERSIONS:
+                get_search_backend().remove_versions(deletes)
+    report.rows_rewritten += len(updates)
+    report.rows_deleted += len(deletes)
+
+
+def start_periodic_compaction(interval=None):
+    """
+    Runs compact_all in a daemon thread every VERSION_COMPACTION_INTERVAL
+    seconds. Does nothing when the setting is unset.
+    """
+    interval = interval or getattr(settings, 'VERSION_COMPACTION_INTERVAL', None)
+    if not interval:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                logger.info(f"Version compaction: {compact_all()}")
+            except Exception:
+                logger.exception("Version compaction failed")
+
+    thread = threading.Thread(target=run, name='version-compaction', daemon=True)
+    thread.start()
+    return thread
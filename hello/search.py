@@ -0,0 +1,287 @@
+"""
+Full-text search over the documents a user can access.
+
+The backend is pluggable through SEARCH_BACKEND:
+
+- SQLiteFTSBackend keeps FTS5 tables of document titles and tag-stripped
+  content, plus the content of each version when SEARCH_INDEX_VERSIONS is
+  on. Results are ranked by bm25, with title matches weighted higher.
+- BasicSearchBackend needs no index and runs substring queries on the
+  document table. It is the fallback on other databases.
+
+The index is maintained incrementally. Saving or deleting a Document
+updates it (signals connected in HelloConfig.ready). Content writes made
+with queryset updates are indexed by hello.persistence, and versions thinned
+by retention are removed by hello.retention. Access is checked when a query
+runs, against the owner column and the share table, so sharing or unsharing
+a document needs no reindexing.
+
+Results are paginated with an opaque cursor that continues after the last
+hit of the previous page.
+"""
+import html
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Exists, OuterRef, Q
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+
+from .blocks import document_content
+from .models import Document
+from .pagination import PAGE_SIZE
+
+# Index the content of every stored version, not only the current content
+INDEX_VERSIONS = getattr(settings, 'SEARCH_INDEX_VERSIONS', False)
+
+DOCUMENT_TABLE = 'hello_document_fts'
+VERSION_TABLE = 'hello_documentversion_fts'
+
+# Snippet highlight markers; replaced by <mark> once the snippet is escaped
+_MARK_START, _MARK_END = '\x02', '\x03'
+
+# Tags that end a word: line breaks and the edges of block elements
+_BLOCK_BOUNDARY = re.compile(
+    r'<(?:br|hr|/?(?:address|article|aside|blockquote|dd|div|dl|dt|figcaption|figure|footer|h[1-6]|header'
+    r'|li|main|nav|ol|p|pre|section|table|tbody|td|tfoot|th|thead|tr|ul))\b[^>]*>',
+    re.IGNORECASE,
+)
+
+
+def plain_text(content):
+    """
+    Returns the text of an HTML document, as indexed. Block elements and
+    line breaks are separated by a newline so their words stay apart.
+    """
+    return html.unescape(strip_tags(_BLOCK_BOUNDARY.sub('\n', content)))
+
+
+def match_expression(query):
+    """
+    Turns user input into an FTS5 query: every word must match, and the last
+    one may be a prefix (so results update while the user types).
+    Returns None if the input has no words.
+    """
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+class BaseSearchBackend:
+    """
+    Search index interface. Indexing methods are no-ops for backends that
+    query the document table directly.
+    """
+
+    def index_document(self, document_id, title, content):
+        pass
+
+    def index_content(self, document_id, content):
+        pass
+
+    def remove_document(self, document_id):
+        pass
+
+    def index_version(self, version_id, document_id, content):
+        pass
+
+    def remove_versions(self, version_ids):
+        pass
+
+    def search(self, user, query, cursor=None, size=PAGE_SIZE, include_versions=False):
+        """
+        Returns (hits, next_cursor) for one page of results, best first.
+        Each hit is a dict with id, title, snippet (HTML) and version_id (the
+        matching version, or None when the current content matched).
+        """
+        raise NotImplementedError
+
+
+class BasicSearchBackend(BaseSearchBackend):
+    """
+    Unranked substring search without an index, newest documents first.
+    """
+
+    def search(self, user, query, cursor=None, size=PAGE_SIZE, include_versions=False):
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return [], None
+
+        shared = Document.shared_with.through.objects.filter(document_id=OuterRef('pk'), user_id=user.id)
+        documents = Document.objects.filter(Q(owner_id=user.id) | Q(Exists(shared)))
+        for term in terms:
+            documents = documents.filter(Q(title__icontains=term) | Q(content__icontains=term))
+        if cursor and cursor.isdigit():
+            documents = documents.filter(pk__lt=int(cursor))
+
+        rows = list(documents.order_by('-pk').values('id', 'title')[:size + 1])
+        next_cursor = str(rows[size - 1]['id']) if len(rows) > size else None
+        hits = [dict(row, snippet='', version_id=None) for row in rows[:size]]
+        return hits, next_cursor
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """
+    Ranked search on SQLite FTS5 tables (created by migration 0009).
+    """
+
+    # bm25 weights of the title and body columns
+    TITLE_WEIGHT = 10.0
+    BODY_WEIGHT = 1.0
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    def _cursor(self):
+        return connections[self.using].cursor()
+
+    def index_document(self, document_id, title, content):
+        with self._cursor() as cursor:
+            cursor.execute(f'DELETE FROM {DOCUMENT_TABLE} WHERE rowid = %s', [document_id])
+            cursor.execute(
+                f'INSERT INTO {DOCUMENT_TABLE} (rowid, title, body) VALUES (%s, %s, %s)',
+                [document_id, title, plain_text(content)]
+            )
+
+    def index_content(self, document_id, content):
+        with self._cursor() as cursor:
+            cursor.execute(f'UPDATE {DOCUMENT_TABLE} SET body = %s WHERE rowid = %s', [plain_text(content), document_id])
+            if cursor.rowcount:
+                return
+        # Not indexed yet (e.g. created before the index existed)
+        title = Document.objects.filter(id=document_id).values_list('title', flat=True).first()
+        if title is not None:
+            self.index_document(document_id, title, content)
+
+    def remove_document(self, document_id):
+        with self._cursor() as cursor:
+            cursor.execute(f'DELETE FROM {DOCUMENT_TABLE} WHERE rowid = %s', [document_id])
+            cursor.execute(f'DELETE FROM {VERSION_TABLE} WHERE document_id = %s', [document_id])
+
+    def index_version(self, version_id, document_id, content):
+        with self._cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {VERSION_TABLE} (rowid, document_id, body) VALUES (%s, %s, %s)',
+                [version_id, document_id, plain_text(content)]
+            )
+
+    def remove_versions(self, version_ids):
+        version_ids = list(version_ids)
+        if not version_ids:
+            return
+        with self._cursor() as cursor:
+            placeholders = ', '.join(['%s'] * len(version_ids))
+            cursor.execute(f'DELETE FROM {VERSION_TABLE} WHERE rowid IN ({placeholders})', version_ids)
+
+    def search(self, user, query, cursor=None, size=PAGE_SIZE, include_versions=False):
+        expression = match_expression(query)
+        if expression is None:
+            return [], None
+
+        snippet_args = f"'{_MARK_START}', '{_MARK_END}', '…', 16"
+        params = [expression]
+        hits = (
+            f'SELECT rowid AS document_id, NULL AS version_id, '
+            f'bm25({DOCUMENT_TABLE}, {self.TITLE_WEIGHT}, {self.BODY_WEIGHT}) AS rank, '
+            f'snippet({DOCUMENT_TABLE}, 1, {snippet_args}) AS snippet '
+            f'FROM {DOCUMENT_TABLE} WHERE {DOCUMENT_TABLE} MATCH %s'
+        )
+        if include_versions:
+            hits += (
+                f' UNION ALL SELECT document_id, rowid, bm25({VERSION_TABLE}, 0.0, {self.BODY_WEIGHT}), '
+                f'snippet({VERSION_TABLE}, 1, {snippet_args}) '
+                f'FROM {VERSION_TABLE} WHERE {VERSION_TABLE} MATCH %s'
+            )
+            params.append(expression)
+
+        shared_table = Document.shared_with.through._meta.db_table
+        sql = (
+            # Materialized so bm25() and snippet() run in the full-text query, not the aggregate
+            f'WITH hits AS MATERIALIZED ({hits}), '
+            # SQLite takes the other columns from the row holding MIN(rank)
+            f'best AS (SELECT document_id, version_id, MIN(rank) AS rank, snippet FROM hits GROUP BY document_id) '
+            f'SELECT best.document_id, document.title, best.version_id, best.rank, best.snippet '
+            f'FROM best JOIN {Document._meta.db_table} AS document ON document.id = best.document_id '
+            f'WHERE (document.owner_id = %s OR EXISTS '
+            f'(SELECT 1 FROM {shared_table} AS share WHERE share.document_id = document.id AND share.user_id = %s))'
+        )
+        params += [user.id, user.id]
+
+        after = _parse_cursor(cursor)
+        if after is not None:
+            sql += ' AND (best.rank > %s OR (best.rank = %s AND best.document_id > %s))'
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY best.rank, best.document_id LIMIT %s'
+        params.append(size + 1)
+
+        with self._cursor() as db_cursor:
+            db_cursor.execute(sql, params)
+            rows = db_cursor.fetchall()
+
+        next_cursor = None
+        if len(rows) > size:
+            rows = rows[:size]
+            next_cursor = f'{rows[-1][3]!r}_{rows[-1][0]}'
+        hits = [
+            {
+                'id': document_id,
+                'title': title,
+                'snippet': _highlight(snippet),
+                'version_id': version_id,
+            }
+            for document_id, title, version_id, rank, snippet in rows
+        ]
+        return hits, next_cursor
+
+
+def _parse_cursor(cursor):
+    try:
+        rank, document_id = cursor.rsplit('_', 1)
+        return float(rank), int(document_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _highlight(snippet):
+    return html.escape(snippet or '').replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+_backend = None
+
+
+def get_search_backend():
+    """
+    Returns the configured search backend, creating it on first use. Without
+    SEARCH_BACKEND, FTS5 is used when its tables exist (SQLite with FTS5)
+    and BasicSearchBackend otherwise.
+    """
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'SEARCH_BACKEND', None)
+        if path is None:
+            path = 'hello.search.SQLiteFTSBackend' if _fts_tables_exist() else 'hello.search.BasicSearchBackend'
+        _backend = import_string(path)()
+    return _backend
+
+
+def _fts_tables_exist():
+    connection = connections['default']
+    return connection.vendor == 'sqlite' and DOCUMENT_TABLE in connection.introspection.table_names()
+
+
+def document_saved(sender, instance, **kwargs):
+    """
+    post_save handler for Document.
+    """
+    get_search_backend().index_document(instance.id, instance.title, document_content(instance))
+
+
+def document_deleted(sender, instance, **kwargs):
+    """
+    post_delete handler for Document.
+    """
+    get_search_backend().remove_document(instance.id)
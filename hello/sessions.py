@@ -0,0 +1,471 @@
+"""
+In-process state for documents that are being edited live.
+
+Every `document_<id>` group that has at least one connected consumer in this
+process gets a DocumentSession. The session holds the authoritative content
+and revision number, and a bounded history of committed operations that
+late-arriving client operations are transformed against.
+
+The revision numbers every change broadcast to the document's clients, and
+the session id tells one session's revisions from the next one's. A client
+that reconnects names the last revision it saw and is sent the history after
+it instead of a full snapshot. A session outlives its last connection by
+COLLAB_SESSION_LINGER seconds so a lone client can still do that.
+
+Sessions are write-behind buffers: edits only change memory, and a single
+flusher task per session writes the latest content to the database every
+COLLAB_FLUSH_INTERVAL seconds, or sooner once COLLAB_FLUSH_BYTES of edits
+have accumulated, however many clients are connected. Edits not flushed yet
+survive a crash in the session's journal (see hello.journal).
+
+Editors number the operation batches they send. A session remembers the last
+batch it committed from each client, and keeps that in the cache for
+COLLAB_BATCH_MEMORY seconds from each flush on. An editor whose acknowledgement
+was lost in a disconnect that outlasted the session learns from its next
+snapshot whether its batch made it, so it neither loses nor repeats it.
+
+With COLLAB_WORKERS set, a document's session only runs on the worker that
+owns it (see hello.sharding), but HTTP requests reach any worker. Each
+session then listens on a control channel in the `document_session_<id>`
+group. Another worker sends it content that was saved or reverted over HTTP
+('session.replace'), and asks it to flush before reading the document from
+the database ('session.flush').
+"""
+import asyncio
+import logging
+import uuid
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from . import framing, journal, metrics, ot
+from .blocks import load_content
+from .models import hash_content
+from .persistence import write_document_content_async
+from .presence import get_presence_backend
+from .sharding import channel_layer_alias, session_group, worker_url_for
+
+logger = logging.getLogger(__name__)
+
+# Number of committed operation lists kept for transforming stale client edits
+HISTORY_LIMIT = getattr(settings, 'COLLAB_HISTORY_LIMIT', 500)
+
+# Seconds between flushes of a session's content to the database
+FLUSH_INTERVAL = getattr(settings, 'COLLAB_FLUSH_INTERVAL', 5)
+
+# Size of edits (in characters) after which a session flushes early
+FLUSH_BYTES = getattr(settings, 'COLLAB_FLUSH_BYTES', 256 * 1024)
+
+# Seconds a session stays open after its last connection, for clients that reconnect
+SESSION_LINGER = getattr(settings, 'COLLAB_SESSION_LINGER', 30)
+
+# Seconds another worker waits for a session to flush before reading the database anyway
+REMOTE_FLUSH_TIMEOUT = getattr(settings, 'COLLAB_REMOTE_FLUSH_TIMEOUT', 2)
+
+# Seconds the last committed batch of each client is remembered after a flush
+BATCH_MEMORY = getattr(settings, 'COLLAB_BATCH_MEMORY', 24 * 60 * 60)
+
+# Maximum size of a document held in a live session (matches save_document)
+MAX_CONTENT_BYTES = 5 * 1024 * 1024
+
+
+class StaleRevision(Exception):
+    """
+    Raised when a client's base revision is older than the kept history; the
+    client has to resynchronize from a fresh snapshot.
+    """
+
+
+def _batches_key(document_id):
+    return f'collab_batches_{document_id}'
+
+
+def committed_batches(document_id):
+    """
+    Returns the last batch number committed from each client by earlier
+    sessions of the document.
+    """
+    return cache.get(_batches_key(document_id)) or {}
+
+
+def remember_batches(document_id, batches):
+    """
+    Keeps the last batch number committed from each client for the next
+    session of the document.
+    """
+    if batches:
+        cache.set(_batches_key(document_id), {**committed_batches(document_id), **batches}, BATCH_MEMORY)
+
+
+class DocumentSession:
+    """
+    Authoritative live state of a single document.
+    """
+
+    def __init__(self, document_id, content):
+        self.document_id = document_id
+        self.content = content
+        self.revision = 0
+        # Identifies this session's revisions to reconnecting clients
+        self.session_id = uuid.uuid4().hex[:12]
+        # (revision, ops, origin) entries; ops turn revision - 1 into revision, and
+        # origin is the (username, client id) that committed them, or None
+        self.history = deque(maxlen=HISTORY_LIMIT)
+        # Client id -> number of the last operation batch committed from it
+        self.batches = {}
+        self.channels = set()
+        self.last_editor_id = None
+        # Revision last written to the database and the edit volume since then
+        self.flushed_revision = 0
+        self.flushed_hash = hash_content(content)
+        self.pending_bytes = 0
+        self.flush_requested = asyncio.Event()
+        self.flusher = None
+        # Task closing the session once it has had no connection for SESSION_LINGER seconds
+        self.closer = None
+        # Control channel other workers reach the session on, and the task reading it
+        self.control_channel = None
+        self.listener = None
+        self._hashed = None
+
+    @property
+    def dirty(self):
+        return self.revision != self.flushed_revision
+
+    def hash_of(self, content):
+        """
+        Returns the hash of a content snapshot taken from this session,
+        remembering the last one since large documents are slow to hash.
+        """
+        cached = self._hashed
+        if cached is not None and cached[0] is content:
+            return cached[1]
+        content_hash = hash_content(content)
+        self._hashed = (content, content_hash)
+        return content_hash
+
+    def missed_since(self, revision):
+        """
+        Returns the history entries committed after `revision`, oldest first,
+        or None when they are no longer all kept.
+        """
+        missed = self.revision - revision
+        if revision < 0 or missed < 0 or missed > len(self.history):
+            return None
+        history = list(self.history)
+        return history[len(history) - missed:]
+
+    def commit(self, ops, base_revision, editor_id=None, origin=None, batch=None):
+        """
+        Commits normalized operations made against `base_revision`.
+        - Transforms them against everything committed since that revision.
+        - Applies them to the content and advances the revision.
+        - Records `batch`, the client's number for the operations, as the
+          last batch committed from the client in `origin`.
+        - Returns the transformed operations and the new revision.
+        """
+        if not isinstance(base_revision, int) or base_revision < 0 or base_revision > self.revision:
+            raise ot.OperationError("Invalid base revision.")
+
+        missed = self.revision - base_revision
+        if missed > len(self.history):
+            raise StaleRevision(base_revision)
+
+        # Committed operations win ties so every client converges on the same text
+        if missed:
+            for _, committed, _ in list(self.history)[-missed:]:
+                ops = ot.transform(ops, committed)
+
+        content = ot.apply(self.content, ops)
+        if len(content.encode('utf-8')) > MAX_CONTENT_BYTES:
+            raise ot.OperationError("Document too large. Maximum size is 5MB.")
+
+        size = sum(len(op['text']) if op['type'] == 'insert' else op['length'] for op in ops)
+        client_id = origin[1] if origin else None
+        if client_id is None or not isinstance(batch, int) or isinstance(batch, bool):
+            batch = None
+        self._advance(content, ops, editor_id, size, origin, batch)
+        return ops, self.revision
+
+    def replace(self, content, editor_id=None, origin=None):
+        """
+        Replaces the whole content (legacy 'edit' action) and records it as an
+        operation so concurrent operation-based clients still converge.
+        - Returns the length of the replaced content and the new revision.
+        """
+        if len(content.encode('utf-8')) > MAX_CONTENT_BYTES:
+            raise ot.OperationError("Document too large. Maximum size is 5MB.")
+
+        old_length = len(self.content)
+        self._advance(content, ot.replacement(old_length, content), editor_id, len(content), origin)
+        return old_length, self.revision
+
+    def _advance(self, content, ops, editor_id, size, origin, batch=None):
+        self.content = content
+        self.pending_bytes += size
+        self.revision += 1
+        self.history.append((self.revision, ops, origin))
+        if batch is not None:
+            self.batches[origin[1]] = batch
+        journal.record(self.document_id, self.revision, ops, editor_id, (origin[1], batch) if batch is not None else None)
+        if editor_id is not None:
+            self.last_editor_id = editor_id
+        if self.pending_bytes >= FLUSH_BYTES:
+            self.flush_requested.set()
+
+    async def flush(self):
+        """
+        Writes the current content to the database if it changed since the
+        last flush. Edits committed while the write is running stay dirty and
+        go out with the next flush.
+        """
+        if not self.dirty:
+            return False
+
+        revision, content, pending, batches = self.revision, self.content, self.pending_bytes, dict(self.batches)
+        content_hash = self.hash_of(content)
+        # Replay after a crash has to know which content reached the database
+        await journal.checkpoint(self.document_id, revision, content_hash)
+        stored = False
+        # Edits that cancel out since the last flush leave nothing to write
+        if content_hash != self.flushed_hash:
+            stored = await write_document_content_async(self.document_id, content, self.last_editor_id)
+            self.flushed_hash = content_hash
+        # The batches outlive the journal records compacted below
+        await sync_to_async(remember_batches, thread_sensitive=False)(self.document_id, batches)
+        self.flushed_revision = revision
+        self.pending_bytes = max(0, self.pending_bytes - pending)
+        journal.compact(self.document_id, revision, content_hash)
+        return stored
+
+    async def run_flusher(self):
+        """
+        Flushes the session periodically, or early when enough edits build up.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception(f"Failed to flush live session of document {self.document_id}")
+
+
+class SessionRegistry:
+    """
+    Tracks the live sessions of this process, keyed by document id.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = asyncio.Lock()
+
+    def get(self, document_id):
+        return self._sessions.get(int(document_id))
+
+    def document_ids(self):
+        return list(self._sessions)
+
+    async def replace_content(self, document_id, content, user, stored=False):
+        """
+        Pushes content written outside the WebSocket (HTTP save or revert)
+        into a live session and broadcasts it to the document's group.
+        - `stored` marks content that is already in the database, so the
+          flusher does not write it a second time.
+        - Returns the new revision, or None when the document is not live.
+        """
+        session = self.get(document_id)
+        if session is None:
+            return None
+
+        replaced_length, revision = session.replace(content, user.id, origin=(user.username, None))
+        if stored:
+            session.flushed_revision = revision
+            session.flushed_hash = hash_content(content)
+            session.pending_bytes = 0
+            journal.compact(session.document_id, revision, session.flushed_hash)
+
+        await metrics.group_send(
+            get_channel_layer(),
+            f'document_{session.document_id}',
+            {
+                'type': 'document_update',
+                'content': content,
+                'cursor_position': None,
+                'user': user.username,
+                'revision': revision,
+                'replaced_length': replaced_length,
+                'frame_id': framing.new_frame_id(),
+            }
+        )
+        return revision
+
+    async def recover_journal(self, document_id):
+        """
+        Stores the edits journaled by a crashed session of a document that
+        has no live session, and deletes the journal. HTTP saves and reverts
+        call this first so they neither write over those edits nor have them
+        replayed over their own content later.
+        - Does nothing for documents another worker owns.
+        - Returns True if journaled edits changed the stored content.
+        """
+        document_id = int(document_id)
+        if not journal.exists(document_id) or worker_url_for(document_id) is not None:
+            return False
+        async with self._lock:
+            if document_id in self._sessions:
+                return False
+            content = await sync_to_async(load_content, thread_sensitive=False)(document_id)
+            recovered, batches = await journal.recover(document_id, content)
+            await sync_to_async(remember_batches, thread_sensitive=False)(document_id, batches)
+            journal.discard(document_id)
+            return recovered != content
+
+    async def forward_content(self, document_id, content, user):
+        """
+        Hands content that was just stored over HTTP to the document's live
+        session when another worker owns the document. The session takes
+        it like a local save and flushes at once, in case it wrote its older
+        content over the stored one in the meantime. Does nothing when this
+        worker owns the document.
+        """
+        if worker_url_for(document_id) is None:
+            return
+        layer = get_channel_layer(channel_layer_alias(document_id))
+        await layer.group_send(session_group(document_id), {
+            'type': 'session.replace',
+            'content': content,
+            'user_id': user.id,
+            'username': user.username,
+        })
+
+    async def flush_remote(self, document_ids):
+        """
+        Asks the sessions of documents owned by other workers to flush, and
+        waits until they did (or REMOTE_FLUSH_TIMEOUT passed), so reading
+        the database afterwards sees their latest content. Documents with
+        nobody connected have nothing unflushed and are skipped.
+        - Returns True if any session was asked to flush.
+        """
+        remote = [document_id for document_id in document_ids if worker_url_for(document_id) is not None]
+        if not remote:
+            return False
+        return any(await asyncio.gather(*(self._flush_remote(document_id) for document_id in remote)))
+
+    async def _flush_remote(self, document_id):
+        participants = await sync_to_async(get_presence_backend().participants, thread_sensitive=False)(document_id)
+        if not participants:
+            return False
+        layer = get_channel_layer(channel_layer_alias(document_id))
+        reply_channel = await layer.new_channel()
+        await layer.group_send(session_group(document_id), {'type': 'session.flush', 'reply_channel': reply_channel})
+        try:
+            await asyncio.wait_for(layer.receive(reply_channel), REMOTE_FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Live session of document {document_id} did not flush within {REMOTE_FLUSH_TIMEOUT}s")
+        return True
+
+    async def _listen(self, session, layer):
+        # Handles control messages from other workers until the session closes
+        while True:
+            message = await layer.receive(session.control_channel)
+            try:
+                if message['type'] == 'session.replace':
+                    user = User(id=message['user_id'], username=message['username'])
+                    await self.replace_content(session.document_id, message['content'], user)
+                    session.flush_requested.set()
+                elif message['type'] == 'session.flush':
+                    await session.flush()
+                    await layer.send(message['reply_channel'], {'type': 'session.flushed'})
+            except Exception:
+                logger.exception(f"Failed to handle {message.get('type')} for document {session.document_id}")
+
+    async def join(self, document_id, channel_name, load_content):
+        """
+        Registers a channel with a document's session, creating the session
+        on first use. `load_content` is an awaitable factory for the stored
+        content and is only called when the session does not exist yet.
+        - Edits journaled by a session that crashed are replayed and stored
+          before the new session starts.
+        """
+        document_id = int(document_id)
+        async with self._lock:
+            session = self._sessions.get(document_id)
+            if session is not None and session.closer is not None:
+                # A client came back while the session was lingering
+                session.closer.cancel()
+                session.closer = None
+            if session is None:
+                content, recovered = await journal.recover(document_id, await load_content())
+                session = DocumentSession(document_id, content)
+                batches = await sync_to_async(committed_batches, thread_sensitive=False)(document_id)
+                session.batches = {**batches, **recovered}
+                journal.start(document_id, session.flushed_hash)
+                session.flusher = asyncio.ensure_future(session.run_flusher())
+                if getattr(settings, 'COLLAB_WORKERS', None):
+                    layer = get_channel_layer(channel_layer_alias(document_id))
+                    session.control_channel = await layer.new_channel()
+                    await layer.group_add(session_group(document_id), session.control_channel)
+                    session.listener = asyncio.ensure_future(self._listen(session, layer))
+                self._sessions[document_id] = session
+            session.channels.add(channel_name)
+            return session
+
+    async def leave(self, document_id, channel_name):
+        """
+        Removes a channel from a document's session.
+        - When it was the last channel, writes any unflushed content. The
+          session is closed after SESSION_LINGER seconds unless a client
+          joins again, or right away when SESSION_LINGER is 0.
+        - Returns (session, closed) where `closed` is True once the session
+          has been dropped from the registry.
+        """
+        document_id = int(document_id)
+        async with self._lock:
+            session = self._sessions.get(document_id)
+            if session is None:
+                return None, False
+            session.channels.discard(channel_name)
+            if session.channels:
+                return session, False
+
+            if not SESSION_LINGER:
+                await self._close(document_id, session)
+                return session, True
+            try:
+                await session.flush()
+            finally:
+                session.closer = asyncio.ensure_future(self._close_idle(document_id, session))
+            return session, False
+
+    async def _close_idle(self, document_id, session):
+        await asyncio.sleep(SESSION_LINGER)
+        async with self._lock:
+            if self._sessions.get(document_id) is session and not session.channels:
+                session.closer = None
+                await self._close(document_id, session)
+
+    async def _close(self, document_id, session):
+        # Stops the flusher, writes any unflushed content and drops the session
+        session.flusher.cancel()
+        if session.listener is not None:
+            session.listener.cancel()
+            layer = get_channel_layer(channel_layer_alias(document_id))
+            await layer.group_discard(session_group(document_id), session.control_channel)
+        try:
+            await session.flush()
+            # Everything journaled is stored; a failed flush keeps the journal for replay
+            journal.discard(document_id)
+        finally:
+            del self._sessions[document_id]
+
+
+# Process-wide registry shared by all consumers
+registry = SessionRegistry()
@@ -0,0 +1,240 @@
+"""
+Document affinity: spreading document groups over several channel layers
+and live sessions over several workers.
+
+Each shard is an ordinary entry in CHANNEL_LAYERS (usually one Redis
+instance). The default layer is a ShardedChannelLayer that lists them:
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'hello.sharding.ShardedChannelLayer',
+            'CONFIG': {'shards': ['shard-0', 'shard-1']},
+        },
+        'shard-0': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [('127.0.0.1', 6379)]}},
+        'shard-1': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [('127.0.0.1', 6380)]}},
+    }
+
+Group names are placed on a consistent hash ring, so adding or removing a
+shard only moves about 1/N of the documents. DocumentConsumer opens its
+channel directly on the shard of its document's group, which keeps the
+group's members and its messages on the same instance. Any layer works as a
+shard, including channels.layers.InMemoryChannelLayer for tests.
+
+ShardedChannelLayer.reshard() switches to a new shard list at runtime. The
+list is published in the default cache, and every worker's layer picks it up
+within COLLAB_SHARD_CHECK_INTERVAL seconds and closes its connections to the
+documents that moved. The cache therefore has to be shared by the workers.
+A published list only applies while the workers are configured with the
+shard list it replaced, so a redeploy with new CHANNEL_LAYERS wins over it.
+
+A live DocumentSession lives in one process. When COLLAB_WORKERS maps
+worker ids to WebSocket base URLs, each document is owned by the worker
+chosen by the same kind of ring. A connection that reaches another worker
+is redirected to the owner, so edits to a document are never split between
+two diverging sessions. The current worker's id comes from COLLAB_WORKER_ID
+(or the COLLAB_WORKER_ID environment variable).
+"""
+import asyncio
+import bisect
+import hashlib
+import os
+import time
+
+from channels.layers import BaseChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+
+# Virtual nodes per shard or worker on a hash ring
+RING_REPLICAS = 128
+
+# Seconds between checks for a shard list published by another worker's reshard()
+SHARD_CHECK_INTERVAL = getattr(settings, 'COLLAB_SHARD_CHECK_INTERVAL', 1)
+
+# Cache key of the shard list published by reshard()
+SHARDS_CACHE_KEY = 'collab_channel_layer_shards'
+
+# Close code sent to clients that must reconnect elsewhere
+MOVED_CLOSE_CODE = 4009
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to nodes.
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        if not nodes:
+            raise ValueError('A hash ring needs at least one node')
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        points = sorted(
+            (_hash(f'{node}#{replica}'), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+    def moved(self, other, keys):
+        """
+        Returns the keys that map to a different node on `other`.
+        """
+        return [key for key in keys if self.node_for(key) != other.node_for(key)]
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def document_group(document_id):
+    return f'document_{document_id}'
+
+
+def session_group(document_id):
+    # Control channel of the document's live session, on the same shard as its group
+    return f'document_session_{document_id}'
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """
+    Channel layer that routes each group to one of several shard layers.
+
+    - Group operations go to the shard that owns the group name.
+    - Channels created through this layer carry their shard's alias as the
+      first name segment, and sends to them are routed by it. Other channel
+      names are placed on the ring like groups.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, shards, replicas=RING_REPLICAS, **kwargs):
+        super().__init__(**kwargs)
+        self.replicas = replicas
+        self.configured = list(shards)
+        self.ring = HashRing(shards, replicas)
+        self._checked = time.monotonic()
+
+    @property
+    def shards(self):
+        return self.ring.nodes
+
+    def alias_for(self, name):
+        """
+        Returns the CHANNEL_LAYERS alias of the shard owning a group or channel.
+        """
+        self._sync_ring()
+        alias = name.split('.', 1)[0]
+        if alias in self.ring.nodes:
+            return alias
+        return self.ring.node_for(name)
+
+    def layer_for(self, name):
+        layer = get_channel_layer(self.alias_for(name))
+        if layer is None:
+            raise ValueError(f'Shard {self.alias_for(name)!r} is not in CHANNEL_LAYERS')
+        return layer
+
+    async def send(self, channel, message):
+        await self.layer_for(channel).send(channel, message)
+
+    async def receive(self, channel):
+        return await self.layer_for(channel).receive(channel)
+
+    async def new_channel(self, prefix='specific.'):
+        self._sync_ring()
+        alias = self.ring.node_for(prefix)
+        return await get_channel_layer(alias).new_channel(f'{alias}.{prefix}')
+
+    async def group_add(self, group, channel):
+        await self.layer_for(group).group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await self.layer_for(group).group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        await self.layer_for(group).group_send(group, message)
+
+    async def flush(self):
+        for alias in self.shards:
+            layer = get_channel_layer(alias)
+            if hasattr(layer, 'flush'):
+                await layer.flush()
+
+    async def reshard(self, shards, groups=None):
+        """
+        Switches every worker's ring to a new list of shards.
+        - The list is published in the cache for the other workers, which
+          switch on their next check.
+        - Members of `groups` (by default, the groups of this process's live
+          sessions) that now belong to another shard are told on their old
+          shard with a 'shard.moved' message. Consumers close those
+          connections and clients reconnect on the new shard.
+        - Returns the groups that moved.
+        """
+        cache.set(SHARDS_CACHE_KEY, {'configured': self.configured, 'shards': list(shards)}, None)
+        old_ring = self.ring
+        self.ring = HashRing(shards, self.replicas)
+        return await self._announce_moved(old_ring, groups)
+
+    def _sync_ring(self):
+        # Follows a shard list published by reshard() in another worker
+        now = time.monotonic()
+        if now - self._checked < SHARD_CHECK_INTERVAL:
+            return
+        self._checked = now
+        published = cache.get(SHARDS_CACHE_KEY)
+        if not published or published['configured'] != self.configured or published['shards'] == self.ring.nodes:
+            return
+        old_ring = self.ring
+        self.ring = HashRing(published['shards'], self.replicas)
+        try:
+            asyncio.get_running_loop().create_task(self._announce_moved(old_ring))
+        except RuntimeError:
+            # No event loop in this thread, so no live sessions to move either
+            pass
+
+    async def _announce_moved(self, old_ring, groups=None):
+        if groups is None:
+            from .sessions import registry
+            groups = [document_group(document_id) for document_id in registry.document_ids()]
+        moved = old_ring.moved(self.ring, groups)
+        for group in moved:
+            await get_channel_layer(old_ring.node_for(group)).group_send(group, {'type': 'shard.moved'})
+        return moved
+
+
+def channel_layer_alias(document_id, alias='default'):
+    """
+    Returns the CHANNEL_LAYERS alias a document's consumers should use: the
+    owning shard when `alias` is sharded, otherwise `alias` itself.
+    """
+    layer = get_channel_layer(alias)
+    if isinstance(layer, ShardedChannelLayer):
+        return layer.alias_for(document_group(document_id))
+    return alias
+
+
+_worker_ring = None
+
+
+def worker_url_for(document_id):
+    """
+    Returns the WebSocket base URL of the worker owning a document, or None
+    when this worker owns it or documents are not pinned to workers.
+    """
+    global _worker_ring
+    workers = getattr(settings, 'COLLAB_WORKERS', None)
+    if not workers:
+        return None
+    if _worker_ring is None or _worker_ring.nodes != list(workers):
+        _worker_ring = HashRing(list(workers))
+
+    owner = _worker_ring.node_for(document_group(document_id))
+    current = getattr(settings, 'COLLAB_WORKER_ID', None) or os.environ.get('COLLAB_WORKER_ID')
+    if owner == current:
+        return None
+    return workers[owner]
@@ -1,6 +1,8 @@
 (function(docId, currentUser) {
     const editor = document.getElementById('editor');
     const typingIndicator = document.getElementById('typing-indicator');
+    const participantList = document.getElementById('participants');
+    const cursorOverlay = document.getElementById('cursor-overlay');
     let isUpdating = false;
     const cursors = {};
 
@@ -13,7 +15,7 @@
         return `hsl(${hash % 360}, 75%, 50%)`;
     }
 
-    // Function to load the document content from the server
+    // Loads the document over HTTP; only used when the WebSocket never delivered a snapshot
     function loadDocumentContent(docId) {
         fetch(`/documents/${docId}/`)
             .then(response => {
@@ -23,8 +25,13 @@
                 return response.json();
             })
             .then(data => {
-                editor.innerHTML = data.content || ''; // Set the editor's content
-                console.log('Document content loaded:', data.content);
+                // The WebSocket snapshot is authoritative once it has arrived
+                if (!loaded || truncated) {
+                    setEditorContent(data.content || ''); // Set the editor's content
+                    loaded = true;
+                    truncated = false;
+                    editor.contentEditable = 'true';
+                }
                 setupAutosave(); // Initialize autosave after loading content
             })
             .catch(error => {
@@ -32,27 +39,344 @@
             });
     }
 
+    // Revision of the server state the local operations are based on
+    let revision = null;
+    // Editor content as of the last local diff, including unacknowledged edits
+    let shadow = '';
+    // Whether the editor has received the whole document at least once
+    let loaded = false;
+    // Snapshot still arriving in chunks: { revision, remaining, committed }
+    let pendingSnapshot = null;
+    // Set while the editor shows only the start of a snapshot, even after its
+    // connection dropped; such content must never be saved
+    let truncated = false;
+    // Operations sent to the server and not yet acknowledged
+    let outstanding = null;
+    // Number of the outstanding batch; resending it keeps the number, and a
+    // snapshot names the last batch the server committed
+    let batch = 0;
+    // Local operations waiting for the outstanding ones to be acknowledged
+    let buffer = [];
+    // Server session the revision belongs to; a reconnect resumes from it
+    let sessionId = null;
+    // Set while the changes missed during a disconnect are applied
+    let replaying = false;
+    // Content at `revision` as the server has it, without our unacknowledged operations
+    let serverText = '';
+    // Local edits the server never acknowledged, kept while a snapshot replaces
+    // the content: { base, text, outstanding, batch }
+    let unsaved = null;
+    // Identifies this editor to the server, which acknowledges its operations on resume
+    const clientId = window.crypto && crypto.randomUUID
+        ? crypto.randomUUID()
+        : Math.random().toString(36).slice(2) + Date.now().toString(36);
+
+    // Returns the code point index of a UTF-16 offset, which is what the server counts
+    function toCodePoints(text, offset) {
+        const head = text.slice(0, offset);
+        if (!/[\uD800-\uDFFF]/.test(head)) return offset;
+        return Array.from(head).length;
+    }
+
+    // Returns the UTF-16 offset of a code point index
+    function toCodeUnits(text, index) {
+        if (!/[\uD800-\uDFFF]/.test(text)) return index;
+        let offset = 0;
+        for (let i = 0; i < index && offset < text.length; i++) {
+            offset += text.codePointAt(offset) > 0xFFFF ? 2 : 1;
+        }
+        return offset;
+    }
+
+    // Describes the change between two strings as delete/insert operations
+    function diffOperations(oldText, newText) {
+        let start = 0;
+        const minLength = Math.min(oldText.length, newText.length);
+        while (start < minLength && oldText[start] === newText[start]) start++;
+
+        let oldEnd = oldText.length;
+        let newEnd = newText.length;
+        while (oldEnd > start && newEnd > start && oldText[oldEnd - 1] === newText[newEnd - 1]) {
+            oldEnd--;
+            newEnd--;
+        }
+
+        // Never split a surrogate pair between the common prefix and the change
+        if (start > 0 && /[\uD800-\uDBFF]/.test(oldText[start - 1])) start--;
+
+        const ops = [];
+        const pos = toCodePoints(oldText, start);
+        const removed = toCodePoints(oldText, Math.max(oldEnd, start)) - pos;
+        if (removed > 0) ops.push({ type: 'delete', pos: pos, length: removed });
+        if (newEnd > start) ops.push({ type: 'insert', pos: pos, text: newText.slice(start, newEnd) });
+        return ops;
+    }
+
+    // Applies server operations (code point positions) to a string
+    function applyOperations(text, ops) {
+        for (const op of ops) {
+            const pos = toCodeUnits(text, op.pos);
+            if (op.type === 'insert') {
+                text = text.slice(0, pos) + op.text + text.slice(pos);
+            } else {
+                const end = toCodeUnits(text, op.pos + op.length);
+                text = text.slice(0, pos) + text.slice(end);
+            }
+        }
+        return text;
+    }
+
+    // Transforms two operation lists made against the same state (mirrors hello/ot.py)
+    function transformPair(a, b, aWins) {
+        if (!a.length || !b.length) return [a.slice(), b.slice()];
+        if (a.length > 1) {
+            const mid = Math.floor(a.length / 2);
+            const [a1, b1] = transformPair(a.slice(0, mid), b, aWins);
+            const [a2, b2] = transformPair(a.slice(mid), b1, aWins);
+            return [a1.concat(a2), b2];
+        }
+        if (b.length > 1) {
+            const mid = Math.floor(b.length / 2);
+            const [a1, b1] = transformPair(a, b.slice(0, mid), aWins);
+            const [a2, b2] = transformPair(a1, b.slice(mid), aWins);
+            return [a2, b1.concat(b2)];
+        }
+        return transformSingle(a[0], b[0], aWins);
+    }
+
+    function transformSingle(a, b, aWins) {
+        if (a.type === 'insert' && b.type === 'insert') {
+            const aLength = Array.from(a.text).length;
+            const bLength = Array.from(b.text).length;
+            if (a.pos < b.pos || (a.pos === b.pos && aWins)) {
+                return [[a], [{ type: 'insert', pos: b.pos + aLength, text: b.text }]];
+            }
+            return [[{ type: 'insert', pos: a.pos + bLength, text: a.text }], [b]];
+        }
+        if (a.type === 'insert') return transformInsertDelete(a, b);
+        if (b.type === 'insert') {
+            const [bOut, aOut] = transformInsertDelete(b, a);
+            return [aOut, bOut];
+        }
+        return [transformDeleteDelete(a, b), transformDeleteDelete(b, a)];
+    }
+
+    function transformInsertDelete(ins, del) {
+        const start = del.pos;
+        const end = start + del.length;
+        const size = Array.from(ins.text).length;
+        if (ins.pos <= start) {
+            return [[ins], [{ type: 'delete', pos: start + size, length: del.length }]];
+        }
+        if (ins.pos >= end) {
+            return [[{ type: 'insert', pos: ins.pos - del.length, text: ins.text }], [del]];
+        }
+        const head = ins.pos - start;
+        return [
+            [{ type: 'insert', pos: start, text: ins.text }],
+            [{ type: 'delete', pos: start, length: head }, { type: 'delete', pos: start + size, length: del.length - head }],
+        ];
+    }
+
+    function transformDeleteDelete(a, b) {
+        const aEnd = a.pos + a.length;
+        const bEnd = b.pos + b.length;
+        const overlap = Math.max(0, Math.min(aEnd, bEnd) - Math.max(a.pos, b.pos));
+        const length = a.length - overlap;
+        if (!length) return [];
+        const removedBefore = Math.max(0, Math.min(bEnd, a.pos) - b.pos);
+        return [{ type: 'delete', pos: a.pos - removedBefore, length: length }];
+    }
+
+    // Replaces the editor content while keeping the local caret where it was
+    function setEditorContent(html) {
+        const position = getCursorPosition();
+        isUpdating = true;
+        editor.innerHTML = html;
+        isUpdating = false;
+        shadow = editor.innerHTML;
+        if (position) {
+            try {
+                const node = getNodeFromPath(position.path);
+                if (node) {
+                    const range = document.createRange();
+                    range.setStart(node, Math.min(position.offset, node.length ?? node.childNodes.length));
+                    range.collapse(true);
+                    const selection = window.getSelection();
+                    selection.removeAllRanges();
+                    selection.addRange(range);
+                }
+            } catch (error) {
+                // The old caret position no longer exists; leave the caret where the browser put it
+            }
+        }
+    }
+
+    // Sends the outstanding operations to the server
+    function sendOutstanding() {
+        sendMessage({
+            action: 'operation',
+            revision: revision,
+            ops: outstanding,
+            batch: batch,
+        });
+    }
+
+    // Applies operations committed by another user
+    function receiveOperations(ops) {
+        serverText = applyOperations(serverText, ops);
+        if (outstanding) {
+            [ops, outstanding] = transformPair(ops, outstanding, true);
+            [ops, buffer] = transformPair(ops, buffer, true);
+        }
+        setEditorContent(applyOperations(editor.innerHTML, ops));
+    }
+
     // WebSocket setup to handle real-time collaboration
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const socket = new WebSocket(`${protocol}//${window.location.host}/ws/documents/${docId}/`);
+    // MessagePack framing is offered when the decoder and DecompressionStream are available
+    const codec = window.MessagePack && window.DecompressionStream ? window.MessagePack : null;
+    const FLAG_DEFLATE = 0x01;
+    // Close codes after which we reconnect: too slow (4008), document moved (4009)
+    const RECONNECT_CODES = [4008, 4009];
+    // Close codes of a dropped network connection, after which we reconnect with backoff
+    const DROPPED_CODES = [1001, 1006];
+    const MAX_RECONNECT_DELAY = 30000;
+    const MAX_RECONNECT_ATTEMPTS = 6;
+    let socketBase = `${protocol}//${window.location.host}`;
+    let socket = null;
+    // Failed reconnects in a row, for the backoff
+    let reconnectAttempts = 0;
+    // Set once we stop reconnecting and fall back to saving over HTTP
+    let socketClosed = false;
+
+    // Sends a message in the encoding the server picked
+    function sendMessage(message) {
+        // While reconnecting, outstanding operations are kept and sent again on resume
+        if (!socket || socket.readyState !== WebSocket.OPEN) return;
+        if (socket.protocol === 'collab.msgpack') {
+            const body = codec.encode(message);
+            const frame = new Uint8Array(body.length + 1);
+            frame.set(body, 1);
+            socket.send(frame);
+        } else {
+            socket.send(JSON.stringify(message));
+        }
+    }
 
-    // WebSocket open event - connection established
-    socket.onopen = () => {
-        console.log('WebSocket connection established');
-    };
+    // Decodes a text (JSON) or binary (flag byte + MessagePack) frame
+    async function decodeMessage(data) {
+        if (typeof data === 'string') return JSON.parse(data);
+        let body = new Uint8Array(data, 1);
+        if (new Uint8Array(data)[0] & FLAG_DEFLATE) {
+            const stream = new Blob([body]).stream().pipeThrough(new DecompressionStream('deflate'));
+            body = new Uint8Array(await new Response(stream).arrayBuffer());
+        }
+        return codec.decode(body);
+    }
 
-    // WebSocket message event - handle incoming updates
-    socket.onmessage = (event) => {
-        const data = JSON.parse(event.data);
+    // Keep our presence alive; the server expires members that stop heartbeating
+    const heartbeat = setInterval(() => {
+        if (socket.readyState === WebSocket.OPEN) {
+            sendMessage({ action: 'heartbeat' });
+        }
+    }, 20000);
+
+    // Function to show the users currently connected to the document
+    function renderParticipants(participants) {
+        participantList.innerHTML = '';
+        participants.forEach(username => {
+            const badge = document.createElement('span');
+            badge.className = 'badge';
+            badge.style.backgroundColor = getColorForUser(username);
+            badge.textContent = username === currentUser ? `${username} (you)` : username;
+            participantList.appendChild(badge);
+        });
+    }
 
-        if (data.action === 'edit') {
-            const { content, user, cursorPosition } = data;
+    // Incoming frames are decoded and handled in arrival order
+    let received = Promise.resolve();
 
-            // Update editor content only if it's not being typed locally
-            if (!isUpdating && editor.innerHTML !== content) {
-                isUpdating = true;
-                editor.innerHTML = content;
-                isUpdating = false;
+    // Handles one incoming update
+    function handleMessage(data) {
+        if (data.action === 'snapshot') {
+            // Authoritative content; unacknowledged local edits are rebased onto it once it is complete
+            if (revision !== null && (outstanding || buffer.length) && !unsaved) {
+                unsaved = { base: serverText, text: editor.innerHTML, outstanding: outstanding, batch: batch };
+            }
+            revision = null;
+            outstanding = null;
+            buffer = [];
+            sessionId = data.session || null;
+            setEditorContent(data.content || '');
+            if (data.chunks > 1) {
+                // Show the start now and hold editing until the rest has arrived
+                pendingSnapshot = { revision: data.revision, remaining: data.chunks - 1, committed: data.committed };
+                truncated = true;
+                editor.contentEditable = 'false';
+            } else {
+                finishSnapshot(data.revision, data.committed);
+            }
+        } else if (data.action === 'snapshot_chunk') {
+            if (!pendingSnapshot || pendingSnapshot.revision !== data.revision) return;
+            isUpdating = true;
+            editor.insertAdjacentHTML('beforeend', data.content);
+            isUpdating = false;
+            if (--pendingSnapshot.remaining === 0) finishSnapshot(pendingSnapshot.revision, pendingSnapshot.committed);
+        } else if (data.action === 'resume') {
+            // Only the changes committed while we were disconnected, oldest first
+            replaying = true;
+            try {
+                data.messages.forEach(handleMessage);
+            } finally {
+                replaying = false;
+            }
+            revision = data.revision;
+            editor.contentEditable = 'true';
+            // Operations the server never received go out again against the current revision
+            if (outstanding) sendOutstanding();
+        } else if (data.action === 'ack') {
+            // Our outstanding operations were committed
+            revision = data.revision;
+            if (outstanding) serverText = applyOperations(serverText, outstanding);
+            outstanding = buffer.length ? buffer : null;
+            buffer = [];
+            if (outstanding) batch++;
+            if (outstanding && !replaying) sendOutstanding();
+        } else if (data.action === 'operation') {
+            revision = data.revision;
+            receiveOperations(data.ops);
+            showUserTypingIndicator(data.user);
+        } else if (data.action === 'rate_limited') {
+            // The server dropped our operations; send them again once allowed
+            if (outstanding && data.action_dropped === 'operation') {
+                setTimeout(() => { if (outstanding) sendOutstanding(); }, data.retry_after * 1000);
+            }
+        } else if (data.action === 'redirect') {
+            // Another worker serves this document; reconnect there once the server closes
+            socketBase = data.url.replace(/\/$/, '');
+        } else if (data.action === 'presence') {
+            renderParticipants(data.participants);
+        } else if (data.action === 'activity') {
+            // One batched frame of other users' cursors, typing and presence
+            data.cursors.forEach(({ user, position }) => {
+                if (position) updateCursor(user, position);
+            });
+            data.typing.forEach(showUserTypingIndicator);
+            if (data.participants) renderParticipants(data.participants);
+        } else if (data.action === 'edit') {
+            const { content, user, cursor_position: cursorPosition } = data;
+
+            if (data.revision != null && revision != null) {
+                // Legacy full-content edit recorded by the server as a replacement
+                revision = data.revision;
+                const ops = [];
+                if (data.replaced_length) ops.push({ type: 'delete', pos: 0, length: data.replaced_length });
+                if (content) ops.push({ type: 'insert', pos: 0, text: content });
+                receiveOperations(ops);
+            } else if (!isUpdating && editor.innerHTML !== content) {
+                // Update editor content only if it's not being typed locally
+                setEditorContent(content);
             }
 
             // Update cursor position for the user
@@ -63,30 +387,134 @@
             // Show typing indicator for the user
             showUserTypingIndicator(user);
         }
-    };
+    }
+
+    // The whole snapshot is in the editor; local edits are based on its revision from now on.
+    // `committed` is the number of our last batch the server committed, if any
+    function finishSnapshot(snapshotRevision, committed) {
+        pendingSnapshot = null;
+        truncated = false;
+        revision = snapshotRevision;
+        shadow = serverText = editor.innerHTML;
+        editor.contentEditable = 'true';
+        if (unsaved) rebaseUnsaved(committed);
+        if (!loaded) {
+            loaded = true;
+            setupAutosave();
+        }
+    }
+
+    // Reapplies local edits the server never received on top of a new snapshot,
+    // e.g. after a disconnect that outlasted the server session
+    function rebaseUnsaved(committed) {
+        const { text, outstanding: sent } = unsaved;
+        let base = unsaved.base;
+        // The server may have committed the operations in flight without the ack reaching us
+        if (sent && committed != null && committed >= unsaved.batch) base = applyOperations(base, sent);
+        unsaved = null;
+        const [, local] = transformPair(diffOperations(base, serverText), diffOperations(base, text), true);
+        if (!local.length) return;
+        setEditorContent(applyOperations(serverText, local));
+        outstanding = local;
+        batch++;
+        sendOutstanding();
+    }
+
+    // Opens the document's WebSocket; called again when the server asks us to reconnect
+    function connectSocket() {
+        // A reconnect asks for only the changes after the last revision we saw
+        let query = `client=${encodeURIComponent(clientId)}`;
+        if (sessionId && revision !== null && !pendingSnapshot) {
+            query += `&resume=${encodeURIComponent(sessionId)}.${revision}`;
+        }
+        socket = new WebSocket(
+            `${socketBase}/ws/documents/${docId}/?${query}`,
+            codec ? ['collab.msgpack', 'collab.json'] : ['collab.json']
+        );
+        socket.binaryType = 'arraybuffer';
+
+        // WebSocket open event - connection established
+        socket.onopen = () => {
+            console.log('WebSocket connection established');
+            reconnectAttempts = 0;
+        };
+
+        // WebSocket message event - handle incoming updates
+        socket.onmessage = (event) => {
+            received = received
+                .then(() => decodeMessage(event.data))
+                .then(handleMessage)
+                .catch(error => console.error('Failed to handle message:', error));
+        };
+
+        // WebSocket error event - handle connection errors
+        socket.onerror = (error) => {
+            console.error('WebSocket Error:', error);
+        };
+
+        // WebSocket close event - handle disconnection
+        socket.onclose = (event) => {
+            console.warn('WebSocket connection closed');
+            if (pendingSnapshot) {
+                // A partial snapshot cannot be resumed; the next one replaces it
+                pendingSnapshot = null;
+                revision = null;
+            }
+            if (RECONNECT_CODES.includes(event.code)) {
+                setTimeout(connectSocket, event.code === 4009 ? 0 : 1000);
+            } else if (loaded && DROPPED_CODES.includes(event.code) && reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
+                // Flaky network: keep editing locally and resume once the connection is back
+                const delay = Math.min(MAX_RECONNECT_DELAY, 1000 * 2 ** reconnectAttempts);
+                reconnectAttempts++;
+                setTimeout(connectSocket, delay * (0.5 + Math.random() / 2));
+            } else {
+                socketClosed = true;
+                clearInterval(heartbeat);
+                // Without a live session the document can still be read and saved over HTTP
+                if (!loaded || truncated) loadDocumentContent(docId);
+            }
+        };
+    }
+
+    connectSocket();
+
+    // Sends an activity message at most once per interval, always with the latest state
+    function throttled(interval, buildMessage) {
+        let timer = null;
+        return () => {
+            if (timer) return;
+            timer = setTimeout(() => {
+                timer = null;
+                if (socket.readyState === WebSocket.OPEN) {
+                    sendMessage(buildMessage());
+                }
+            }, interval);
+        };
+    }
 
-    // WebSocket error event - handle connection errors
-    socket.onerror = (error) => {
-        console.error('WebSocket Error:', error);
-        alert('WebSocket connection failed. Please try refreshing the page.');
-    };
+    const sendCursor = throttled(100, () => ({ action: 'cursor', position: getCursorPosition() }));
+    const sendTyping = throttled(1000, () => ({ action: 'typing' }));
 
-    // WebSocket close event - handle disconnection
-    socket.onclose = () => {
-        console.warn('WebSocket connection closed');
-    };
+    document.addEventListener('selectionchange', () => {
+        if (editor.contains(document.activeElement) || document.activeElement === editor) sendCursor();
+    });
 
-    // Event listener to send updates when the content changes
+    // Event listener to send operations when the content changes
     editor.addEventListener('input', () => {
-        if (!isUpdating) {
-            const content = editor.innerHTML;
-            const cursorPosition = getCursorPosition();
-            socket.send(JSON.stringify({
-                action: 'edit',
-                content: content,
-                cursorPosition: cursorPosition,
-                user: currentUser,
-            }));
+        sendTyping();
+        if (isUpdating || revision === null) return;
+
+        const content = editor.innerHTML;
+        const ops = diffOperations(shadow, content);
+        shadow = content;
+        if (!ops.length) return;
+
+        if (outstanding) {
+            buffer = buffer.concat(ops);
+        } else {
+            outstanding = ops;
+            batch++;
+            sendOutstanding();
         }
     });
 
@@ -159,7 +587,7 @@
             cursor = document.createElement('div');
             cursor.className = 'user-cursor';
             cursor.style.backgroundColor = getColorForUser(username);
-            editor.appendChild(cursor);
+            cursorOverlay.appendChild(cursor);
             cursors[username] = cursor;
         }
 
@@ -170,20 +598,17 @@
         range.setStart(node, position.offset);
 
         const rect = range.getBoundingClientRect();
-        const editorRect = editor.getBoundingClientRect();
+        const overlayRect = cursorOverlay.getBoundingClientRect();
 
         cursor.style.position = 'absolute';
-        cursor.style.left = `${rect.left - editorRect.left}px`;
-        cursor.style.top = `${rect.top - editorRect.top}px`;
+        cursor.style.left = `${rect.left - overlayRect.left}px`;
+        cursor.style.top = `${rect.top - overlayRect.top}px`;
         cursor.style.width = '2px';
         cursor.style.height = '1em';
         cursor.style.backgroundColor = getColorForUser(username);
         cursor.style.zIndex = '1000';
     }
 
-    // Function to load and initialize the document
-    loadDocumentContent(docId);
-
     // Function to format text in the editor
     function formatText(command) {
         document.execCommand(command, false, null);
@@ -214,31 +639,12 @@
         return null;
     }
 
-    // Function to download the file in a specified format
+    // Downloads the document in the selected format; the server renders and streams it
     function downloadFile() {
-        const content = editor.innerHTML;
         const downloadType = document.getElementById('downloadType').value;
-        let blob;
-        let filename = `document.${downloadType}`;
-
-        if (downloadType === 'html') {
-            blob = new Blob([content], { type: 'text/html' });
-        } else if (downloadType === 'txt') {
-            const textContent = editor.innerText;
-            blob = new Blob([textContent], { type: 'text/plain' });
-        } else if (downloadType === 'doc') {
-            blob = new Blob([content], { type: 'application/msword' });
-        } else {
-            alert('Unsupported download type.');
-            return;
-        }
-
-        const url = URL.createObjectURL(blob);
         const a = document.createElement('a');
-        a.href = url;
-        a.download = filename;
+        a.href = `/documents/${docId}/export/${downloadType}/`;
         a.click();
-        URL.revokeObjectURL(url);
     }
 
     // Placeholder function for duplicating a line
@@ -249,6 +655,10 @@
     // Function to autosave the document content
     function autosaveDocument() {
         console.log('Autosave function called');
+        // While the socket is live, or resuming, the server session buffers and saves the edits
+        if (revision !== null && !socketClosed) return;
+        // Saving part of a snapshot would cut the document short for everyone
+        if (truncated) return;
         const content = editor.innerHTML;
         console.log('Autosaving content:', content);
         fetch(`/documents/${docId}/save/`, {
@@ -273,7 +683,10 @@
     }
 
     // Function to set up periodic autosave
+    let autosaveStarted = false;
     function setupAutosave() {
+        if (autosaveStarted) return;
+        autosaveStarted = true;
         setInterval(autosaveDocument, 10000); // Autosave every 10 seconds
 
         let autosaveTimeout;
@@ -1,3 +1,1689 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connections
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    backpressure, blocks, compression, framing, journal, metrics, ot, pagination, permissions, persistence,
+    presence, ratelimit, retention, search, sessions, sharding, tracing, views,
+)
+from .blocks import load_content
+from .coalescing import FrameCoalescer
+from .consumers import DocumentConsumer
+from .presence import InMemoryPresenceBackend
+from .routing import websocket_urlpatterns
+from .deltas import make_delta, apply_delta
+from .management.commands.bench_views import DEFAULT_BUDGETS
+from .pagination import keyset_page, parse_cursor
+from .models import Document, DocumentBlock, DocumentVersion, VERSION_KEYFRAME_INTERVAL, hash_content
+
+
+# Operational transformation of concurrent edits
+class OperationalTransformTests(SimpleTestCase):
+    def assertConverges(self, content, a, b, a_wins=False):
+        a_after_b, b_after_a = ot.transform_pair(a, b, a_wins)
+        result = ot.apply(ot.apply(content, a), b_after_a)
+        self.assertEqual(ot.apply(ot.apply(content, b), a_after_b), result)
+        return result
+
+    def test_concurrent_inserts_converge(self):
+        self.assertEqual(self.assertConverges('<p>ac</p>', [ot.insert(4, 'b')], [ot.insert(5, 'd')]), '<p>abcd</p>')
+
+    def test_insert_and_delete_converge(self):
+        content = '<p>abcdef</p>'
+        self.assertEqual(self.assertConverges(content, [ot.insert(3, 'x')], [ot.delete(5, 2)]), '<p>xabef</p>')
+        self.assertEqual(self.assertConverges(content, [ot.delete(3, 2)], [ot.insert(9, 'x')]), '<p>cdefx</p>')
+        # Text inserted inside a deleted range survives where the range was
+        self.assertEqual(self.assertConverges(content, [ot.insert(5, 'x')], [ot.delete(4, 3)]), '<p>axef</p>')
+
+    def test_overlapping_deletes_remove_each_character_once(self):
+        self.assertEqual(self.assertConverges('<p>abcdef</p>', [ot.delete(3, 3)], [ot.delete(4, 3)]), '<p>ef</p>')
+        self.assertEqual(self.assertConverges('<p>abcdef</p>', [ot.delete(4, 1)], [ot.delete(3, 4)]), '<p>ef</p>')
+
+    def test_ties_at_the_same_position(self):
+        a, b = [ot.insert(3, 'a')], [ot.insert(3, 'b')]
+        self.assertEqual(self.assertConverges('<p></p>', a, b, a_wins=True), '<p>ab</p>')
+        self.assertEqual(self.assertConverges('<p></p>', a, b, a_wins=False), '<p>ba</p>')
+        self.assertEqual(ot._transform_single(a[0], b[0], True), ([ot.insert(3, 'a')], [ot.insert(4, 'b')]))
+        # An insert at the start of a deleted range stays in front of it
+        self.assertEqual(
+            ot._transform_single(ot.insert(3, 'x'), ot.delete(3, 2), False),
+            ([ot.insert(3, 'x')], [ot.delete(4, 2)]),
+        )
+
+    def test_random_edit_lists_converge(self):
+        generator = random.Random(1)
+
+        def edits(length):
+            ops = []
+            for _ in range(generator.randint(1, 4)):
+                pos = generator.randint(0, length)
+                if generator.random() < 0.5 or pos == length:
+                    text = generator.choice('xyz') * generator.randint(1, 3)
+                    ops.append(ot.insert(pos, text))
+                    length += len(text)
+                else:
+                    size = generator.randint(1, length - pos)
+                    ops.append(ot.delete(pos, size))
+                    length -= size
+            return ops
+
+        for _ in range(500):
+            content = ''.join(generator.choice('abc') for _ in range(generator.randint(0, 12)))
+            self.assertConverges(content, edits(len(content)), edits(len(content)), generator.random() < 0.5)
+
+    def test_format_expands_to_tag_inserts(self):
+        ops = ot.normalize([{'type': 'format', 'pos': 3, 'length': 5, 'tag': 'b'}])
+        self.assertEqual(ops, [ot.insert(8, '</b>'), ot.insert(3, '<b>')])
+        self.assertEqual(ot.apply('<p>hello</p>', ops), '<p><b>hello</b></p>')
+        with self.assertRaises(ot.OperationError):
+            ot.normalize([{'type': 'format', 'pos': 0, 'length': 1, 'tag': 'script'}])
+
+    def test_normalize_rejects_malformed_operations(self):
+        self.assertEqual(ot.normalize([ot.insert(0, ''), ot.delete(0, 0)]), [])
+        for ops in (
+            {'type': 'insert'},
+            [{'type': 'insert', 'pos': -1, 'text': 'x'}],
+            [{'type': 'insert', 'pos': True, 'text': 'x'}],
+            [{'type': 'delete', 'pos': 0, 'length': '2'}],
+            [{'type': 'move', 'pos': 0}],
+        ):
+            with self.subTest(ops=ops), self.assertRaises(ot.OperationError):
+                ot.normalize(ops)
+
+    def test_operations_past_the_end_are_rejected(self):
+        for ops in ([ot.insert(4, 'x')], [ot.delete(2, 2)]):
+            with self.subTest(ops=ops), self.assertRaises(ot.OperationError):
+                ot.apply('abc', ops)
+
+
+# Commits to a live session made against older revisions
+class SessionCommitTests(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.object(journal, 'JOURNAL_DIR', None)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.session = sessions.DocumentSession(1, '<p>abc</p>')
+
+    def test_commit_against_a_stale_revision_is_transformed(self):
+        self.assertEqual(self.session.commit([ot.insert(3, 'x')], 0), ([ot.insert(3, 'x')], 1))
+        ops, revision = self.session.commit([ot.insert(6, 'y'), ot.delete(3, 1)], 0)
+        self.assertEqual((ops, revision), ([ot.insert(7, 'y'), ot.delete(4, 1)], 2))
+        self.assertEqual(self.session.content, '<p>xbcy</p>')
+
+    def test_committed_operations_win_ties(self):
+        self.session.commit([ot.insert(3, 'x')], 0)
+        self.session.commit([ot.insert(3, 'y')], 0)
+        self.assertEqual(self.session.content, '<p>xyabc</p>')
+
+    def test_invalid_revisions_and_positions_are_rejected(self):
+        self.session.commit([ot.insert(3, 'x')], 0)
+        for ops, revision in (
+            ([ot.insert(0, 'y')], 2),
+            ([ot.insert(0, 'y')], -1),
+            ([ot.insert(0, 'y')], '1'),
+            ([ot.insert(20, 'y')], 1),
+            ([ot.delete(5, 20)], 0),
+        ):
+            with self.subTest(ops=ops, revision=revision), self.assertRaises(ot.OperationError):
+                self.session.commit(ops, revision)
+        self.assertEqual((self.session.content, self.session.revision), ('<p>xabc</p>', 1))
+
+    def test_revision_older_than_the_history_needs_a_snapshot(self):
+        with mock.patch.object(sessions, 'HISTORY_LIMIT', 2):
+            session = sessions.DocumentSession(1, '')
+        for revision in range(3):
+            session.commit([ot.insert(0, 'x')], revision)
+        with self.assertRaises(sessions.StaleRevision):
+            session.commit([ot.insert(0, 'y')], 0)
+        session.commit([ot.insert(0, 'y')], 1)
+        # The committed inserts at 0 win the tie against the late one
+        self.assertEqual(session.content, 'xxyx')
+
+
+# Deltas between two versions of a document
+class DeltaTests(TestCase):
+    def test_round_trip(self):
+        cases = [
+            ('', ''),
+            ('', '<p>new</p>'),
+            ('<p>old</p>', ''),
+            ('<p>same</p>', '<p>same</p>'),
+            ('<p>hello world</p>', '<p>hello there world</p>'),
+            ('<p>aaaa</p>', '<p>aa</p>'),
+            ('<p>café ☕</p>', '<p>café ☕ 😀</p>'),
+            ('x' * 100000 + 'a' + 'y' * 100000, 'x' * 100000 + 'b' + 'y' * 100000),
+        ]
+        for old, new in cases:
+            with self.subTest(old=old[:20], new=new[:20]):
+                self.assertEqual(apply_delta(old, make_delta(old, new)), new)
+
+    def test_only_the_changed_middle_is_stored(self):
+        old = '<p>' + 'a' * 50000 + '</p>'
+        new = '<p>' + 'a' * 25000 + 'b' + 'a' * 25000 + '</p>'
+        self.assertLess(len(make_delta(old, new)), 50)
+
+
+# Saves of content that is already stored
+class SaveDeduplicationTests(TestCase):
+    def setUp(self):
+        patch = mock.patch.object(persistence, 'WRITE_QUEUE', False)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.user = User.objects.create_user('deduplicated', password='x')
+        self.document = Document.objects.create(title='Same', content='<p>same</p>', owner=self.user)
+
+    def writes(self, queries):
+        return [query['sql'] for query in queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+
+    def test_document_hash_follows_its_content(self):
+        self.assertEqual(self.document.content_hash, hash_content('<p>same</p>'))
+
+    def test_identical_http_save_writes_nothing(self):
+        self.client.force_login(self.user)
+        updated_at = self.document.updated_at
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self.client.post(
+                reverse('save_document', args=[self.document.id]), json.dumps({'content': '<p>same</p>'}),
+                content_type='application/json',
+            )
+        self.assertEqual(response.json(), {'status': 'success', 'unchanged': True})
+        self.assertEqual(self.writes(queries), [])
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.updated_at, updated_at)
+        self.assertFalse(DocumentVersion.objects.filter(document=self.document).exists())
+
+    def test_store_skips_unchanged_content(self):
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.assertTrue(persistence.store_document_content(self.document.id, '<p>same</p>', self.user.id))
+        # The one conditional UPDATE matches no row, and no version is inserted
+        self.assertEqual([sql.split()[0] for sql in self.writes(queries)], ['UPDATE'])
+        self.assertFalse(DocumentVersion.objects.filter(document=self.document).exists())
+
+        self.assertTrue(persistence.store_document_content(self.document.id, '<p>new</p>', self.user.id))
+        self.assertTrue(persistence.store_document_content(self.document.id, '<p>new</p>', self.user.id))
+        self.assertEqual(DocumentVersion.objects.filter(document=self.document).count(), 1)
+        self.assertFalse(persistence.store_document_content(self.document.id + 1, '<p>new</p>'))
+
+
+# Conditional and compressed document reads
+class DocumentResponseTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patch = mock.patch.object(persistence, 'WRITE_QUEUE', False)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.user = User.objects.create_user('reader', password='x')
+        self.document = Document.objects.create(title='Read', content='<p>small</p>', owner=self.user)
+        self.client.force_login(self.user)
+        self.url = reverse('get_document', args=[self.document.id])
+
+    def test_unchanged_content_is_not_sent_again(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['content'], '<p>small</p>')
+        etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        persistence.store_document_content(self.document.id, '<p>changed</p>')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_large_content_is_compressed_when_accepted(self):
+        content = '<p>paragraph</p>' * 1000
+        persistence.store_document_content(self.document.id, content)
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(json.loads(gzip.decompress(response.content))['content'], content)
+
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(response.content)['content'], content)
+
+    def test_encoding_negotiation(self):
+        factory = RequestFactory()
+
+        def negotiate(accept, size=4096):
+            return compression.negotiate_encoding(factory.get('/', HTTP_ACCEPT_ENCODING=accept), size)
+
+        self.assertEqual(negotiate('gzip'), 'gzip')
+        self.assertIsNone(negotiate('gzip', size=100))
+        self.assertIsNone(negotiate('gzip;q=0, identity'))
+        self.assertIsNone(negotiate(''))
+        expected = 'br' if compression.brotli is not None else 'gzip'
+        self.assertEqual(negotiate('gzip;q=0.5, br'), expected)
+
+    @skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli_round_trip(self):
+        body = b'<p>paragraph</p>' * 1000
+        self.assertEqual(compression.brotli.decompress(compression.compress(body, 'br')), body)
+
+
+# Keyset pagination of the document and version lists
+class PaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('pager', password='x')
+        self.document = Document.objects.create(title='Paged', content='', owner=self.user)
+        for index in range(5):
+            DocumentVersion.objects.create_version(self.document.id, f'<p>{index}</p>', self.user.id)
+        self.versions = DocumentVersion.objects.filter(document=self.document)
+        self.ids = sorted(self.versions.values_list('id', flat=True), reverse=True)
+
+    def test_pages_cover_every_row_once(self):
+        rows, cursor = keyset_page(self.versions, size=2)
+        self.assertEqual([row.id for row in rows], self.ids[:2])
+        self.assertEqual(cursor, self.ids[1])
+        # A row added between pages does not shift the next one
+        DocumentVersion.objects.create_version(self.document.id, '<p>new</p>', self.user.id)
+        rows, cursor = keyset_page(self.versions, cursor, 2)
+        self.assertEqual([row.id for row in rows], self.ids[2:4])
+        rows, cursor = keyset_page(self.versions, cursor, 2)
+        self.assertEqual(([row.id for row in rows], cursor), (self.ids[4:], None))
+
+    def test_last_full_page_has_no_cursor(self):
+        rows, cursor = keyset_page(self.versions, size=5)
+        self.assertEqual((len(rows), cursor), (5, None))
+        self.assertEqual(keyset_page(self.versions, self.ids[-1], 5), ([], None))
+        self.assertEqual(keyset_page(DocumentVersion.objects.none()), ([], None))
+
+    def test_bad_cursor_and_size_fall_back(self):
+        factory = RequestFactory()
+        self.assertEqual(parse_cursor(factory.get('/', {'before': 'x', 'limit': 'y'})), (None, pagination.PAGE_SIZE))
+        self.assertEqual(parse_cursor(factory.get('/', {'before': '7', 'limit': '0'})), (7, 1))
+        self.assertEqual(parse_cursor(factory.get('/', {'limit': '100000'})), (None, pagination.MAX_PAGE_SIZE))
+
+    def test_version_api_query_count_does_not_grow_with_the_page(self):
+        self.client.force_login(self.user)
+        url = reverse('version_history_api', args=[self.document.id])
+        self.client.get(url, {'limit': 1})
+        with CaptureQueriesContext(connections['default']) as small:
+            first = self.client.get(url, {'limit': 1}).json()
+        with CaptureQueriesContext(connections['default']) as large:
+            self.client.get(url, {'limit': 5})
+        self.assertEqual(len(small), len(large))
+
+        seen = [version['id'] for version in first['versions']]
+        cursor = first['next']
+        while cursor is not None:
+            page = self.client.get(url, {'limit': 2, 'before': cursor}).json()
+            seen += [version['id'] for version in page['versions']]
+            cursor = page['next']
+        self.assertEqual(seen, self.ids)
+        self.assertEqual(first['versions'][0]['editor'], 'pager')
+
+
+# Participants of a document and their expiry
+class PresenceTests(SimpleTestCase):
+    class Clock:
+        now = 1000.0
+
+        def time(self):
+            return self.now
+
+        def monotonic(self):
+            return self.now
+
+    def setUp(self):
+        self.clock = self.Clock()
+        patch = mock.patch.object(presence, 'time', self.clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.backend = InMemoryPresenceBackend(ttl=60)
+
+    def test_members_expire_without_a_heartbeat(self):
+        self.assertTrue(self.backend.touch(1, 'ann', 'ann.1'))
+        self.assertTrue(self.backend.touch(1, 'bob', 'bob.1'))
+        self.clock.now += 40
+        # A heartbeat only refreshes a known member
+        self.assertFalse(self.backend.touch(1, 'ann', 'ann.1'))
+        self.clock.now += 30
+        self.assertEqual(self.backend.participants(1), ['ann'])
+        self.clock.now += 30
+        self.assertEqual(self.backend.participants(1), [])
+        # Someone touching the document after others expired reports the change
+        self.backend.touch(1, 'bob', 'bob.1')
+        self.backend.touch(1, 'ann', 'ann.1')
+        self.clock.now += 61
+        self.assertTrue(self.backend.touch(1, 'cy', 'cy.1'))
+        self.assertEqual(self.backend.participants(1), ['cy'])
+
+    def test_a_user_with_several_connections_is_one_participant(self):
+        self.backend.touch(1, 'ann', 'ann.1')
+        self.backend.touch(1, 'ann', 'ann.2')
+        self.assertEqual(self.backend.participants(1), ['ann'])
+        self.assertTrue(self.backend.remove(1, 'ann', 'ann.1'))
+        self.assertFalse(self.backend.remove(1, 'ann', 'ann.1'))
+        self.assertEqual(self.backend.participants(1), ['ann'])
+        self.backend.remove(1, 'ann', 'ann.2')
+        self.assertEqual(self.backend.participants(1), [])
+
+    def test_changes_are_broadcast_as_one_snapshot_per_interval(self):
+        backend = InMemoryPresenceBackend(ttl=60, snapshot_interval=5)
+        broadcaster = presence.PresenceBroadcaster(backend)
+        snapshots = []
+
+        async def run():
+            with mock.patch.object(presence.coalescer, 'presence', lambda document_id, users: snapshots.append(users)):
+                for name in ('ann', 'bob', 'cy'):
+                    backend.touch(1, name, f'{name}.1')
+                    broadcaster.changed(1)
+                await asyncio.sleep(0)
+                await asyncio.sleep(0.05)
+                self.assertEqual(snapshots, [['ann', 'bob', 'cy']])
+                # The next change waits out the interval
+                backend.remove(1, 'bob', 'bob.1')
+                broadcaster.changed(1)
+                await asyncio.sleep(0.05)
+                self.assertEqual(len(snapshots), 1)
+                broadcaster._pending['1'].cancel()
+        async_to_sync(run)()
+
+
+# Cursor, typing and presence activity batched into one frame per tick
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class CoalescingTests(SimpleTestCase):
+    def test_one_frame_per_tick_with_the_latest_cursors(self):
+        coalescer = FrameCoalescer(interval_ms=10)
+
+        async def run():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add('document_1', channel)
+            for offset in range(5):
+                coalescer.cursor(1, 'ann.1', 'ann', {'path': [0], 'offset': offset})
+            coalescer.typing(1, 'bob.1', 'bob')
+            coalescer.typing(1, 'bob.1', 'bob')
+            coalescer.cursor(1, 'cy.1', 'cy', {'path': [0], 'offset': 9})
+            coalescer.forget(1, 'cy.1')
+            coalescer.presence(1, ['ann', 'bob'])
+
+            frame = await asyncio.wait_for(layer.receive(channel), 1)
+            self.assertEqual(frame['cursors'], {'ann.1': {'user': 'ann', 'position': {'path': [0], 'offset': 4}}})
+            self.assertEqual(frame['typing'], {'bob.1': 'bob'})
+            self.assertEqual(frame['participants'], ['ann', 'bob'])
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(channel), 0.1)
+        async_to_sync(run)()
+
+    def test_recipients_do_not_get_their_own_activity(self):
+        consumer = DocumentConsumer()
+        consumer.channel_name = 'ann.1'
+        consumer.send_message = mock.AsyncMock()
+        own = {'ann.1': {'user': 'ann', 'position': {'path': [], 'offset': 0}}}
+
+        async def run():
+            await consumer.activity_frame({'cursors': own, 'typing': {'ann.1': 'ann'}, 'participants': None})
+            consumer.send_message.assert_not_called()
+            await consumer.activity_frame({
+                'cursors': {**own, 'bob.1': {'user': 'bob', 'position': None}},
+                'typing': {'ann.1': 'ann', 'bob.1': 'bob'},
+                'participants': ['ann', 'bob'],
+            })
+        async_to_sync(run)()
+        consumer.send_message.assert_called_once_with({
+            'action': 'activity',
+            'cursors': [{'user': 'bob', 'position': None}],
+            'typing': ['bob'],
+            'participants': ['ann', 'bob'],
+        })
+
+
+# Versions stored as deltas against periodic keyframes
+class VersionChainTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('writer', password='x')
+        self.document = Document.objects.create(title='Chain', content='', owner=self.user)
+
+    def test_every_version_rebuilds_its_content(self):
+        contents = [f'<p>line {i}</p>' * (i + 1) for i in range(VERSION_KEYFRAME_INTERVAL * 2 + 3)]
+        for content in contents:
+            DocumentVersion.objects.create_version(self.document.id, content, self.user.id)
+
+        versions = list(DocumentVersion.objects.filter(document=self.document).order_by('id'))
+        self.assertEqual([v.full_content for v in versions], contents)
+        keyframes = [index for index, version in enumerate(versions) if version.is_keyframe]
+        self.assertEqual(keyframes, [0, VERSION_KEYFRAME_INTERVAL, VERSION_KEYFRAME_INTERVAL * 2])
+        self.assertTrue(all(v.content == '' for v in versions if not v.is_keyframe))
+
+    def test_unchanged_content_creates_no_version(self):
+        self.assertIsNotNone(DocumentVersion.objects.create_version(self.document.id, '<p>a</p>'))
+        self.assertIsNone(DocumentVersion.objects.create_version(self.document.id, '<p>a</p>'))
+        self.assertEqual(DocumentVersion.objects.filter(document=self.document).count(), 1)
+
+
+# Thinning of old versions by the retention policy
+class RetentionTests(TestCase):
+    # One version per 10 minutes, at any age
+    POLICY = [(None, 600)]
+
+    def setUp(self):
+        self.user = User.objects.create_user('keeper', password='x')
+        self.document = Document.objects.create(title='Retained', content='', owner=self.user)
+        self.now = timezone.now().replace(minute=0, second=0, microsecond=0)
+
+    def add_versions(self, count, start, step, **kwargs):
+        # Versions `step` apart from `start`, with content that differs by one line each
+        ids = []
+        for i in range(count):
+            content = ''.join(f'<p>line {n}</p>' for n in range(len(ids) + DocumentVersion.objects.count() + 1))
+            version = DocumentVersion.objects.create_version(self.document.id, content, self.user.id, **kwargs)
+            DocumentVersion.objects.filter(id=version.id).update(timestamp=start + step * i)
+            ids.append(version.id)
+        return ids
+
+    def contents(self):
+        return {v.id: v.full_content for v in DocumentVersion.objects.filter(document=self.document)}
+
+    def test_latest_version_and_reverts_fill_their_window(self):
+        start = self.now - timedelta(days=1)
+        versions = [(1, start, False), (2, start + timedelta(seconds=1), True), (3, start + timedelta(seconds=2), False)]
+        self.assertEqual(retention.select_kept(versions, self.now, self.POLICY), {2, 3})
+        versions = [(1, start, False), (2, start + timedelta(seconds=1), False)]
+        self.assertEqual(retention.select_kept(versions, self.now, self.POLICY), {2})
+
+    def test_kept_versions_still_rebuild(self):
+        self.add_versions(VERSION_KEYFRAME_INTERVAL * 3, self.now - timedelta(days=2), timedelta(minutes=3))
+        before = self.contents()
+
+        report = retention.compact_document(self.document.id, self.now, self.POLICY, batch_size=7)
+
+        after = self.contents()
+        self.assertGreater(report.rows_deleted, 0)
+        self.assertEqual(len(after), len(before) - report.rows_deleted)
+        for version_id, content in after.items():
+            self.assertEqual(content, before[version_id])
+        self.assertIn(max(before), after)
+
+    def test_versions_saved_during_compaction_are_kept(self):
+        # All in one window, so only the latest of them is kept
+        ids = self.add_versions(10, self.now - timedelta(days=2), timedelta(minutes=1))
+        saved = []
+
+        def select_then_save(*args):
+            # A save lands between reading the version list and thinning it
+            kept = select_kept(*args)
+            saved.append(DocumentVersion.objects.create_version(self.document.id, '<p>concurrent</p>', self.user.id))
+            return kept
+
+        select_kept = retention.select_kept
+        with mock.patch.object(retention, 'select_kept', select_then_save):
+            retention.compact_document(self.document.id, self.now, self.POLICY)
+
+        after = self.contents()
+        self.assertEqual(after[saved[0].id], '<p>concurrent</p>')
+        self.assertEqual(sorted(after), [ids[-1], saved[0].id])
+
+
+# Block-structured storage of document content
+class BlockStorageTests(TestCase):
+    PARAGRAPHS = ''.join(f'<p>paragraph {index}</p>' for index in range(10))
+
+    def setUp(self):
+        # Assembled content is cached under the document id, which tests reuse
+        cache.clear()
+        owner = User.objects.create_user('blocks', password='x')
+        self.document = Document.objects.create(title='Blocks', content=self.PARAGRAPHS, owner=owner)
+        blocks.convert_to_blocks(self.document.id)
+
+    def rows(self):
+        return list(DocumentBlock.objects.filter(document_id=self.document.id).order_by('position').values_list('id', 'content'))
+
+    def store(self, content):
+        counts = blocks.store_blocks(self.document.id, content)
+        Document.objects.filter(id=self.document.id).update(content_hash=hash_content(content))
+        cache.clear()
+        self.assertEqual(load_content(self.document.id), content)
+        return counts
+
+    def test_split_blocks_joins_back_to_the_content(self):
+        content = 'lead<h1>Title</h1>\n<ul><li>one<br></li><li>two</li></ul><p>a<img src="x"/>b</p></div>tail'
+        parts = blocks.split_blocks(content)
+        self.assertEqual(''.join(parts), content)
+        self.assertEqual(parts[:2], ['lead<h1>Title</h1>', '\n<ul><li>one<br></li><li>two</li></ul>'])
+
+    def test_keys_sort_between_their_neighbours(self):
+        keys = [blocks.key_between()]
+        for _ in range(50):
+            # Always insert at the front, the worst case for key length
+            keys.insert(0, blocks.key_between(None, keys[0]))
+            keys.insert(1, blocks.key_between(keys[0], keys[1]))
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+        spread = blocks.keys_between('a', 'b', 1000)
+        self.assertEqual(spread, sorted(spread))
+        self.assertTrue(all('a' < key < 'b' for key in spread))
+
+    def test_editing_one_paragraph_rewrites_one_row(self):
+        before = self.rows()
+        content = self.PARAGRAPHS.replace('paragraph 4', 'paragraph four')
+        self.assertEqual(self.store(content), (1, 0, 0))
+        after = self.rows()
+        self.assertEqual([row[0] for row in after], [row[0] for row in before])
+
+    def test_inserted_and_removed_paragraphs_keep_the_other_rows(self):
+        before = self.rows()
+        content = self.PARAGRAPHS.replace('<p>paragraph 2</p>', '').replace('<p>paragraph 6</p>', '<p>new</p><p>paragraph 6</p>')
+        self.assertEqual(self.store(content), (0, 1, 1))
+        kept = {row[0] for row in self.rows()}
+        self.assertEqual(len(kept & {row[0] for row in before}), 9)
+
+    def test_conversion_back_to_a_blob(self):
+        self.assertTrue(blocks.convert_to_blob(self.document.id))
+        document = Document.objects.get(id=self.document.id)
+        self.assertFalse(document.block_storage)
+        self.assertEqual(document.content, self.PARAGRAPHS)
+        self.assertEqual(self.rows(), [])
+
+
+# Crash recovery journal
+class JournalTests(TestCase):
+    def checkpoint(self, revision, content):
+        return journal._line({'rev': revision, 'hash': hash_content(content)})
+
+    def operation(self, revision, ops, user=1, batch=None):
+        entry = {'rev': revision, 'ops': ops, 'user': user}
+        if batch is not None:
+            entry['batch'] = batch
+        return journal._line(entry)
+
+    def test_replay_applies_operations_after_the_matching_checkpoint(self):
+        lines = [
+            self.checkpoint(0, '<p>a</p>'),
+            self.operation(1, [{'type': 'insert', 'pos': 4, 'text': 'b'}], batch=['c1', 3]),
+            self.checkpoint(1, '<p>ab</p>'),
+            self.operation(2, [{'type': 'delete', 'pos': 3, 'length': 1}, {'type': 'insert', 'pos': 3, 'text': 'x'}], user=2),
+        ]
+        self.assertEqual(journal.replay(lines, '<p>a</p>'), ('<p>xb</p>', 2, 2, {'c1': 3}))
+        # The stored content already includes the first operation
+        self.assertEqual(journal.replay(lines, '<p>ab</p>'), ('<p>xb</p>', 2, 1, {}))
+
+    def test_journal_of_other_content_is_not_replayed(self):
+        lines = [self.checkpoint(0, '<p>a</p>'), self.operation(1, [{'type': 'insert', 'pos': 0, 'text': 'b'}])]
+        self.assertIsNone(journal.replay(lines, '<p>saved elsewhere</p>'))
+
+    def test_replay_stops_at_a_torn_record_or_a_gap(self):
+        insert = [{'type': 'insert', 'pos': 0, 'text': 'x'}]
+        torn = [self.checkpoint(0, ''), self.operation(1, insert), self.operation(2, insert)[:10]]
+        self.assertEqual(journal.replay(torn, ''), ('x', 1, 1, {}))
+        gap = [self.checkpoint(0, ''), self.operation(1, insert), self.operation(3, insert)]
+        with self.assertLogs('hello.journal', 'WARNING'):
+            self.assertEqual(journal.replay(gap, ''), ('x', 1, 1, {}))
+
+    def test_text_buffer_matches_string_edits(self):
+        generator = random.Random(0)
+        text = ''.join(generator.choice('abc') for _ in range(500))
+        buffer = journal._TextBuffer(text, chunk_size=16)
+        for _ in range(2000):
+            pos = generator.randint(0, len(text))
+            if generator.random() < 0.5 or pos == len(text):
+                insert = 'x' * generator.randint(1, 40)
+                text = text[:pos] + insert + text[pos:]
+                buffer.insert(pos, insert)
+            else:
+                length = generator.randint(1, min(60, len(text) - pos))
+                text = text[:pos] + text[pos + length:]
+                buffer.delete(pos, length)
+        self.assertEqual(buffer.text(), text)
+        self.assertEqual(buffer.length, len(text))
+
+    def test_compaction_keeps_only_records_after_the_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = journal.JournalWriter(directory, interval=0)
+            writer.submit('start', 1, self.checkpoint(0, '')).result(5)
+            for revision in (1, 2, 3):
+                writer.submit('append', 1, (revision, self.operation(revision, []))).result(5)
+            writer.submit('compact', 1, (2, self.checkpoint(2, 'stored'))).result(5)
+            self.assertEqual(writer.submit('read', 1).result(5), [self.checkpoint(2, 'stored'), self.operation(3, [])])
+            writer.submit('remove', 1).result(5)
+            self.assertFalse(writer.path(1).exists())
+
+
+# Journals of crashed sessions meeting saves and reverts over HTTP
+class JournalRecoveryTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patches = [
+            mock.patch.object(journal, 'JOURNAL_DIR', directory.name),
+            mock.patch.object(journal, 'writer', journal.JournalWriter(directory.name, interval=0)),
+            mock.patch.object(persistence, 'WRITE_QUEUE', False),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.user = User.objects.create_user('crashed', password='x')
+        self.document = Document.objects.create(
+            title='Crashed', content='<p>a</p>', content_hash=hash_content('<p>a</p>'), owner=self.user
+        )
+        self.client.force_login(self.user)
+
+        # The session crashed after committing an edit it never flushed
+        with open(journal.writer.path(self.document.id), 'w', encoding='utf-8') as f:
+            f.write(journal._line({'rev': 0, 'hash': hash_content('<p>a</p>')}))
+            f.write(journal._line({'rev': 1, 'ops': [{'type': 'insert', 'pos': 4, 'text': 'b'}], 'user': self.user.id, 'batch': ['c1', 1]}))
+
+    def versions(self):
+        return [version.full_content for version in DocumentVersion.objects.filter(document=self.document).order_by('id')]
+
+    def test_http_save_stores_journaled_edits_first(self):
+        response = self.client.post(
+            reverse('save_document', args=[self.document.id]), json.dumps({'content': '<p>c</p>'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(self.versions(), ['<p>ab</p>', '<p>c</p>'])
+        self.assertEqual(load_content(self.document.id), '<p>c</p>')
+        self.assertEqual(sessions.committed_batches(self.document.id), {'c1': 1})
+        journal.writer.drain()
+        self.assertFalse(journal.exists(self.document.id))
+
+    def test_saving_the_journaled_content_is_a_no_op(self):
+        response = self.client.post(
+            reverse('save_document', args=[self.document.id]), json.dumps({'content': '<p>ab</p>'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.json(), {'status': 'success', 'unchanged': True})
+        self.assertEqual(self.versions(), ['<p>ab</p>'])
+
+
+# Reverts written in one transaction, reaching live editors once committed
+class RevertTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patch = mock.patch.object(journal, 'JOURNAL_DIR', None)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.user = User.objects.create_user('reverter', password='x')
+        self.document = Document.objects.create(title='Reverted', content='<p>b</p>', owner=self.user)
+        self.version = DocumentVersion.objects.create_version(self.document.id, '<p>a</p>', self.user.id)
+        DocumentVersion.objects.create_version(self.document.id, '<p>b</p>', self.user.id)
+        self.client.force_login(self.user)
+
+    def revert(self):
+        return self.client.post(reverse('revert_version', args=[self.document.id, self.version.id]))
+
+    def test_editors_hear_of_the_revert_after_it_commits(self):
+        with mock.patch.object(views, 'broadcast_revert') as broadcast:
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.revert()
+            self.assertRedirects(response, reverse('editor', args=[self.document.id]), fetch_redirect_response=False)
+            broadcast.assert_not_called()
+            self.assertEqual(len(callbacks), 1)
+            callbacks[0]()
+        broadcast.assert_called_once_with(self.document.id, '<p>a</p>', self.user)
+        self.assertEqual(load_content(self.document.id), '<p>a</p>')
+        self.assertTrue(DocumentVersion.objects.latest('id').is_revert)
+
+    def test_failed_revert_leaves_the_document_and_editors_alone(self):
+        failure = mock.patch.object(DocumentVersion.objects, 'create_version', side_effect=OperationalError('locked'))
+        with mock.patch.object(views, 'broadcast_revert') as broadcast, failure, mock.patch.object(views.logger, 'error'):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                response = self.revert()
+        self.assertRedirects(response, reverse('document_list'), fetch_redirect_response=False)
+        self.assertEqual(callbacks, [])
+        broadcast.assert_not_called()
+        self.assertEqual(load_content(self.document.id), '<p>b</p>')
+        self.assertEqual(DocumentVersion.objects.filter(document=self.document).count(), 2)
+
+
+# Cached document access decisions
+class PermissionTests(TestCase):
+    def setUp(self):
+        # Document ids are reused between tests, so are their cached decisions
+        cache.clear()
+        self.owner = User.objects.create_user('owner', password='x')
+        self.reader = User.objects.create_user('reader', password='x')
+        self.document = Document.objects.create(title='Shared', content='', owner=self.owner)
+        self.document.shared_with.add(self.reader)
+
+    def test_revoking_takes_effect_at_once(self):
+        self.assertTrue(permissions.has_document_access(self.reader, self.document.id))
+        self.document.shared_with.remove(self.reader)
+        permissions.invalidate_document_access(self.document.id)
+        self.assertFalse(permissions.has_document_access(self.reader, self.document.id))
+
+    def test_check_racing_an_invalidation_does_not_restore_access(self):
+        query_access = permissions._query_access
+
+        def revoke_during_check(user_id, document_id):
+            # The check read the old share list; the revoke commits before it caches the answer
+            allowed = query_access(user_id, document_id)
+            self.document.shared_with.remove(self.reader)
+            permissions.invalidate_document_access(self.document.id)
+            return allowed
+
+        with mock.patch.object(permissions, '_query_access', revoke_during_check):
+            self.assertTrue(permissions.has_document_access(self.reader, self.document.id))
+        self.assertFalse(permissions.has_document_access(self.reader, self.document.id))
+
+    def test_several_workers_need_a_shared_cache(self):
+        workers = {'a': 'ws://a', 'b': 'ws://b'}
+        with override_settings(COLLAB_WORKERS=workers):
+            with self.assertRaises(ImproperlyConfigured):
+                permissions.check_shared_cache()
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache'}}
+        with override_settings(COLLAB_WORKERS=workers, CACHES=shared):
+            permissions.check_shared_cache()
+
+
+# Document exports
+class ExportTests(TestCase):
+    def setUp(self):
+        # Renders are cached under the content hash
+        cache.clear()
+        self.user = User.objects.create_user('exporter', password='x')
+        self.client.force_login(self.user)
+
+    def read(self, response):
+        # Under ASGI the body is iterated on the event loop, where the ORM may not run
+        with self.assertNumQueries(0):
+            body = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        return body
+
+    def test_export_is_rendered_before_responding(self):
+        document = Document.objects.create(title='Plan', content='<h1>Plan</h1><p>first</p>', owner=self.user)
+        response = self.client.get(reverse('export_document', args=[document.id, 'md']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.read(response), b'# Plan\n\nfirst\n')
+
+    def test_export_all_includes_unhashed_documents(self):
+        first = Document.objects.create(title='One', content='<p>one</p>', owner=self.user)
+        Document.objects.create(title='Two', content='<p>two</p>', owner=self.user)
+        Document.objects.filter(id=first.id).update(content_hash='')
+        response = self.client.get(reverse('export_all_documents', args=['txt']))
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(self.read(response))) as archive:
+            self.assertEqual(archive.read('one.txt'), b'one\n')
+            self.assertEqual(archive.read('two.txt'), b'two\n')
+
+
+# Rate limits
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('limited', password='x')
+        self.document = Document.objects.create(title='Limited', content='<p>text</p>', owner=self.user)
+        self.client.force_login(self.user)
+
+    def test_views_work_without_redis(self):
+        response = self.client.get(reverse('get_document', args=[self.document.id]))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('document_presence', args=[self.document.id]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_limit_is_enforced(self):
+        limiter = ratelimit.InMemoryRateLimitBackend()
+        with self.settings(RATE_LIMITS={'export': (2, 60)}):
+            results = [limiter.check('export', 'user:1').allowed for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+
+    def test_unreachable_redis_fails_open(self):
+        # Nothing listens on port 1
+        limiter = ratelimit.RedisRateLimitBackend(port=1)
+        with self.assertLogs('hello.ratelimit', 'WARNING') as logs:
+            self.assertTrue(limiter.check('export', 'user:1').allowed)
+            self.assertTrue(limiter.check('export', 'user:1').allowed)
+        self.assertEqual(len(logs.records), 1)
+
+
+# Wire encoding of WebSocket messages
+class FramingTests(TestCase):
+    @skipIf(framing.msgpack is None, 'msgpack is not installed')
+    def test_deflated_frame_round_trip(self):
+        message = {'action': 'edit', 'content': '<p>text</p>' * 10000}
+        frame = framing.encode(message, framing.MSGPACK)['bytes_data']
+        self.assertTrue(frame[0] & framing.FLAG_DEFLATE)
+        self.assertEqual(framing.decode(bytes_data=frame), message)
+
+    @skipIf(framing.msgpack is None, 'msgpack is not installed')
+    def test_oversized_deflated_frame_is_rejected(self):
+        body = framing.msgpack.packb({'action': 'edit', 'content': 'a' * (2 * 1024 * 1024)})
+        frame = bytes([framing.FLAG_DEFLATE]) + zlib.compress(body, 9)
+        with mock.patch.object(framing, 'MAX_FRAME_BYTES', 1024 * 1024):
+            with self.assertRaises(ValueError):
+                framing.decode(bytes_data=frame)
+
+
+# Full-text search index
+class SearchTests(TestCase):
+    def setUp(self):
+        if not search._fts_tables_exist():
+            self.skipTest('SQLite FTS5 is not available')
+        self.backend = search.SQLiteFTSBackend()
+        self.owner = User.objects.create_user('owner', password='x')
+
+    def found(self, query):
+        hits, _ = self.backend.search(self.owner, query)
+        return [hit['id'] for hit in hits]
+
+    def test_words_of_adjacent_blocks_are_indexed_apart(self):
+        content = '<h1>Title</h1><p>alpha</p><p>bravo<br>charlie</p><ul><li>one</li><li>two</li></ul>'
+        document = Document.objects.create(title='Notes', content=content, owner=self.owner)
+        self.backend.index_document(document.id, document.title, content)
+        for word in ['title', 'alpha', 'bravo', 'charlie', 'two']:
+            self.assertEqual(self.found(word), [document.id], word)
+        self.assertEqual(self.found('titlealpha'), [])
+
+    def test_inline_tags_do_not_split_words(self):
+        content = '<p>un<b>break</b>able</p>'
+        document = Document.objects.create(title='Notes', content=content, owner=self.owner)
+        self.backend.index_document(document.id, document.title, content)
+        self.assertEqual(self.found('unbreakable'), [document.id])
+
+
+# Outgoing queues of WebSocket connections
+class SendQueueTests(TestCase):
+    def test_snapshot_chunks_count_as_one_frame(self):
+        async def run():
+            async def stalled_send(**frame):
+                await asyncio.Event().wait()
+
+            queue = backpressure.SendQueue(stalled_send, framing.JSON, max_frames=4, max_lag=60)
+            try:
+                with mock.patch.object(framing, 'SNAPSHOT_CHUNK_CHARS', 10):
+                    messages = framing.snapshot_messages('<p>paragraph</p>' * 20, 1)
+                self.assertGreater(len(messages), queue.max_frames)
+                self.assertTrue(all([queue.put(message) for message in messages]))
+                await asyncio.sleep(0)
+
+                # Other messages still count
+                operations = [queue.put({'action': 'operation', 'revision': 2, 'ops': []}) for _ in range(5)]
+                self.assertEqual(operations[-1], False)
+
+                # A new snapshot replaces the chunks of the old one
+                queue.put(messages[0])
+                self.assertEqual(len(queue), 1)
+                self.assertFalse(queue.is_slow())
+            finally:
+                queue.close()
+        async_to_sync(run)()
+
+    async def stalled_queue(self, **options):
+        # The writer takes a first message and never finishes sending it
+        async def stalled_send(**frame):
+            await asyncio.Event().wait()
+        queue = backpressure.SendQueue(stalled_send, framing.JSON, **options)
+        queue.put({'action': 'ack', 'revision': 1})
+        await asyncio.sleep(0)
+        return queue
+
+    def test_messages_are_sent_in_order(self):
+        sent = []
+
+        async def run():
+            async def send(text_data=None, bytes_data=None):
+                sent.append(json.loads(text_data)['revision'])
+            queue = backpressure.SendQueue(send, framing.JSON)
+            try:
+                for revision in range(1, 6):
+                    queue.put({'action': 'operation', 'revision': revision, 'ops': []})
+                for _ in range(10):
+                    await asyncio.sleep(0)
+            finally:
+                queue.close()
+        async_to_sync(run)()
+        self.assertEqual(sent, [1, 2, 3, 4, 5])
+
+    def test_newer_frames_supersede_pending_ones(self):
+        async def run():
+            queue = await self.stalled_queue()
+            try:
+                queue.put({'action': 'edit', 'content': 'a', 'revision': 2, 'replaced_length': 5})
+                queue.put({'action': 'edit', 'content': 'b', 'revision': 3, 'replaced_length': 1})
+                queue.put({'action': 'activity', 'cursors': [{'user': 'ann', 'position': 1}], 'typing': ['ann'], 'participants': None})
+                queue.put({'action': 'activity', 'cursors': [{'user': 'ann', 'position': 2}], 'typing': ['bob'], 'participants': ['ann']})
+                self.assertEqual([pending.message for pending in queue._pending], [
+                    {'action': 'edit', 'content': 'b', 'revision': 3, 'replaced_length': 5},
+                    {'action': 'activity', 'cursors': [{'user': 'ann', 'position': 2}], 'typing': ['ann', 'bob'], 'participants': ['ann']},
+                ])
+            finally:
+                queue.close()
+        async_to_sync(run)()
+
+    def test_client_is_slow_when_the_oldest_message_waits_too_long(self):
+        clock = PresenceTests.Clock()
+
+        async def run():
+            with mock.patch.object(backpressure, 'time', clock):
+                queue = await self.stalled_queue(max_frames=10, max_lag=5)
+                try:
+                    self.assertTrue(queue.put({'action': 'operation', 'revision': 2, 'ops': []}))
+                    clock.now += 6
+                    self.assertTrue(queue.is_slow())
+                    self.assertFalse(queue.put({'action': 'operation', 'revision': 3, 'ops': []}))
+                finally:
+                    queue.close()
+        async_to_sync(run)()
+
+    def test_slow_client_is_disconnected(self):
+        consumer = DocumentConsumer()
+        consumer.outbox = outbox = mock.MagicMock(put=mock.Mock(return_value=False))
+        consumer.user = 'slow'
+        consumer.close = mock.AsyncMock()
+        with self.assertLogs('hello.consumers', 'WARNING'):
+            async_to_sync(consumer.send_message)({'action': 'operation', 'revision': 2, 'ops': []})
+        outbox.close.assert_called_once_with()
+        consumer.close.assert_called_once_with(code=backpressure.SLOW_CLIENT_CLOSE_CODE)
+        self.assertIsNone(consumer.outbox)
+
+
+# Consistent hashing of document groups over shards and workers
+class ShardingTests(SimpleTestCase):
+    KEYS = [sharding.document_group(document_id) for document_id in range(2000)]
+
+    def test_placement_does_not_depend_on_node_order(self):
+        ring = sharding.HashRing(['s0', 's1', 's2'])
+        shuffled = sharding.HashRing(['s2', 's0', 's1'])
+        self.assertEqual([ring.node_for(key) for key in self.KEYS], [shuffled.node_for(key) for key in self.KEYS])
+        self.assertEqual(ring.moved(shuffled, self.KEYS), [])
+
+    def test_keys_are_spread_evenly(self):
+        ring = sharding.HashRing(['s0', 's1', 's2', 's3'])
+        counts = {}
+        for key in self.KEYS:
+            counts[ring.node_for(key)] = counts.get(ring.node_for(key), 0) + 1
+        self.assertEqual(set(counts), {'s0', 's1', 's2', 's3'})
+        self.assertTrue(all(0.15 < count / len(self.KEYS) < 0.35 for count in counts.values()), counts)
+
+    def test_adding_a_shard_only_moves_keys_to_it(self):
+        old = sharding.HashRing(['s0', 's1', 's2'])
+        new = sharding.HashRing(['s0', 's1', 's2', 's3'])
+        moved = old.moved(new, self.KEYS)
+        self.assertTrue(0.15 < len(moved) / len(self.KEYS) < 0.35, len(moved))
+        self.assertEqual({new.node_for(key) for key in moved}, {'s3'})
+
+    def test_removing_a_shard_only_moves_its_keys(self):
+        old = sharding.HashRing(['s0', 's1', 's2'])
+        new = sharding.HashRing(['s0', 's2'])
+        moved = old.moved(new, self.KEYS)
+        self.assertEqual(moved, [key for key in self.KEYS if old.node_for(key) == 's1'])
+
+    def test_ring_needs_a_node(self):
+        with self.assertRaises(ValueError):
+            sharding.HashRing([])
+
+    @override_settings(
+        CHANNEL_LAYERS={
+            'default': {'BACKEND': 'hello.sharding.ShardedChannelLayer', 'CONFIG': {'shards': ['s0', 's1']}},
+            's0': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+            's1': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+        },
+    )
+    def test_group_messages_stay_on_the_owning_shard(self):
+        async def run():
+            layer = get_channel_layer()
+            group = sharding.document_group(7)
+            alias = layer.alias_for(group)
+            self.assertEqual(sharding.channel_layer_alias(7), alias)
+            channel = await get_channel_layer(alias).new_channel(f'{alias}.specific.')
+            self.assertEqual(layer.alias_for(channel), alias)
+            await layer.group_add(group, channel)
+            await layer.group_send(group, {'type': 'hello'})
+            self.assertEqual(await asyncio.wait_for(layer.receive(channel), 1), {'type': 'hello'})
+            other = 's1' if alias == 's0' else 's0'
+            self.assertEqual(get_channel_layer(other).groups, {})
+        async_to_sync(run)()
+
+    def test_each_document_has_one_owning_worker(self):
+        workers = {'w1': 'ws://w1', 'w2': 'ws://w2'}
+        urls = {}
+        for worker in workers:
+            with self.settings(COLLAB_WORKERS=workers, COLLAB_WORKER_ID=worker):
+                urls[worker] = [sharding.worker_url_for(document_id) for document_id in range(50)]
+        for first, second in zip(urls['w1'], urls['w2']):
+            # Exactly one worker serves the document itself; the other redirects to it
+            self.assertIn((first, second), [(None, 'ws://w1'), ('ws://w2', None)])
+        self.assertIn(None, urls['w1'])
+        self.assertIn(None, urls['w2'])
+
+
+# The Prometheus metrics endpoint
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.url = reverse('metrics')
+
+    def test_scraper_addresses_are_allowed(self):
+        response = self.client.get(self.url, REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE collab_messages_received_total counter', response.content.decode())
+        with self.settings(METRICS_ALLOWED_IPS=['10.0.0.5']):
+            self.assertEqual(self.client.get(self.url, REMOTE_ADDR='10.0.0.5').status_code, 200)
+            self.assertEqual(self.client.get(self.url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+    def test_other_addresses_need_a_staff_user(self):
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='203.0.113.9').status_code, 403)
+        user = User.objects.create_user('watcher', password='x')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='203.0.113.9').status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='203.0.113.9').status_code, 200)
+
+    def test_series_are_rendered_with_their_labels(self):
+        metrics.messages_received.inc(metrics.action_label('typing'))
+        # Unknown actions share one series, so clients cannot add series at will
+        metrics.messages_received.inc(metrics.action_label('made-up'))
+        metrics.document_save_bytes.observe(2000)
+        rendered = metrics.render()
+        self.assertRegex(rendered, r'collab_messages_received_total\{action="typing"\} \d+')
+        self.assertRegex(rendered, r'collab_messages_received_total\{action="other"\} \d+')
+        self.assertNotIn('made-up', rendered)
+        self.assertRegex(rendered, r'document_save_bytes_bucket\{le="\+Inf"\} \d+')
+
+
+# Timing spans and query counts of requests and messages
+class TracingTests(TestCase):
+    def setUp(self):
+        patches = [mock.patch.object(tracing, 'ENABLED', True), mock.patch.object(tracing, 'SLOW_MS', 10 ** 6)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_nothing_is_traced_when_disabled(self):
+        with mock.patch.object(tracing, 'ENABLED', False), tracing.trace('off') as current:
+            self.assertIsNone(current)
+            self.assertIs(tracing.span('step'), tracing._NOOP)
+
+    def test_spans_count_the_queries_made_inside_them(self):
+        connection = connections['default']
+        with connection.execute_wrapper(tracing.count_query), tracing.trace('request') as current:
+            # Nested traces belong to the outer one
+            with tracing.trace('inner') as inner:
+                self.assertIsNone(inner)
+            with tracing.span('outer'):
+                User.objects.count()
+                with tracing.span('inner'):
+                    User.objects.count()
+                    User.objects.count()
+        self.assertEqual(current.queries, 3)
+        spans = {name: (queries, depth) for name, _, _, queries, depth in current.spans}
+        self.assertEqual(spans, {'outer': (3, 0), 'inner': (2, 1)})
+        # A finished trace no longer collects spans
+        self.assertIsNone(tracing.current_trace())
+        self.assertIs(tracing.span('late'), tracing._NOOP)
+
+    def test_responses_carry_server_timing(self):
+        user = User.objects.create_user('timed', password='x')
+        document = Document.objects.create(title='Timed', content='<p>a</p>', owner=user)
+        self.client.force_login(user)
+        with connections['default'].execute_wrapper(tracing.count_query):
+            response = self.client.post(
+                reverse('save_document', args=[document.id]), json.dumps({'content': '<p>a</p>'}),
+                content_type='application/json',
+            )
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertIn('parse;dur=', timing)
+
+    def test_slow_traces_are_logged_and_sampled_traces_profiled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.multiple(tracing, SLOW_MS=0, PROFILE_SAMPLE_RATE=1, PROFILE_DIR=directory, PROFILE_INTERVAL_MS=1):
+                with self.assertLogs('hello.tracing', 'INFO') as logs, tracing.trace('slow'):
+                    with tracing.span('sleep'):
+                        time.sleep(0.05)
+            profiles = os.listdir(directory)
+            self.assertEqual(len(profiles), 1)
+            with open(os.path.join(directory, profiles[0])) as f:
+                self.assertIn('test_slow_traces_are_logged_and_sampled_traces_profiled', f.read())
+        self.assertTrue(any('slow' in line and 'sleep' in line for line in logs.output))
+
+
+# Tracing of database calls made from consumers; database_sync_to_async closes
+# connections, so this stays outside TestCase's transaction
+class AsyncTracingTests(TransactionTestCase):
+    @mock.patch.object(tracing, 'ENABLED', True)
+    def test_database_calls_from_async_code_join_the_trace(self):
+        @tracing.database_sync_to_async
+        def lookup():
+            return tracing.current_trace()
+
+        async def run():
+            with tracing.trace('message') as current:
+                self.assertIs(await lookup(), current)
+            return current
+        current = async_to_sync(run)()
+        self.assertEqual([span[0] for span in current.spans], ['db:lookup'])
+
+
+# Live sessions reached from workers that do not own the document
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    COLLAB_WORKERS={'w1': 'ws://w1', 'w2': 'ws://w2'},
+)
+class WorkerRoutingTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('router', password='x')
+        self.document = Document.objects.create(title='Routed', content='<p>stored</p>', owner=self.user)
+        owner = sharding.HashRing(['w1', 'w2']).node_for(sharding.document_group(self.document.id))
+        self.owner, self.other = owner, 'w2' if owner == 'w1' else 'w1'
+        self.presence = InMemoryPresenceBackend()
+        # One process plays both workers; nothing is journaled and writes are direct
+        patches = [
+            mock.patch.object(journal, 'JOURNAL_DIR', None),
+            mock.patch.object(persistence, 'WRITE_QUEUE', False),
+            mock.patch.object(sessions, 'SESSION_LINGER', 0),
+            mock.patch.object(sessions, 'get_presence_backend', lambda: self.presence),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def join(self):
+        async def load():
+            return await sync_to_async(load_content)(self.document.id)
+        with self.settings(COLLAB_WORKER_ID=self.owner):
+            return await sessions.registry.join(self.document.id, 'specific.test', load)
+
+    async def leave(self):
+        with self.settings(COLLAB_WORKER_ID=self.owner):
+            await sessions.registry.leave(self.document.id, 'specific.test')
+
+    def stored_content(self):
+        return load_content(self.document.id)
+
+    def test_http_save_on_another_worker_reaches_the_session(self):
+        async def run():
+            session = await self.join()
+            try:
+                with self.settings(COLLAB_WORKER_ID=self.other):
+                    await sessions.registry.forward_content(self.document.id, '<p>saved elsewhere</p>', self.user)
+                for _ in range(100):
+                    if session.content == '<p>saved elsewhere</p>':
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(session.content, '<p>saved elsewhere</p>')
+            finally:
+                await self.leave()
+        async_to_sync(run)()
+        self.assertEqual(self.stored_content(), '<p>saved elsewhere</p>')
+
+    def test_reads_on_another_worker_flush_the_session_first(self):
+        async def run():
+            session = await self.join()
+            try:
+                self.presence.touch(self.document.id, 'router', 'specific.test')
+                session.commit([{'type': 'insert', 'pos': 0, 'text': '<p>live</p>'}], session.revision)
+                self.assertNotEqual(await sync_to_async(self.stored_content)(), session.content)
+                with self.settings(COLLAB_WORKER_ID=self.other):
+                    self.assertTrue(await sessions.registry.flush_remote([self.document.id]))
+                self.assertEqual(await sync_to_async(self.stored_content)(), session.content)
+            finally:
+                await self.leave()
+        async_to_sync(run)()
+
+    def test_reshard_reaches_every_worker(self):
+        cache.clear()
+        first = sharding.ShardedChannelLayer(['s0', 's1'])
+        second = sharding.ShardedChannelLayer(['s0', 's1'])
+        async_to_sync(first.reshard)(['s0', 's1', 's2'], groups=[])
+        with mock.patch.object(sharding, 'SHARD_CHECK_INTERVAL', 0):
+            groups = [sharding.document_group(document_id) for document_id in range(200)]
+            self.assertEqual([second.alias_for(g) for g in groups], [first.alias_for(g) for g in groups])
+            self.assertIn('s2', {second.alias_for(g) for g in groups})
+
+
+# Live sessions buffering edits and writing them behind
+class SessionFlushTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buffered', password='x')
+        self.document = Document.objects.create(
+            title='Buffered', content='<p>a</p>', content_hash=hash_content('<p>a</p>'), owner=self.user
+        )
+        patches = [
+            mock.patch.object(journal, 'JOURNAL_DIR', None),
+            mock.patch.object(persistence, 'WRITE_QUEUE', False),
+            mock.patch.object(sessions, 'SESSION_LINGER', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def versions(self):
+        return DocumentVersion.objects.filter(document=self.document).count()
+
+    def test_edits_are_written_once_per_flush(self):
+        async def run():
+            session = sessions.DocumentSession(self.document.id, '<p>a</p>')
+            for revision, text in enumerate('bcd'):
+                session.commit([{'type': 'insert', 'pos': 4 + revision, 'text': text}], revision, self.user.id)
+            self.assertEqual(await sync_to_async(load_content)(self.document.id), '<p>a</p>')
+            self.assertTrue(await session.flush())
+            self.assertFalse(session.dirty)
+            # Nothing new to write
+            self.assertFalse(await session.flush())
+        async_to_sync(run)()
+        self.assertEqual(load_content(self.document.id), '<p>abcd</p>')
+        self.assertEqual(self.versions(), 1)
+
+    def test_edits_that_cancel_out_are_not_written(self):
+        async def run():
+            session = sessions.DocumentSession(self.document.id, '<p>a</p>')
+            session.commit([{'type': 'insert', 'pos': 4, 'text': 'b'}], 0)
+            session.commit([{'type': 'delete', 'pos': 4, 'length': 1}], 1)
+            self.assertFalse(await session.flush())
+            self.assertFalse(session.dirty)
+        async_to_sync(run)()
+        self.assertEqual(self.versions(), 0)
+
+    def test_large_edits_request_an_early_flush(self):
+        with mock.patch.object(sessions, 'FLUSH_BYTES', 10):
+            session = sessions.DocumentSession(self.document.id, '')
+            session.commit([{'type': 'insert', 'pos': 0, 'text': 'x' * 9}], 0)
+            self.assertFalse(session.flush_requested.is_set())
+            session.commit([{'type': 'insert', 'pos': 0, 'text': 'x'}], 1)
+            self.assertTrue(session.flush_requested.is_set())
+
+    def test_last_connection_leaving_writes_the_session(self):
+        async def run():
+            async def load():
+                return await sync_to_async(load_content)(self.document.id)
+            session = await sessions.registry.join(self.document.id, 'first.test', load)
+            self.assertIs(await sessions.registry.join(self.document.id, 'second.test', load), session)
+            session.commit([{'type': 'insert', 'pos': 4, 'text': 'b'}], 0, self.user.id)
+            self.assertEqual(await sessions.registry.leave(self.document.id, 'first.test'), (session, False))
+            self.assertEqual(await sync_to_async(load_content)(self.document.id), '<p>a</p>')
+            self.assertEqual(await sessions.registry.leave(self.document.id, 'second.test'), (session, True))
+            self.assertIsNone(sessions.registry.get(self.document.id))
+        async_to_sync(run)()
+        self.assertEqual(load_content(self.document.id), '<p>ab</p>')
+
+
+# Editors connected to a document's live session over the WebSocket
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class LiveSessionTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('live', password='x')
+        self.document = Document.objects.create(title='Live', content='<p>a</p>', owner=self.user)
+        patches = [
+            mock.patch.object(journal, 'JOURNAL_DIR', None),
+            mock.patch.object(persistence, 'WRITE_QUEUE', False),
+            mock.patch.object(sessions, 'SESSION_LINGER', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def connect(self, client, resume=None):
+        query = f'client={client}' + (f'&resume={resume}' if resume else '')
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/documents/{self.document.id}/?{query}', subprotocols=['collab.json']
+        )
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect(timeout=5)
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator, action):
+        # Skips presence and activity messages
+        while True:
+            message = json.loads(await communicator.receive_from(timeout=5))
+            if message['action'] == action:
+                return message
+
+    async def send(self, communicator, message):
+        await communicator.send_to(text_data=json.dumps(message))
+
+    def test_snapshot_names_the_last_committed_batch(self):
+        insert = [{'type': 'insert', 'pos': 4, 'text': 'b'}]
+
+        async def run():
+            editor = await self.connect('c1')
+            snapshot = await self.receive(editor, 'snapshot')
+            self.assertIsNone(snapshot['committed'])
+            await self.send(editor, {'action': 'operation', 'revision': snapshot['revision'], 'ops': insert, 'batch': 1})
+            await self.receive(editor, 'ack')
+            # A batch the session rejects is not committed
+            await self.send(editor, {'action': 'operation', 'revision': 99, 'ops': insert, 'batch': 2})
+            await self.receive(editor, 'error')
+            await editor.disconnect()
+
+            # The session closed with the last connection, so the editor gets a new snapshot
+            editor = await self.connect('c1', resume=f"{snapshot['session']}.{snapshot['revision']}")
+            snapshot = await self.receive(editor, 'snapshot')
+            self.assertEqual((snapshot['content'], snapshot['committed']), ('<p>ab</p>', 1))
+            other = await self.connect('c2')
+            self.assertIsNone((await self.receive(other, 'snapshot'))['committed'])
+            await other.disconnect()
+            await editor.disconnect()
+        async_to_sync(run)()
+
+
+# Concurrent saves on SQLite, with and without the write queue
+class WriteQueueTests(TransactionTestCase):
+    SAVERS = 200
+    SAVES = 10
+
+    def setUp(self):
+        self.user = User.objects.create_user('saver', password='x')
+        self.document_ids = [Document.objects.create(title=f'Doc {i}', content='', owner=self.user).id for i in range(4)]
+        # Fail at once instead of waiting out the busy timeout, so every collision shows
+        patch = mock.patch.dict(connections.databases['default']['OPTIONS'], {'timeout': 0})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def run_savers(self, save):
+        # Returns the number of "database is locked" errors
+        errors = []
+        start = threading.Barrier(self.SAVERS)
+
+        def saver(index):
+            try:
+                start.wait()
+                for round_number in range(self.SAVES):
+                    document_id = self.document_ids[(index + round_number) % len(self.document_ids)]
+                    try:
+                        save(document_id, f'<p>saver {index} round {round_number}</p>', self.user.id)
+                    except OperationalError as e:
+                        errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=saver, args=(index,)) for index in range(self.SAVERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all('locked' in str(e) for e in errors), errors[:1])
+        return len(errors)
+
+    def test_direct_writes_collide(self):
+        self.assertGreater(self.run_savers(persistence.store_document_content), 0)
+
+    def test_queued_writes_do_not_collide(self):
+        with mock.patch.object(persistence, 'WRITE_QUEUE', True):
+            self.assertEqual(self.run_savers(persistence.write_document_content), 0)
+        for document_id in self.document_ids:
+            self.assertTrue(DocumentVersion.objects.filter(document_id=document_id).exists())
+
+
+# The fan-out benchmark command
+class BenchFanoutTests(TransactionTestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(journal, 'JOURNAL_DIR', None),
+            mock.patch.object(persistence, 'WRITE_QUEUE', False),
+            mock.patch.object(sessions, 'SESSION_LINGER', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def bench(self, *args):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command(
+            'bench_fanout', '--documents=1', '--editors=2', '--duration=0.2', *args, stdout=stdout, stderr=stderr,
+        )
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_stdout_is_only_the_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = os.path.join(directory, 'baseline.json')
+            self.bench(f'--output={baseline}')
+            stdout, stderr = self.bench(f'--baseline={baseline}', '--tolerance=1000')
+        report = json.loads(stdout)
+        self.assertEqual(report['connections'], 2)
+        self.assertIn('messages received/s', stderr)
+
+
+# The HTTP view benchmark command
+class BenchViewsTests(TransactionTestCase):
+    def setUp(self):
+        patch = mock.patch.object(journal, 'JOURNAL_DIR', None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def bench(self, budgets):
+        with tempfile.TemporaryDirectory() as directory:
+            budgets_path = os.path.join(directory, 'budgets.json')
+            output = os.path.join(directory, 'results.json')
+            with open(budgets_path, 'w') as f:
+                json.dump(budgets, f)
+            try:
+                call_command(
+                    'bench_views', '--document-mb=0.05', '--versions=30', '--documents=5', '--shares=3',
+                    '--iterations=2', f'--budgets={budgets_path}', f'--output={output}', stdout=io.StringIO(),
+                )
+            finally:
+                with open(output) as f:
+                    self.results = json.load(f)['results']
+
+    # Timings on a test machine say little; the query budgets still apply
+    RELAXED = {name: {'p95_ms': 10 ** 6} for name in DEFAULT_BUDGETS}
+
+    def test_every_scenario_runs_within_its_query_budget(self):
+        self.bench(self.RELAXED)
+        self.assertEqual(set(self.results), set(DEFAULT_BUDGETS))
+        self.assertFalse(User.objects.filter(username__startswith='bench-').exists())
+
+    def test_over_budget_scenarios_fail(self):
+        with self.assertRaisesMessage(CommandError, 'Over budget: get_document'):
+            self.bench(dict(self.RELAXED, get_document={'queries': 0}))
+        self.assertGreater(self.results['get_document']['queries'], 0)
+
+
+# Runs hello/static/hello/editor.js with stand-ins for the DOM, WebSocket, timers
+# and fetch. A scenario is the body of an async function of `h`; it returns a
+# JSON-serializable result.
+EDITOR_HARNESS = r"""
+const fs = require('fs');
+const vm = require('vm');
+
+function element(id) {
+    return {
+        id: id, innerHTML: '', contentEditable: 'true', style: {}, dataset: {}, children: [], listeners: {},
+        classList: { add() {} },
+        addEventListener(type, listener) { (this.listeners[type] = this.listeners[type] || []).push(listener); },
+        appendChild(child) { this.children.push(child); },
+        removeChild(child) { this.children = this.children.filter(c => c !== child); },
+        contains() { return false; },
+        insertAdjacentHTML(position, html) { this.innerHTML += html; },
+        getBoundingClientRect() { return { left: 0, top: 0 }; },
+    };
+}
+
+function load() {
+    const elements = {};
+    const byId = id => elements[id] = elements[id] || element(id);
+    const sockets = [];
+    const timers = new Map();
+    const fetches = [];
+    let nextTimer = 1;
+
+    class FakeSocket {
+        constructor(url) {
+            this.url = url;
+            this.readyState = FakeSocket.OPEN;
+            this.protocol = 'collab.json';
+            this.sent = [];
+            sockets.push(this);
+        }
+        send(data) { this.sent.push(JSON.parse(data)); }
+    }
+    FakeSocket.OPEN = 1;
+
+    const schedule = (repeat) => (fn, delay) => { timers.set(nextTimer, { fn, repeat }); return nextTimer++; };
+    const quiet = () => {};
+    const window = {
+        docId: 1, currentUser: 'me', location: { protocol: 'http:', host: 'testserver' },
+        getSelection: () => ({ rangeCount: 0, removeAllRanges() {}, addRange() {} }),
+    };
+    const sandbox = {
+        window, WebSocket: FakeSocket, crypto: { randomUUID: () => 'client-1' },
+        console: { log: quiet, warn: quiet, error: quiet },
+        setTimeout: schedule(false), setInterval: schedule(true),
+        clearTimeout: id => timers.delete(id), clearInterval: id => timers.delete(id),
+        fetch: (url, options) => {
+            fetches.push({ url, method: (options && options.method) || 'GET', body: options && options.body });
+            return Promise.resolve({ ok: true, json: () => Promise.resolve({ status: 'success', content: h.stored }) });
+        },
+        document: {
+            cookie: '', getElementById: byId, createElement: () => element(null),
+            querySelector: () => null, addEventListener() {},
+            createRange: () => ({ setStart() {}, collapse() {}, getBoundingClientRect: () => ({ left: 0, top: 0 }) }),
+        },
+    };
+    window.crypto = sandbox.crypto;
+    vm.runInNewContext(fs.readFileSync(process.env.EDITOR_JS, 'utf8'), sandbox);
+
+    const editor = byId('editor');
+    const settle = () => new Promise(resolve => setImmediate(resolve));
+    const h = {
+        editor, sockets, fetches, stored: '', element: byId,
+        get socket() { return sockets[sockets.length - 1]; },
+        async deliver(message) {
+            h.socket.onmessage({ data: JSON.stringify(message) });
+            for (let i = 0; i < 5; i++) await settle();
+        },
+        type(html) {
+            editor.innerHTML = html;
+            (editor.listeners.input || []).forEach(listener => listener());
+        },
+        drop(code = 1006) {
+            const socket = h.socket;
+            socket.readyState = 3;
+            socket.onclose({ code });
+        },
+        // Runs every pending timer once; intervals stay scheduled
+        async runTimers() {
+            for (const [id, timer] of [...timers]) {
+                if (!timer.repeat) timers.delete(id);
+                timer.fn();
+            }
+            for (let i = 0; i < 5; i++) await settle();
+        },
+        saves() { return fetches.filter(f => f.method === 'POST').map(f => JSON.parse(f.body).content); },
+    };
+    return h;
+}
+
+async function run(scenario) {
+    const result = await scenario(load());
+    process.stdout.write(JSON.stringify(result === undefined ? null : result));
+}
+"""
+
+
+@skipIf(shutil.which('node') is None, 'node is not installed')
+class EditorScriptTests(SimpleTestCase):
+    def run_editor(self, scenario):
+        script = EDITOR_HARNESS + f'run(async (h) => {{\n{scenario}\n}});'
+        path = os.path.join(settings.BASE_DIR, 'hello', 'static', 'hello', 'editor.js')
+        result = subprocess.run(
+            ['node', '-e', script], env=dict(os.environ, EDITOR_JS=path), capture_output=True, text=True, timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout)
+
+    def test_partial_snapshot_is_never_saved(self):
+        saves = self.run_editor("""
+            await h.deliver({ action: 'snapshot', content: '<p>one</p><p>two</p>', revision: 1, session: 's1', chunks: 1 });
+            h.drop();
+            await h.runTimers();
+            // The reconnect gets a chunked snapshot and drops again before the rest arrives
+            await h.deliver({ action: 'snapshot', content: '<p>one</p>', revision: 4, session: 's2', chunks: 2 });
+            h.drop();
+            await h.runTimers();
+            await h.runTimers();
+            return h.saves();
+        """)
+        self.assertEqual(saves, [])
+
+    def test_committed_batch_is_not_sent_again(self):
+        result = self.run_editor("""
+            await h.deliver({ action: 'snapshot', content: '<p>a</p>', revision: 1, session: 's1', chunks: 1 });
+            h.type('<p>ab</p>');
+            const sent = h.socket.sent.filter(m => m.action === 'operation');
+            // The session closed before the acknowledgement came, but it committed the batch
+            h.drop();
+            await h.runTimers();
+            await h.deliver({ action: 'snapshot', content: '<p>ab</p>', revision: 2, session: 's2', chunks: 1, committed: sent[0].batch });
+            return { content: h.editor.innerHTML, resent: h.socket.sent.filter(m => m.action === 'operation') };
+        """)
+        self.assertEqual(result, {'content': '<p>ab</p>', 'resent': []})
+
+    def test_uncommitted_batch_is_sent_again(self):
+        result = self.run_editor("""
+            await h.deliver({ action: 'snapshot', content: '<p>a</p>', revision: 1, session: 's1', chunks: 1 });
+            h.type('<p>ab</p>');
+            const sent = h.socket.sent.filter(m => m.action === 'operation');
+            // Someone else's edit is all the new session has
+            h.drop();
+            await h.runTimers();
+            await h.deliver({ action: 'snapshot', content: '<p>xa</p>', revision: 2, session: 's2', chunks: 1, committed: sent[0].batch - 1 });
+            return { content: h.editor.innerHTML, sent: sent, resent: h.socket.sent.filter(m => m.action === 'operation') };
+        """)
+        self.assertEqual(result['content'], '<p>xab</p>')
+        self.assertEqual(len(result['resent']), 1)
+        self.assertEqual(result['resent'][0]['ops'], [{'type': 'insert', 'pos': 5, 'text': 'b'}])
+        self.assertGreater(result['resent'][0]['batch'], result['sent'][0]['batch'])
+
+    def test_other_cursors_stay_out_of_the_content(self):
+        result = self.run_editor("""
+            await h.deliver({ action: 'snapshot', content: '<p>a</p>', revision: 1, session: 's1', chunks: 1 });
+            await h.deliver({ action: 'activity', cursors: [{ user: 'other', position: { path: [], offset: 0 } }], typing: [] });
+            return { editor: h.editor.children.length, overlay: h.element('cursor-overlay').children.length };
+        """)
+        self.assertEqual(result, {'editor': 0, 'overlay': 1})
+
+    def test_legacy_edit_moves_the_sender_cursor(self):
+        cursors = self.run_editor("""
+            await h.deliver({ action: 'snapshot', content: '<p>a</p>', revision: 1, session: 's1', chunks: 1 });
+            await h.deliver({
+                action: 'edit', content: '<p>b</p>', user: 'other', revision: 2, replaced_length: 8,
+                cursor_position: { path: [], offset: 0 },
+            });
+            return h.element('cursor-overlay').children.length;
+        """)
+        self.assertEqual(cursors, 1)
+
+    def test_truncated_editor_reloads_over_http_before_saving(self):
+        result = self.run_editor("""
+            h.stored = '<p>one</p><p>two</p>';
+            await h.deliver({ action: 'snapshot', content: '<p>one</p>', revision: 1, session: 's1', chunks: 2 });
+            // Not a dropped connection, so the editor gives up on the socket
+            h.drop(1011);
+            await h.runTimers();
+            await h.runTimers();
+            return { content: h.editor.innerHTML, saves: h.saves() };
+        """)
+        self.assertEqual(result['content'], '<p>one</p><p>two</p>')
+        self.assertEqual(result['saves'], ['<p>one</p><p>two</p>'])
@@ -0,0 +1,276 @@
+"""
+Timing spans and query counts per HTTP request and WebSocket message.
+
+With TRACING_ENABLED, TracingMiddleware and DocumentConsumer.dispatch open a
+Trace for every request or incoming message. Code along the way marks the
+steps worth timing with `span(name)` (parsing, permission checks, rate
+limits, the content update, the version insert...). Every query made while
+a trace is active counts towards it, including queries run in
+database_sync_to_async threads and by the document writer on the trace's
+behalf. Traces slower than TRACING_SLOW_MS are logged, and HTTP responses
+carry them in a Server-Timing header for the browser's dev tools.
+
+PROFILE_SAMPLE_RATE is the fraction of traces that are also profiled. A
+thread samples the traced thread's stack every PROFILE_INTERVAL_MS and the
+samples are written to PROFILE_DIR as folded stacks, which flamegraph.pl and
+speedscope read directly. For WebSocket messages the traced thread is the
+event loop, so its profile also shows whatever else ran on the loop.
+
+When tracing is off, `span()` costs one context variable lookup.
+"""
+import contextvars
+import functools
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from channels.db import database_sync_to_async as channels_database_sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'TRACING_ENABLED', False)
+
+# Traces at least this slow are logged; 0 logs every trace
+SLOW_MS = getattr(settings, 'TRACING_SLOW_MS', 200)
+
+# Fraction of traces that are profiled
+PROFILE_SAMPLE_RATE = getattr(settings, 'PROFILE_SAMPLE_RATE', 0.0)
+
+# Directory the folded-stack profiles are written to
+PROFILE_DIR = getattr(settings, 'PROFILE_DIR', None) or Path(settings.BASE_DIR) / 'profiles'
+
+# Milliseconds between profiler samples
+PROFILE_INTERVAL_MS = getattr(settings, 'PROFILE_INTERVAL_MS', 5)
+
+_current = contextvars.ContextVar('hello_trace', default=None)
+
+_NOOP = nullcontext()
+
+
+class Trace:
+    """
+    Spans and queries of one request or message.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        # (name, start offset, duration, queries, depth), in the order they ended
+        self.spans = []
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.depth = 0
+        self.finished = False
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        self.finished = True
+
+    def summary(self):
+        spans = ', '.join(
+            f"{'  ' * depth}{name} {duration * 1000:.1f}ms/{queries}q"
+            for name, _, duration, queries, depth in sorted(self.spans, key=lambda span: span[1])
+        )
+        return (f"{self.name} {self.duration * 1000:.1f}ms, {self.queries} queries "
+                f"({self.query_seconds * 1000:.1f}ms) [{spans}]")
+
+    def server_timing(self):
+        """
+        Returns the trace as a Server-Timing header value.
+        """
+        entries = [f'total;dur={self.duration * 1000:.1f}',
+                   f'db;dur={self.query_seconds * 1000:.1f};desc="{self.queries} queries"']
+        totals = {}
+        for name, _, duration, _, _ in self.spans:
+            totals[name] = totals.get(name, 0) + duration
+        for name, duration in totals.items():
+            entries.append(f"{re.sub(r'[^A-Za-z0-9_.-]', '-', name)};dur={duration * 1000:.1f}")
+        return ', '.join(entries)
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'started', 'queries')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.queries = self.trace.queries
+        self.trace.depth += 1
+
+    def __exit__(self, *exc_info):
+        trace = self.trace
+        trace.depth -= 1
+        trace.spans.append((
+            self.name, self.started - trace.started, time.perf_counter() - self.started,
+            trace.queries - self.queries, trace.depth,
+        ))
+
+
+def current_trace():
+    trace = _current.get()
+    if trace is None or trace.finished:
+        return None
+    return trace
+
+
+def span(name):
+    """
+    Context manager timing a step of the current trace, if there is one.
+    """
+    trace = _current.get()
+    if trace is None or trace.finished:
+        return _NOOP
+    return _Span(trace, name)
+
+
+def traced(name=None):
+    """
+    Decorator running a function in a span (named after the function by default).
+    """
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def database_sync_to_async(function):
+    """
+    channels.db.database_sync_to_async that records the call as a span. The
+    trace's context is carried into the worker thread, so its queries count.
+    """
+    return channels_database_sync_to_async(traced(f'db:{function.__name__}')(function))
+
+
+@contextmanager
+def trace(name, thread_id=None):
+    """
+    Traces the block as one request or message, unless tracing is off or a
+    trace is already active. Yields the Trace or None.
+    """
+    if not ENABLED or current_trace() is not None:
+        yield None
+        return
+
+    current = Trace(name)
+    token = _current.set(current)
+    profiler = None
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = SamplingProfiler(thread_id or threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        current.finish()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(current.name)
+        if current.duration * 1000 >= SLOW_MS:
+            logger.info(current.summary())
+
+
+def count_query(execute, sql, params, many, context):
+    """
+    Execute wrapper adding every query to the active trace.
+    """
+    trace = _current.get()
+    if trace is None or trace.finished:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        trace.queries += 1
+        trace.query_seconds += time.perf_counter() - started
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """
+    connection_created handler installing count_query on the connection.
+    """
+    if ENABLED and count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread from a background thread.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='trace-profiler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_fold(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, name):
+        """
+        Writes the samples as folded stacks ("outer;inner count" lines).
+        """
+        if not self.stacks:
+            return None
+        directory = Path(PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9_.-]+', '-', name).strip('-')[:60]
+        path = directory / f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:6]}.folded"
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.info(f"Profile of {name} written to {path}")
+        return path
+
+
+def _fold(frame):
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class TracingMiddleware:
+    """
+    Traces each request and adds a Server-Timing header to its response.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not ENABLED:
+            return self.get_response(request)
+        with trace(f'{request.method} {request.path}') as current:
+            response = self.get_response(request)
+            if current is not None and request.resolver_match is not None:
+                current.name = f'{request.method} {request.resolver_match.view_name}'
+        if current is not None:
+            response['Server-Timing'] = current.server_timing()
+        return response
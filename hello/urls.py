@@ -18,6 +18,15 @@ urlpatterns = [
     # URL to list all documents (owned and shared), handled by the document_list view
     path('documents/', views.document_list, name='document_list'),
 
+    # URL returning pages of the document list as JSON, handled by the document_list_api view
+    path('documents/api/', views.document_list_api, name='document_list_api'),
+
+    # URL returning ranked search results as JSON, handled by the search_documents view
+    path('documents/search/', views.search_documents, name='search_documents'),
+
+    # URL downloading all of the user's documents as a ZIP archive, handled by the export_all_documents view
+    path('documents/export/<str:export_format>/', views.export_all_documents, name='export_all_documents'),
+
     # URL to create a new document, handled by the create_document view
     path('documents/create/', views.create_document, name='create_document'),
 
@@ -30,20 +39,35 @@ urlpatterns = [
     # URL to retrieve the content of a specific document by its ID, handled by the get_document view
     path('documents/<int:doc_id>/', views.get_document, name='get_document'),
 
+    # URL to download a specific document in an export format, handled by the export_document view
+    path('documents/<int:doc_id>/export/<str:export_format>/', views.export_document, name='export_document'),
+
     # URL to delete a specific document by its ID, handled by the delete_document view
     path('documents/<int:doc_id>/delete/', views.delete_document, name='delete_document'),
 
+    # URL listing the users currently connected to a document, handled by the document_presence view
+    path('documents/<int:doc_id>/presence/', views.document_presence, name='document_presence'),
+
     # URL to share a specific document with other users, handled by the share_document view
     path('documents/<int:doc_id>/share/', views.share_document, name='share_document'),
 
     # URL to view the version history of a specific document, handled by the version_history view
     path('documents/<int:doc_id>/versions/', views.version_history, name='version_history'),
 
+    # URL returning pages of the version history as JSON, handled by the version_history_api view
+    path('documents/<int:doc_id>/versions/api/', views.version_history_api, name='version_history_api'),
+
     # URL to view a specific version of a document, handled by the view_version view
     path('documents/<int:doc_id>/versions/<int:version_id>/view/', views.view_version, name='view_version'),
 
+    # URL to download a specific version of a document, handled by the export_version view
+    path('documents/<int:doc_id>/versions/<int:version_id>/export/<str:export_format>/', views.export_version, name='export_version'),
+
     # URL to revert a document to a specific version, handled by the revert_version view
     path('documents/<int:doc_id>/versions/<int:version_id>/revert/', views.revert_version, name='revert_version'),
 
+    # URL exposing process metrics to Prometheus, handled by the metrics_view
+    path('metrics/', views.metrics_view, name='metrics'),
+
     # Additional URL patterns can be added here as needed
 ]
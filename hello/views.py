@@ -1,25 +1,41 @@
 import json
+from functools import partial
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from .models import Document, DocumentVersion
+from .models import Document, DocumentVersion, hash_content
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.cache import never_cache
 from django.core.cache import cache
-from django.http.response import HttpResponseTooManyRequests
 import logging
 from django.shortcuts import render, redirect, get_object_or_404
 from .forms import ShareDocumentForm
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
-from django.db import transaction
 from typing import Optional, Union
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, HttpResponseNotModified, FileResponse, Http404
+from django.utils.cache import parse_etags, patch_vary_headers, quote_etag
 from django.core.cache import cache
 from django.views.decorators.http import require_http_methods
+from django.db import transaction
+from django.db.models import Prefetch
+from django.urls import reverse
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from .blocks import document_content, load_content
+from .compression import negotiate_encoding, compress
+from . import metrics, tracing
+from .exports import CHUNK_SIZE, FORMATS, cached_export, export_filename, spool, stream_zip
+from .pagination import keyset_page, parse_cursor
+from .presence import get_presence_backend
+from .search import get_search_backend
+from .permissions import has_document_access, invalidate_document_access
+from .ratelimit import rate_limit
+from .persistence import store_document_content, write_document_content
+from .sessions import registry
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -47,22 +63,20 @@ def text_editor(request):
     else:
         return render(request, 'hello/login.html')
 
+# Too many signup attempts from one address
+def signup_limited(request, result):
+    logger.warning(f"Too many signup attempts from {request.META.get('REMOTE_ADDR')}")
+    return HttpResponse("Too many signup attempts. Please try again later.", status=429)
+
 # Handles user registration
 @never_cache
+@rate_limit('signup', methods=('POST',), limited=signup_limited)
 def signup(request):
     if request.method == 'POST':
         username = request.POST.get('username')
         password = request.POST.get('password')
         password_confirm = request.POST.get('password_confirm')
 
-        # Rate limiting check
-        cache_key = f'signup_attempts_{request.META.get("REMOTE_ADDR")}'
-        if cache.get(cache_key, 0) >= 5:  # 5 attempts per minute
-            logger.warning(f"Too many signup attempts from {request.META.get('REMOTE_ADDR')}")
-            return HttpResponseTooManyRequests("Too many signup attempts. Please try again later.")
-        cache.incr(cache_key, 1)
-        cache.expire(cache_key, 60)  # Reset after 1 minute
-
         # Validate input fields
         if not username or not password or not password_confirm:
             messages.error(request, "All fields are required.")
@@ -96,17 +110,75 @@ def logout_view(request):
     messages.success(request, "You have been logged out.")
     return redirect('index')
 
-# Displays a list of documents owned or shared with the user
+# Documents owned by a user, without their content and with share lists prefetched
+def owned_documents_query(user):
+    shared_users = Prefetch('shared_with', queryset=User.objects.only('id', 'username'))
+    return (Document.objects.filter(owner=user)
+            .only('id', 'title', 'updated_at', 'owner_id')
+            .prefetch_related(shared_users))
+
+# Documents shared with a user, without their content and with owners joined
+def shared_documents_query(user):
+    return (Document.objects.filter(shared_with=user)
+            .select_related('owner')
+            .only('id', 'title', 'updated_at', 'owner__username'))
+
+# JSON representation of a document row for the list API
+def document_summary(document, owned):
+    summary = {
+        'id': document.id,
+        'title': document.title,
+        'updated_at': document.updated_at.isoformat(),
+        'edit_url': reverse('editor', kwargs={'doc_id': document.id}),
+    }
+    if owned:
+        summary['shared_with'] = [user.username for user in document.shared_with.all()]
+        summary['share_url'] = reverse('share_document', kwargs={'doc_id': document.id})
+        summary['delete_url'] = reverse('delete_document', kwargs={'doc_id': document.id})
+        summary['versions_url'] = reverse('version_history', kwargs={'doc_id': document.id})
+    else:
+        summary['owner'] = document.owner.username
+    return summary
+
+# Displays the first page of documents owned or shared with the user
 @login_required
 def document_list(request):
-    owned_documents = Document.objects.filter(owner=request.user)
-    shared_documents = Document.objects.filter(shared_with=request.user)
+    owned_documents, owned_next = keyset_page(owned_documents_query(request.user))
+    shared_documents, shared_next = keyset_page(shared_documents_query(request.user))
     context = {
         'owned_documents': owned_documents,
-        'shared_documents': shared_documents
+        'owned_next': owned_next,
+        'shared_documents': shared_documents,
+        'shared_next': shared_next,
     }
     return render(request, 'hello/document_list.html', context)
 
+# Returns a page of owned or shared documents as JSON for infinite scrolling
+@login_required
+def document_list_api(request):
+    owned = request.GET.get('kind', 'owned') != 'shared'
+    query = owned_documents_query(request.user) if owned else shared_documents_query(request.user)
+    before, size = parse_cursor(request)
+    documents, next_cursor = keyset_page(query, before, size)
+    return JsonResponse({
+        'documents': [document_summary(document, owned) for document in documents],
+        'next': next_cursor,
+    })
+
+# Searches the titles and content of the documents the user can access
+# Results are ranked and continue from the opaque `after` cursor of the previous page
+@login_required
+def search_documents(request):
+    query = request.GET.get('q', '').strip()[:200]
+    _, size = parse_cursor(request)
+    include_versions = request.GET.get('versions') == '1'
+    hits, next_cursor = get_search_backend().search(request.user, query, request.GET.get('after'), size, include_versions)
+    for hit in hits:
+        hit['edit_url'] = reverse('editor', kwargs={'doc_id': hit['id']})
+        if hit['version_id'] is not None:
+            hit['version_url'] = reverse('view_version', kwargs={'doc_id': hit['id'], 'version_id': hit['version_id']})
+    return JsonResponse({'results': hits, 'next': next_cursor})
+
 # Allows the user to create a new document
 @login_required
 def create_document(request):
@@ -122,13 +194,13 @@ def create_document(request):
 @login_required
 def editor(request, doc_id):
     try:
-        document = Document.objects.get(id=doc_id)
-        if document.owner == request.user or request.user in document.shared_with.all():
+        # The content is not rendered into the page; the editor loads it from the WebSocket snapshot
+        document = Document.objects.only('id', 'title', 'owner_id').get(id=doc_id)
+        if has_document_access(request.user, document.id, document.owner_id):
             return render(request, 'hello/editor.html', {
                 'doc_id': doc_id,
                 'user': request.user,
                 'title': document.title,
-                'content': document.content,
             })
         else:
             messages.error(request, "You do not have permission to edit this document.")
@@ -137,25 +209,26 @@ def editor(request, doc_id):
         messages.error(request, "Document not found.")
         return redirect('document_list')
 
+# Too many saves by one user
+def save_limited(request, result):
+    return JsonResponse({"status": "error", "message": "Too many save attempts. Please wait."}, status=429)
+
 # Save the document content
 @login_required
 @csrf_protect
-@transaction.atomic
+@rate_limit('save_document', methods=('POST',), limited=save_limited)
 def save_document(request, doc_id):
     if request.method == "POST":
         try:
-            document = Document.objects.get(id=doc_id)
-            if document.owner == request.user or request.user in document.shared_with.all():
-                # Rate limiting check
-                cache_key = f'save_document_{request.user.id}'
-                if cache.get(cache_key, 0) >= 100:  # 100 saves per minute
-                    return JsonResponse({"status": "error", "message": "Too many save attempts. Please wait."}, status=429)
-                cache.incr(cache_key, 1)
-                cache.set(cache_key, cache.get(cache_key, 0), 60)  # Reset after 1 minute
-
+            # Only the columns the save path needs; the stored content is never read
+            document = Document.objects.only('id', 'owner_id', 'content_hash').get(id=doc_id)
+            with tracing.span('permission'):
+                has_access = has_document_access(request.user, document.id, document.owner_id)
+            if has_access:
                 # Parse the request body as JSON
                 try:
-                    data = json.loads(request.body.decode('utf-8'))
+                    with tracing.span('parse'):
+                        data = json.loads(request.body.decode('utf-8'))
                 except json.JSONDecodeError:
                     return JsonResponse({"status": "error", "message": "Invalid JSON data."}, status=400)
                 
@@ -164,17 +237,26 @@ def save_document(request, doc_id):
                 if len(content.encode('utf-8')) > 5 * 1024 * 1024:
                     return JsonResponse({"status": "error", "message": "Document too large. Maximum size is 5MB."}, status=400)
 
-                # Update document content
-                document.content = content
-                document.last_editor = request.user 
-                document.save()
+                # Edits journaled by a crashed live session are stored first
+                if async_to_sync(registry.recover_journal)(document.id):
+                    document.refresh_from_db(fields=['content_hash'])
+
+                # Nothing to do when the content is byte-identical to what is stored
+                if hash_content(content) == document.content_hash:
+                    return JsonResponse({"status": "success", "unchanged": True})
 
-                # Save a new version of the document
-                DocumentVersion.objects.create(
-                    document=document,
-                    content=content,
-                    editor=request.user
-                )
+                # A live editing session buffers writes itself and flushes them in one go
+                session = registry.get(doc_id)
+                if session is not None:
+                    if session.content != content:
+                        async_to_sync(registry.replace_content)(doc_id, content, request.user)
+                    logger.info(f"Document {doc_id} save by user {request.user.username} handed to live session")
+                    return JsonResponse({"status": "success"})
+
+                # Update document content and save a new version of the document
+                write_document_content(document.id, content, request.user.id)
+                # The document's live session may run on another worker
+                async_to_sync(registry.forward_content)(document.id, content, request.user)
 
                 logger.info(f"Document {doc_id} saved successfully by user {request.user.username}")
                 return JsonResponse({"status": "success"})
@@ -192,6 +274,7 @@ def delete_document(request, doc_id):
         try:
             document = Document.objects.get(id=doc_id, owner=request.user)
             document.delete()
+            invalidate_document_access(doc_id)
             logger.debug(f"Document {doc_id} deleted by user {request.user.username}.")
             return JsonResponse({"status": "success"})
         except Document.DoesNotExist:
@@ -202,29 +285,169 @@ def delete_document(request, doc_id):
         return JsonResponse({"status": "error", "message": "Method Not Allowed. Please use POST."}, status=405)
 
 # Retrieve a document's content
-@never_cache
+# The response can be revalidated with If-None-Match and is compressed when large
 @login_required
+@rate_limit('get_document')
 def get_document(request, doc_id):
-    # Rate limiting check
-    cache_key = f'get_document_{request.user.id}'
-    if cache.get(cache_key, 0) >= 100:  # 100 requests per minute
-        return HttpResponseTooManyRequests("Too many requests. Please wait.")
-    cache.incr(cache_key, 1)
-    cache.set(cache_key, cache.get(cache_key, 0), 60)  # Reset after 1 minute
-
-    document = get_object_or_404(Document, id=doc_id)
+    # The content is only loaded if the client's copy turns out to be stale
+    document = get_object_or_404(Document.objects.defer('content'), id=doc_id)
     
     # Check permissions
-    if document.owner != request.user and request.user not in document.shared_with.all():
+    if not has_document_access(request.user, document.id, document.owner_id):
         logger.warning(f"Unauthorized access attempt to document {doc_id} by user {request.user.username}")
         return JsonResponse({"error": "Permission denied"}, status=403)
-    
-    response = JsonResponse({'id': document.id, 'content': document.content})
+
+    # A live editing session holds newer content than the database
+    session = registry.get(document.id)
+    if session is None and async_to_sync(registry.flush_remote)([document.id]):
+        # Another worker's session has just written its content
+        document = Document.objects.defer('content').get(id=document.id)
+    if session is not None:
+        content = session.content
+        content_hash = session.hash_of(content)
+    else:
+        content = document_content(document)
+        content_hash = document.content_hash or hash_content(content)
+    etag = quote_etag(content_hash)
+
+    # The client already has this content
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        body = json.dumps({'id': document.id, 'content': content}).encode('utf-8')
+        encoding = negotiate_encoding(request, len(body))
+        if encoding:
+            # Compressed payloads are cached per content version, not per request
+            payload_key = f'document_payload_{document.id}_{content_hash}_{encoding}'
+            compressed = cache.get(payload_key)
+            if compressed is None:
+                compressed = compress(body, encoding)
+                cache.set(payload_key, compressed, 300)
+            body = compressed
+        response = HttpResponse(body, content_type='application/json')
+        if encoding:
+            response['Content-Encoding'] = encoding
+        response['Content-Length'] = str(len(body))
+
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Accept-Encoding',))
     response['X-Content-Type-Options'] = 'nosniff'
     response['X-Frame-Options'] = 'DENY'
-    response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    # Private to the user's browser, which must revalidate before every reuse
+    response['Cache-Control'] = 'private, no-cache, must-revalidate, max-age=0'
+    return response
+
+# Sends rendered chunks from a temporary file, written before responding
+# Under ASGI, Django 3.2 iterates response content on the event loop; rendering there would stall it
+def spooled_response(chunks, content_type):
+    file, size = spool(chunks)
+    response = FileResponse(file, content_type=content_type)
+    response.block_size = CHUNK_SIZE
+    response['Content-Length'] = str(size)
+    return response
+
+# Response for an export, revalidated with an ETag of the content hash and format
+# `load_content` is only called when the render is not cached
+def export_response(request, title, content_hash, export_format, load_content):
+    etag = quote_etag(f'{content_hash}-{export_format}')
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = spooled_response(cached_export(content_hash, export_format, load_content), FORMATS[export_format][0])
+        response['Content-Disposition'] = f'attachment; filename="{export_filename(title, export_format)}"'
+    response['ETag'] = etag
+    response['X-Content-Type-Options'] = 'nosniff'
+    response['Cache-Control'] = 'private, no-cache, must-revalidate, max-age=0'
     return response
 
+# Downloads a document as HTML, plain text, Markdown or DOCX
+@login_required
+@rate_limit('export')
+def export_document(request, doc_id, export_format):
+    if export_format not in FORMATS:
+        raise Http404("Unknown export format.")
+    document = get_object_or_404(Document.objects.defer('content'), id=doc_id)
+    if not has_document_access(request.user, document.id, document.owner_id):
+        return JsonResponse({"error": "Permission denied"}, status=403)
+
+    # A live editing session holds newer content than the database
+    session = registry.get(document.id)
+    if session is not None:
+        content = session.content
+        return export_response(request, document.title, session.hash_of(content), export_format, lambda: content)
+    if async_to_sync(registry.flush_remote)([document.id]):
+        # Another worker's session has just written its content
+        document = Document.objects.defer('content').get(id=document.id)
+    if not document.content_hash:
+        document.content_hash = hash_content(document.content)
+    return export_response(request, document.title, document.content_hash, export_format, lambda: document_content(document))
+
+# Downloads a version of a document in one of the export formats
+@login_required
+@rate_limit('export')
+def export_version(request, doc_id, version_id, export_format):
+    if export_format not in FORMATS:
+        raise Http404("Unknown export format.")
+    document = get_object_or_404(Document.objects.only('id', 'title', 'owner_id'), id=doc_id)
+    if not has_document_access(request.user, document.id, document.owner_id):
+        return JsonResponse({"error": "Permission denied"}, status=403)
+    version = get_object_or_404(DocumentVersion, id=version_id, document=document)
+
+    title = f'{document.title} {version.timestamp:%Y-%m-%d %H%M}'
+    content_hash = version.content_hash or hash_content(version.full_content)
+    return export_response(request, title, content_hash, export_format, lambda: version.full_content)
+
+# Downloads every document the user owns as one ZIP archive
+# The archive is written one document at a time before it is sent
+@login_required
+@rate_limit('export')
+def export_all_documents(request, export_format):
+    if export_format not in FORMATS:
+        raise Http404("Unknown export format.")
+
+    documents = Document.objects.filter(owner=request.user).order_by('id')
+    # Live sessions on other workers write their content first
+    async_to_sync(registry.flush_remote)(list(documents.values_list('id', flat=True)))
+
+    def entries():
+        names = set()
+        for document_id, title, content_hash in documents.values_list('id', 'title', 'content_hash'):
+            name = export_filename(title, export_format)
+            if name in names:
+                name = f'{document_id}-{name}'
+            names.add(name)
+            if content_hash:
+                # Content is only read for documents whose render is not cached
+                load = partial(load_content, document_id)
+            else:
+                content = load_content(document_id)
+                content_hash = hash_content(content)
+                load = partial(str, content)
+            yield name, cached_export(content_hash, export_format, load)
+
+    response = spooled_response(stream_zip(entries()), 'application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{request.user.username}-documents.zip"'
+    response['X-Content-Type-Options'] = 'nosniff'
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+# Exposes process metrics in the Prometheus text format
+# Open to METRICS_ALLOWED_IPS (the scraper) and to staff users
+@never_cache
+def metrics_view(request):
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if request.META.get('REMOTE_ADDR') not in allowed_ips and not request.user.is_staff:
+        return HttpResponseForbidden("Forbidden")
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Returns the users currently connected to a document
+@login_required
+def document_presence(request, doc_id):
+    document = get_object_or_404(Document.objects.only('id', 'owner_id'), id=doc_id)
+    if not has_document_access(request.user, document.id, document.owner_id):
+        return JsonResponse({"error": "Permission denied"}, status=403)
+    return JsonResponse({'participants': get_presence_backend().participants(document.id)})
+
 # Share a document with other users
 @login_required
 def share_document(request, doc_id):
@@ -240,6 +463,7 @@ def share_document(request, doc_id):
             # Update shared users
             document.shared_with.set(new_shared_users)
             document.save()
+            invalidate_document_access(document.id)
 
             added_users = set(new_shared_users) - set(old_shared_users)
             removed_users = set(old_shared_users) - set(new_shared_users)
@@ -265,20 +489,48 @@ def share_document(request, doc_id):
 
     return render(request, 'hello/share_document.html', {'form': form, 'document': document})
 
+# Versions of a document without their stored content, with editors joined
+def version_rows_query(document):
+    return (document.versions.select_related('editor')
+            .only('id', 'document_id', 'timestamp', 'is_revert', 'editor__username'))
+
 # Displays version history for a document
 @login_required
 def version_history(request, doc_id):
-    document = get_object_or_404(Document, id=doc_id)
-    if document.owner != request.user and request.user not in document.shared_with.all():
+    document = get_object_or_404(Document.objects.defer('content'), id=doc_id)
+    if not has_document_access(request.user, document.id, document.owner_id):
         messages.error(request, "You do not have permission to view the version history of this document.")
         return redirect('document_list')
     
-    # Fetch versions ordered by timestamp (latest first)
-    versions = document.versions.order_by('-timestamp')
+    # Fetch the newest page of versions (latest first)
+    before, size = parse_cursor(request)
+    versions, next_cursor = keyset_page(version_rows_query(document), before, size)
     
     return render(request, 'hello/version_history.html', {
         'document': document,
         'versions': versions,
+        'next_cursor': next_cursor,
+    })
+
+# Returns a page of a document's versions as JSON for infinite scrolling
+@login_required
+def version_history_api(request, doc_id):
+    document = get_object_or_404(Document.objects.only('id', 'owner_id'), id=doc_id)
+    if not has_document_access(request.user, document.id, document.owner_id):
+        return JsonResponse({"error": "Permission denied"}, status=403)
+
+    before, size = parse_cursor(request)
+    versions, next_cursor = keyset_page(version_rows_query(document), before, size)
+    return JsonResponse({
+        'versions': [{
+            'id': version.id,
+            'timestamp': version.timestamp.isoformat(),
+            'editor': version.editor.username if version.editor else None,
+            'is_revert': version.is_revert,
+            'view_url': reverse('view_version', kwargs={'doc_id': document.id, 'version_id': version.id}),
+            'revert_url': reverse('revert_version', kwargs={'doc_id': document.id, 'version_id': version.id}),
+        } for version in versions],
+        'next': next_cursor,
     })
 
 # View a specific version of a document
@@ -286,7 +538,7 @@ def version_history(request, doc_id):
 def view_version(request, doc_id, version_id):
     document = get_object_or_404(Document, id=doc_id)
     version = get_object_or_404(DocumentVersion, id=version_id, document=document)
-    if document.owner != request.user and request.user not in document.shared_with.all():
+    if not has_document_access(request.user, document.id, document.owner_id):
         messages.error(request, "You do not have permission to view this version of the document.")
         return redirect('document_list')
     
@@ -295,39 +547,42 @@ def view_version(request, doc_id, version_id):
         'version': version,
     })
 
+# Too many reverts by one user
+def revert_limited(request, result):
+    messages.error(request, "Too many revert attempts. Please wait.")
+    return redirect('document_list')
+
+# Push reverted content into the document's live session
+def broadcast_revert(document_id, content, user):
+    async_to_sync(registry.replace_content)(document_id, content, user, stored=True)
+    async_to_sync(registry.forward_content)(document_id, content, user)
+
 # Revert a document to a specific version
 @login_required
-@transaction.atomic
+@rate_limit('revert_version', methods=('POST',), limited=revert_limited)
 def revert_version(request, doc_id, version_id):
     try:
         document = get_object_or_404(Document, id=doc_id)
         version = get_object_or_404(DocumentVersion, id=version_id, document=document)
         
-        if document.owner != request.user and request.user not in document.shared_with.all():
+        if not has_document_access(request.user, document.id, document.owner_id):
             logger.warning(f"Unauthorized revert attempt on document {doc_id} by user {request.user.username}")
             messages.error(request, "You do not have permission to revert this document.")
             return redirect('document_list')
         
         if request.method == "POST":
-            # Rate limiting check
-            cache_key = f'revert_version_{request.user.id}'
-            if cache.get(cache_key, 0) >= 10:  # 10 reverts per minute
-                messages.error(request, "Too many revert attempts. Please wait.")
-                return redirect('document_list')
-            cache.incr(cache_key, 1)
-            cache.set(cache_key, cache.get(cache_key, 0), 60)  # Reset after 1 minute
-
-            # Revert document content
-            document.content = version.content
-            document.last_editor = request.user
-            document.save()
+            # Edits journaled by a crashed live session become a version before they are reverted
+            async_to_sync(registry.recover_journal)(document.id)
 
-            # Save the reverted version as a new document version
-            DocumentVersion.objects.create(
-                document=document,
-                content=version.content,
-                editor=request.user
-            )
+            # Revert document content and save the reverted version as a new document version.
+            # Written directly rather than through the write queue, which cannot be waited on
+            # inside a transaction
+            content = version.full_content
+            with transaction.atomic():
+                store_document_content(document.id, content, request.user.id, is_revert=True)
+                # Bring connected editors onto the reverted content, on whichever worker they are,
+                # once it is committed
+                transaction.on_commit(partial(broadcast_revert, document.id, content, request.user))
             
             logger.info(f"Document {doc_id} reverted to version {version_id} by user {request.user.username}")
             messages.success(request, "Document has been reverted to the selected version.")
@@ -335,6 +590,7 @@ def revert_version(request, doc_id, version_id):
     except Exception as e:
         logger.error(f"Error reverting document {doc_id} to version {version_id}: {str(e)}")
         messages.error(request, "An error occurred while reverting the document.")
+        return redirect('document_list')
     else:
         return render(request, 'hello/revert_version.html', {
             'document': document,
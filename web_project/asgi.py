@@ -9,6 +9,10 @@ from channels.auth import AuthMiddlewareStack
 from django.core.asgi import get_asgi_application
 from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler 
 import hello.routing  
+from hello.retention import start_periodic_compaction
+
+# Thin old document versions in the background when VERSION_COMPACTION_INTERVAL is set
+start_periodic_compaction()
 
 application = ProtocolTypeRouter({
     "http": ASGIStaticFilesHandler(get_asgi_application()), 
@@ -1,3 +1,4 @@
+import tempfile
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -37,6 +38,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'hello.tracing.TracingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,10 +59,19 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'timeout': 20,  # Seconds to wait for a lock before "database is locked"
+        },
+        'CONN_MAX_AGE': 60,  # Reuse connections between requests
+        # A file rather than an in-memory database, so tests lock it like the server
+        # does; it lives in the temp directory to keep it out of the repository
+        'TEST': {'NAME': Path(tempfile.gettempdir()) / 'web_project_test_db.sqlite3'},
     }
 }
 
 # settings.py
+# To spread documents over several Redis instances, make "default" a
+# hello.sharding.ShardedChannelLayer listing one alias per instance
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -70,6 +81,101 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Caches access decisions, assembled block-stored documents and export renders.
+# With several COLLAB_WORKERS this has to be a cache they share, e.g.
+# "django.core.cache.backends.memcached.PyMemcacheCache" with "LOCATION": "127.0.0.1:11211"
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+
+# Registry of users connected to each document.
+# With several workers, share it through Redis:
+# "BACKEND": "hello.presence.RedisPresenceBackend" with "host" and "port" in "CONFIG"
+PRESENCE = {
+    "BACKEND": "hello.presence.InMemoryPresenceBackend",
+    "CONFIG": {
+        "ttl": 60,  # Seconds a connection stays present without a heartbeat
+        "snapshot_interval": 1.0,  # Minimum seconds between participant broadcasts per document
+    },
+}
+
+# Request bodies up to this size are read; save_document accepts 5 MB documents plus JSON escaping
+DATA_UPLOAD_MAX_MEMORY_SIZE = 8 * 1024 * 1024
+
+# Rate limits, counted per process.
+# With several workers, share them through Redis (requests are let through while it is down):
+# "BACKEND": "hello.ratelimit.RedisRateLimitBackend" with "CONFIG": {"host": "127.0.0.1", "port": 6379}
+RATE_LIMIT = {
+    "BACKEND": "hello.ratelimit.InMemoryRateLimitBackend",
+    "CONFIG": {},
+}
+RATE_LIMITS = {  # Limit name -> (requests, per seconds); a full allowance may be used at once
+    "signup": (5, 60),
+    "save_document": (100, 60),
+    "get_document": (100, 60),
+    "revert_version": (10, 60),
+    "export": (60, 60),
+    "document_message": (300, 10),  # WebSocket messages per user
+}
+
+# Tracing
+TRACING_ENABLED = False  # Time spans and count queries of every request and WebSocket message
+TRACING_SLOW_MS = 200  # Log traces at least this slow; 0 logs every trace
+PROFILE_SAMPLE_RATE = 0.0  # Fraction of traces also sampled by the profiler
+PROFILE_DIR = BASE_DIR / 'profiles'  # Where folded-stack profiles are written
+PROFILE_INTERVAL_MS = 5  # Milliseconds between profiler samples
+
+# Metrics
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']  # Addresses that may scrape /metrics/ without logging in as staff
+
+# Live editing sessions
+COLLAB_HISTORY_LIMIT = 500  # Committed operations kept for transforming late edits
+COLLAB_FLUSH_INTERVAL = 5  # Seconds between writes of a live session to the database
+COLLAB_FLUSH_BYTES = 256 * 1024  # Edit volume that triggers an early write
+COLLAB_SESSION_LINGER = 30  # Seconds a session outlives its last connection so reconnecting clients can resume (0 closes it at once)
+COLLAB_FRAME_INTERVAL_MS = 50  # Cursor, typing and presence updates are batched per tick of this length
+COLLAB_FRAME_COMPRESS_BYTES = 16 * 1024  # Binary WebSocket frames at least this large are deflated
+COLLAB_MAX_FRAME_BYTES = 8 * 1024 * 1024  # Largest decompressed WebSocket frame accepted from a client
+COLLAB_SNAPSHOT_CHUNK_CHARS = 128 * 1024  # Larger snapshots reach the editor in chunks of about this size
+COLLAB_SEND_QUEUE_FRAMES = 64  # Unsent messages a client may have before it is disconnected as slow
+COLLAB_SLOW_CLIENT_SECONDS = 10  # Age of the oldest unsent message that marks a client as slow
+COLLAB_WORKERS = {}  # Worker id -> WebSocket base URL; when set, each document is served by one worker
+COLLAB_REMOTE_FLUSH_TIMEOUT = 2  # Seconds a worker waits for another worker's live session to flush before reading a document
+COLLAB_SHARD_CHECK_INTERVAL = 1  # Seconds between checks for a shard list changed by another worker
+COLLAB_JOURNAL_DIR = BASE_DIR / 'journal'  # Unflushed edits are journaled here for crash recovery; None disables it
+COLLAB_JOURNAL_SYNC_INTERVAL = 0.05  # Seconds between batched fsyncs of the journal
+COLLAB_BATCH_MEMORY = 24 * 60 * 60  # Seconds the last operation batch committed from each editor is remembered, so a late reconnect is not rebased twice
+DOCUMENT_ACL_CACHE_TIMEOUT = 300  # Seconds a cached document access decision is trusted
+LIST_PAGE_SIZE = 50  # Rows per page in the document list and version history
+
+# Document writes
+DOCUMENT_WRITE_QUEUE = None  # Serialize writes through one thread; None enables it on SQLite only
+DOCUMENT_WRITE_BATCH_INTERVAL = 0.02  # Seconds of writes committed together in one transaction
+DOCUMENT_WRITE_BATCH_SIZE = 200  # Most writes per transaction
+
+# Search
+SEARCH_BACKEND = None  # None uses SQLite FTS5 when available, else hello.search.BasicSearchBackend
+SEARCH_INDEX_VERSIONS = False  # Also index older versions (run rebuild_search_index --versions after enabling)
+
+# Exports
+EXPORT_CACHE_TIMEOUT = 24 * 60 * 60  # Seconds a rendered export stays cached
+EXPORT_CACHE_MAX_BYTES = 2 * 1024 * 1024  # Larger renders are not cached, and are spooled to disk
+
+# Block storage
+DOCUMENT_BLOCK_STORAGE = False  # Store content as per-paragraph DocumentBlock rows; see hello/blocks.py
+DOCUMENT_BLOCK_CACHE_TIMEOUT = 60 * 60  # Seconds an assembled block-stored document stays cached
+DOCUMENT_BLOCK_CACHE_MAX_BYTES = 5 * 1024 * 1024  # Larger documents are assembled on every read
+
+# Document versions
+VERSION_KEYFRAME_INTERVAL = 20  # Every Nth version is stored in full, the rest as deltas
+VERSION_RETENTION = [  # (max age, one version kept per this many seconds); reverts are always kept
+    (60 * 60, 0),
+    (24 * 60 * 60, 10 * 60),
+    (None, 24 * 60 * 60),
+]
+VERSION_COMPACTION_INTERVAL = None  # Seconds between in-process compaction runs; None disables them
 
 
 AUTH_PASSWORD_VALIDATORS = [